@@ -0,0 +1,203 @@
+"""Script for benchmarking the I2C comms path against the Arduino emulator"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import argparse, threading, time
+import i2c_comms as i2c
+import simple_i2c as si2c
+from bus_scheduler import BusScheduler
+from i2c_emulator import ArduinoEmulator, EmulatedBus
+from typing import Any, Callable, Dict, List, Tuple
+
+# Globals
+MODES = ("two-step", "repeated-start", "batched", "readback")
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.00
+    ordered = sorted(samples)
+    idx = min(int(len(ordered) * pct / 100.00), len(ordered) - 1)
+    return ordered[idx]
+
+
+def _tick_single(tick: int) -> List[Tuple[bool, Any]]:
+    return [
+        i2c.call_function(i2c.Function.FUNC_GET_SERVO),
+        i2c.call_function(i2c.Function.FUNC_SET_SERVO, tick % 91),
+    ]
+
+
+def _tick_batched(tick: int) -> List[Tuple[bool, Any]]:
+    return i2c.call_many(
+        [
+            (i2c.Function.FUNC_GET_SERVO, ()),
+            (i2c.Function.FUNC_SET_SERVO, (tick % 91,)),
+        ]
+    )
+
+
+def _tick_readback(tick: int) -> List[Tuple[bool, Any]]:
+    # The readback after this tick's write is the position the next tick needs
+    return [i2c.call_function(i2c.Function.FUNC_SET_SERVO_READBACK, tick % 91)]
+
+
+_TICK_FUNCS: Dict[str, Callable[[int], List[Tuple[bool, Any]]]] = {
+    "two-step": _tick_single,
+    "repeated-start": _tick_single,
+    "batched": _tick_batched,
+    "readback": _tick_readback,
+}
+
+
+def run(
+    ticks: int, emulator: ArduinoEmulator, mode: str = "repeated-start"
+) -> Dict[str, float]:
+    """
+    Runs `ticks` control ticks (a servo read followed by a servo write, the bus traffic of
+    one Controller.simulate iteration) using the bus call pattern `mode` and returns
+    latency and throughput figures.
+    """
+    tick_func = _TICK_FUNCS[mode]
+    latencies: List[float] = []
+    failures = 0
+    bus_errors = 0
+    prev_repeated_start = i2c.USE_REPEATED_START
+
+    i2c.USE_REPEATED_START = mode != "two-step"
+    si2c.init_bus(1, emulator)
+    try:
+        start = time.perf_counter()
+        for tick in range(ticks):
+            t0 = time.perf_counter()
+            try:
+                results = tick_func(tick)
+            except OSError:
+                bus_errors += 1
+            else:
+                latencies.append(time.perf_counter() - t0)
+                failures += sum(1 for (response, _) in results if not response)
+        elapsed = time.perf_counter() - start
+    finally:
+        si2c.close_bus()
+        i2c.USE_REPEATED_START = prev_repeated_start
+
+    return {
+        "ticks_per_sec": len(latencies) / elapsed,
+        "txns_per_sec": emulator.transactions / elapsed,
+        "txns_per_tick": emulator.transactions / ticks,
+        "p50_us": _percentile(latencies, 50) * 1e6,
+        "p99_us": _percentile(latencies, 99) * 1e6,
+        "max_us": max(latencies, default=0.00) * 1e6,
+        "error_replies": failures,
+        "bus_errors": bus_errors,
+    }
+
+
+def run_shared(ticks: int, emulators: List[ArduinoEmulator]) -> Dict[str, float]:
+    """
+    Runs `ticks` control ticks on each emulator at once, one thread per device, with all
+    of them sharing a bus through a BusScheduler. Returns aggregate throughput and the
+    per-tick latency seen by the devices.
+    """
+    scheduler = BusScheduler(EmulatedBus(*emulators))
+    devices = [i2c.Device(scheduler, emulator.address) for emulator in emulators]
+    latencies: List[float] = []
+    bus_errors = [0]
+
+    def drive(device: i2c.Device):
+        samples = []
+        for tick in range(ticks):
+            t0 = time.perf_counter()
+            try:
+                device.call_function(i2c.Function.FUNC_GET_SERVO)
+                device.call_function(i2c.Function.FUNC_SET_SERVO, tick % 91)
+            except OSError:
+                bus_errors[0] += 1
+            else:
+                samples.append(time.perf_counter() - t0)
+        latencies.extend(samples)
+
+    threads = [threading.Thread(target=drive, args=(device,)) for device in devices]
+    scheduler.start()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    scheduler.stop()
+
+    transactions = sum(emulator.transactions for emulator in emulators)
+    return {
+        "ticks_per_sec": len(latencies) / elapsed,
+        "txns_per_sec": transactions / elapsed,
+        "p50_us": _percentile(latencies, 50) * 1e6,
+        "p99_us": _percentile(latencies, 99) * 1e6,
+        "max_us": max(latencies, default=0.00) * 1e6,
+        "bus_errors": bus_errors[0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ticks", type=int, default=10000)
+    parser.add_argument("--latency", type=float, default=0.00, help="seconds")
+    parser.add_argument("--bus-speed", type=float, default=0.00, help="Hz, 0 = off")
+    parser.add_argument("--error-rate", type=float, default=0.00)
+    parser.add_argument("--oserror-rate", type=float, default=0.00)
+    parser.add_argument("--oserror-burst", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--mode",
+        choices=MODES + ("compare",),
+        default="compare",
+        help="bus call pattern",
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=0,
+        help="instead, compare 1 to N devices sharing the bus through a BusScheduler",
+    )
+    args = parser.parse_args()
+
+    def make_emulator(address: int = 0x08) -> ArduinoEmulator:
+        return ArduinoEmulator(
+            address=address,
+            latency=args.latency,
+            bus_speed=args.bus_speed,
+            error_rate=args.error_rate,
+            oserror_rate=args.oserror_rate,
+            oserror_burst=args.oserror_burst,
+            seed=args.seed,
+        )
+
+    if args.devices > 0:
+        counts = range(1, args.devices + 1)
+        rows = {
+            count: run_shared(
+                args.ticks, [make_emulator(0x08 + idx) for idx in range(count)]
+            )
+            for count in counts
+        }
+        print(f"{'devices':>14}" + "".join(f"{count:>12}" for count in counts))
+        for key in rows[1]:
+            print(f"{key:>14}" + "".join(f"{rows[c][key]:>12.2f}" for c in counts))
+        return
+
+    modes = MODES if args.mode == "compare" else (args.mode,)
+    table: Dict[str, Dict[str, float]] = {}
+    for mode in modes:
+        table[mode] = run(args.ticks, make_emulator(), mode)
+
+    print(f"{'':>14}" + "".join(f"{mode:>16}" for mode in modes))
+    for key in table[modes[0]]:
+        print(f"{key:>14}" + "".join(f"{table[mode][key]:>16.2f}" for mode in modes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""Script for timing the controller and comms hot paths against a saved baseline"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import argparse, json, os.path, platform, sys, time
+import i2c_comms as i2c
+import simple_i2c as si2c
+from control_law import CRUISE_MPC, CRUISE_PID
+from controller import Controller, _LOOP_FREQUENCY
+from headless import HeadlessGPIO, VirtualClock
+from i2c_emulator import ArduinoEmulator, engine_sensors
+from plant import reported_position
+from sensors import FILTER_AVERAGE, FILTER_KALMAN, FILTER_MEDIAN, SensorPipeline
+from typing import Callable, Dict, List, Tuple
+
+# Add dashboard directory to import path
+DASHBOARD_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.path.pardir, "dashboard")
+)
+sys.path.append(DASHBOARD_DIR)
+from telemetry import to_view
+
+# Globals
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "bench_baseline.json")
+DEFAULT_THRESHOLD = 0.25  # fractional slowdown that counts as a regression
+_MIN_REPEAT_SECONDS = 0.05  # each timed repeat runs at least this long
+
+# name -> setup function returning the operation to time and its teardown
+_BENCHMARKS: Dict[
+    str, Callable[[], Tuple[Callable[[], object], Callable[[], None]]]
+] = {}
+
+
+def benchmark(name: str):
+    def register(setup):
+        _BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def _nothing():
+    pass
+
+
+def _buffer_pack(u_type: str):
+    buf = i2c.Buffer(i2c.Function.FUNC_SET_SERVO, u_type)
+    if u_type == "string":
+        buf.string = "throttle body"
+    elif u_type == "float":
+        buf.params[:] = [0.50] * 7
+    elif u_type != "void":
+        buf.params[:] = [45] * 7
+    return (buf.pack, _nothing)
+
+
+def _buffer_unpack(u_type: str):
+    (pack, _) = _buffer_pack(u_type)
+    data = pack()
+    return (lambda: i2c.Buffer.unpack(data, u_type), _nothing)
+
+
+for _u_type in ("void", "int", "uint", "float", "string"):
+    benchmark(f"buffer.pack.{_u_type}")(lambda u_type=_u_type: _buffer_pack(u_type))
+    benchmark(f"buffer.unpack.{_u_type}")(lambda u_type=_u_type: _buffer_unpack(u_type))
+
+
+def _call_function(function: i2c.Function, *args):
+    si2c.init_bus(1, ArduinoEmulator())
+    return (lambda: i2c.call_function(function, *args), si2c.close_bus)
+
+
+benchmark("call_function.get_servo")(
+    lambda: _call_function(i2c.Function.FUNC_GET_SERVO)
+)
+benchmark("call_function.set_servo")(
+    lambda: _call_function(i2c.Function.FUNC_SET_SERVO, 45)
+)
+benchmark("call_function.get_telemetry")(
+    lambda: _call_function(i2c.Function.FUNC_GET_TELEMETRY)
+)
+
+
+def _sensor_poll(kind: str):
+    clock = VirtualClock()
+    emulator = ArduinoEmulator(
+        sleep=clock.sleep, clock=clock.now, boot_delay=0, sensor_model=engine_sensors
+    )
+    si2c.init_bus(1, emulator)
+    pipeline = SensorPipeline(kind=kind, clock=clock.now)
+
+    def op():
+        # A full burst of new samples each time
+        clock.sleep(0.14)
+        pipeline.poll()
+
+    return (op, si2c.close_bus)
+
+
+for _kind in (FILTER_AVERAGE, FILTER_MEDIAN, FILTER_KALMAN):
+    benchmark(f"sensors.poll.{_kind}")(lambda kind=_kind: _sensor_poll(kind))
+
+
+_Harness = Tuple[Controller, VirtualClock, ArduinoEmulator, Callable[[], None]]
+
+
+def _headless_controller(cruise_mode: str = CRUISE_PID) -> _Harness:
+    clock = VirtualClock()
+    emulator = ArduinoEmulator(sleep=clock.sleep, clock=clock.now)
+    si2c.init_bus(1, emulator)
+    controller = Controller(
+        gpio=HeadlessGPIO(clock.now),
+        clock=clock.now,
+        sleep=clock.sleep,
+        cruise_mode=cruise_mode,
+    )
+
+    def teardown():
+        si2c.close_bus()
+        controller.cleanup()
+
+    return (controller, clock, emulator, teardown)
+
+
+def _tick(branch: str):
+    (controller, clock, emulator, teardown) = _headless_controller(
+        CRUISE_MPC if branch == "cruise_mpc" else CRUISE_PID
+    )
+    dt = 1.00 / _LOOP_FREQUENCY
+    if branch in ("cruise", "cruise_mpc"):
+        controller.set_cruise_target_speed(60)
+        controller.set_cruise_control_status(True)
+
+    def op():
+        # The tick reads this position back before running the control law
+        throttle = reported_position(emulator.get_servo_position())
+        if branch == "throttle":
+            # Keep the pedal far from the throttle so the throttle PID runs every tick
+            controller.set_accelerator_position(1.00 if throttle < 45 else 0.00)
+        elif branch == "maf":
+            # Pedal matching the throttle leaves the MAF PID in charge
+            controller.set_accelerator_position(throttle / 90)
+        clock.sleep(dt)
+        controller.tick(dt)
+
+    return (op, teardown)
+
+
+for _branch in ("cruise", "cruise_mpc", "throttle", "maf"):
+    benchmark(f"tick.{_branch}")(lambda branch=_branch: _tick(branch))
+
+
+@benchmark("update_speed")
+def _update_speed():
+    (controller, _, _, teardown) = _headless_controller()
+    dt = 1.00 / _LOOP_FREQUENCY
+    return (lambda: controller.update_speed(dt), teardown)
+
+
+@benchmark("dashboard.reply")
+def _reply():
+    (controller, _, _, teardown) = _headless_controller()
+    return (lambda: to_view(controller.get_snapshot()), teardown)
+
+
+def _time_op(op: Callable[[], object], repeats: int) -> List[float]:
+    # Grow the loop count until one repeat is long enough to time reliably
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            op()
+        elapsed = time.perf_counter() - start
+        if elapsed >= _MIN_REPEAT_SECONDS:
+            break
+        loops *= 2 if elapsed <= 0 else max(2, int(_MIN_REPEAT_SECONDS / elapsed))
+
+    samples = [elapsed / loops]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            op()
+        samples.append((time.perf_counter() - start) / loops)
+    return samples
+
+
+def run(names: List[str] = None, repeats: int = 5) -> Dict[str, Dict[str, float]]:
+    """
+    Times each benchmark in `names` (all by default) and returns the best and median
+    per-call time in nanoseconds. The best of several repeats is the figure compared
+    against the baseline, it is the least affected by other load on the machine.
+    """
+    results = {}
+    for name in names or sorted(_BENCHMARKS):
+        (op, teardown) = _BENCHMARKS[name]()
+        try:
+            samples = sorted(_time_op(op, repeats))
+        finally:
+            teardown()
+        results[name] = {
+            "best_ns": samples[0] * 1e9,
+            "median_ns": samples[len(samples) // 2] * 1e9,
+        }
+    return results
+
+
+def compare(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float = DEFAULT_THRESHOLD,
+) -> List[str]:
+    """Returns the names of the benchmarks more than `threshold` slower than baseline"""
+    regressions = []
+    for (name, result) in results.items():
+        base = baseline.get(name)
+        if base is not None and result["best_ns"] > base["best_ns"] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("names", nargs="*", help="benchmarks to run, all by default")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline JSON file")
+    parser.add_argument(
+        "--save", action="store_true", help="write the results as the new baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="allowed slowdown as a fraction of the baseline",
+    )
+    parser.add_argument(
+        "--allow-missing",
+        action="store_true",
+        help="pass when there is no baseline for a benchmark instead of failing",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--list", action="store_true", help="list benchmarks and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(sorted(_BENCHMARKS)))
+        return
+    unknown = [name for name in args.names if name not in _BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(unknown)}")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            saved = json.load(f)
+        if saved["python"] != platform.python_version():
+            print(f"Baseline was recorded on Python {saved['python']}")
+        baseline = saved["results"]
+    elif not args.save:
+        print(f"No baseline at {args.baseline}", file=sys.stderr)
+
+    results = run(args.names, args.repeats)
+    regressions = compare(results, baseline, args.threshold)
+    print(f"{'benchmark':<30} {'best ns':>12} {'median ns':>12} {'baseline':>12}")
+    for (name, result) in results.items():
+        base = baseline.get(name)
+        change = ""
+        if base is not None:
+            change = f"{result['best_ns'] / base['best_ns'] - 1:+.1%}"
+            if name in regressions:
+                change += " REGRESSED"
+        print(
+            f"{name:<30} {result['best_ns']:>12.0f} {result['median_ns']:>12.0f} "
+            f"{base['best_ns'] if base else float('nan'):>12.0f} {change}"
+        )
+
+    if args.save:
+        # Keep entries for benchmarks that were not run this time
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": baseline,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    # A gate that compared nothing must not pass by accident
+    missing = [name for name in results if name not in baseline]
+    if missing:
+        print(f"{len(missing)} with no baseline: {', '.join(missing)}", file=sys.stderr)
+    if regressions:
+        print(f"{len(regressions)} regressed past {args.threshold:.0%}")
+    if regressions or (missing and not args.allow_missing):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
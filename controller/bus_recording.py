@@ -0,0 +1,203 @@
+"""Module for recording I2C bus traffic to a compact binary file and replaying it"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import ctypes, errno, mmap, os, struct, time
+import i2c_comms as i2c
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+# Globals
+MAGIC = b"TBBUSREC"
+VERSION = 2
+FLAG_OSERROR = 0x01  # the transaction raised OSError, response is empty
+FLAG_TICK = 0x02  # no transaction, marks the start of a control tick
+I2C_M_RD = 0x0001  # read flag of struct i2c_msg (linux/i2c.h)
+
+# timestamp, tick, accelerator, maf, cruise enabled, cruise target, flags, request, response
+_RECORD = struct.Struct("<dIff?hB29s29s")
+_TICK = struct.Struct("<I")  # the tick field alone, at offset 8 of a record
+_HEADER = struct.Struct("<8sHH")
+_EMPTY_FRAME = bytes(29)
+_SENSOR_BURST_CMD = bytes([i2c.Function.FUNC_GET_SENSOR_BURST])
+
+
+class Record(NamedTuple):
+    timestamp: float
+    tick: int
+    accelerator: float
+    maf: float
+    cruise_enabled: bool
+    cruise_target_speed: int
+    flags: int
+    request: bytes
+    response: bytes
+
+
+class BusRecorder:
+    """
+    Class appending every i2c_comms request/response pair to a file of fixed-size records.
+
+    `inputs` is called for each record and must return the controller's current
+    ControlInputs (see Controller.get_inputs), so a replay can feed the same operator inputs
+    back in. Install it with i2c_comms.set_recorder().
+    """
+
+    __file: object
+    __inputs: Callable
+    __clock: Callable[[], float]
+
+    def __init__(
+        self, path: str, inputs: Callable, clock: Callable[[], float] = time.monotonic
+    ):
+        self.__inputs = inputs
+        self.__clock = clock
+        new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+        self.__file = open(path, "ab")
+        if new_file:
+            self.__file.write(_HEADER.pack(MAGIC, VERSION, _RECORD.size))
+
+    def record(self, request: bytes, response: Optional[bytes]):
+        """Appends one transaction, `response` is None when the bus raised OSError"""
+        inputs = self.__inputs()
+        self.__file.write(
+            _RECORD.pack(
+                self.__clock(),
+                inputs.tick,
+                inputs.accelerator,
+                inputs.maf,
+                inputs.cruise_enabled,
+                inputs.cruise_target_speed,
+                FLAG_OSERROR if response is None else 0,
+                bytes(request),
+                _EMPTY_FRAME if response is None else bytes(response),
+            )
+        )
+
+    def record_tick(self):
+        """
+        Appends a tick marker. Ticks the servo cache answers make no bus calls, without the
+        marker a replay would never run them.
+        """
+        inputs = self.__inputs()
+        self.__file.write(
+            _RECORD.pack(
+                self.__clock(),
+                inputs.tick,
+                inputs.accelerator,
+                inputs.maf,
+                inputs.cruise_enabled,
+                inputs.cruise_target_speed,
+                FLAG_TICK,
+                _EMPTY_FRAME,
+                _EMPTY_FRAME,
+            )
+        )
+
+    def close(self):
+        self.__file.close()
+
+
+class Recording:
+    """Class giving indexed access to a recording through mmap, without loading it"""
+
+    __file: object
+    __map: mmap.mmap
+    __count: int
+
+    def __init__(self, path: str):
+        self.__file = open(path, "rb")
+        self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, size) = _HEADER.unpack_from(self.__map, 0)
+        # Version 1 is the same format without tick markers
+        if magic != MAGIC or version not in (1, VERSION) or size != _RECORD.size:
+            raise ValueError(f"{path} is not a version {VERSION} bus recording")
+        # A partially written last record (e.g. after a crash) is ignored
+        self.__count = (len(self.__map) - _HEADER.size) // _RECORD.size
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def __getitem__(self, idx: int) -> Record:
+        if idx < 0:
+            idx += self.__count
+        if not 0 <= idx < self.__count:
+            raise IndexError("Record index out of range")
+        return Record._make(
+            _RECORD.unpack_from(self.__map, _HEADER.size + idx * _RECORD.size)
+        )
+
+    def tick_starts(self) -> List[Tuple[int, int]]:
+        """Returns (tick, index of its first record) for every tick in the recording"""
+        starts: List[Tuple[int, int]] = []
+        prev = None
+        for idx in range(self.__count):
+            [tick] = _TICK.unpack_from(
+                self.__map, _HEADER.size + idx * _RECORD.size + 8
+            )
+            if tick != prev:
+                starts.append((tick, idx))
+                prev = tick
+        return starts
+
+    def close(self):
+        self.__map.close()
+        self.__file.close()
+
+
+class ReplayBus:
+    """
+    Stand-in for an smbus2.SMBus that answers from a Recording instead of the Arduino.
+
+    Each write consumes the next record and the following read returns its response, so
+    both the repeated start and the two-step i2c_comms paths replay. Requests that differ
+    from the recorded ones are counted as divergences, which is how a changed control law
+    shows up. Tick markers and the sensor bursts, read on a thread of their own, are
+    skipped.
+    """
+
+    cursor: int
+    divergences: int
+
+    __recording: Recording
+    __pending: Optional[Record]
+
+    def __init__(self, recording: Recording):
+        self.__recording = recording
+        self.__pending = None
+        self.cursor = 0
+        self.divergences = 0
+
+    def seek(self, idx: int):
+        self.cursor = idx
+        self.__pending = None
+
+    def i2c_rdwr(self, *msgs):
+        for msg in msgs:
+            if msg.flags & I2C_M_RD:
+                rec = self.__pending
+                self.__pending = None
+                data = rec.response if rec is not None else _EMPTY_FRAME
+                ctypes.memmove(msg.buf, data[0 : msg.len], min(msg.len, len(data)))
+                continue
+
+            while True:
+                if self.cursor >= len(self.__recording):
+                    raise EOFError("Recording exhausted")
+                rec = self.__recording[self.cursor]
+                self.cursor += 1
+                if not (
+                    rec.flags & FLAG_TICK or rec.request.startswith(_SENSOR_BURST_CMD)
+                ):
+                    break
+            if bytes(msg) != rec.request:
+                self.divergences += 1
+            if rec.flags & FLAG_OSERROR:
+                self.__pending = None
+                raise OSError(errno.EREMOTEIO, "Remote I/O error (recorded)")
+            self.__pending = rec
+
+    def close(self):
+        pass
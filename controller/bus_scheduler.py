@@ -0,0 +1,238 @@
+"""Module for sharing one I2C bus between several throttle body controllers"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import collections, threading, time
+import metrics
+from simple_i2c import MessageCache
+from typing import Callable, Deque, Dict, List, Optional
+
+# Transaction priorities, lower goes first
+PRIORITY_CONTROL = 0  # servo writes
+PRIORITY_TELEMETRY = 1  # reads
+PRIORITIES = (PRIORITY_CONTROL, PRIORITY_TELEMETRY)
+_PRIORITY_NAMES = ("control", "telemetry")
+
+_QUEUE_SECONDS = metrics.Histogram(
+    "bus_queue_seconds", "Time a transaction waited for the bus", ("priority",)
+)
+_BUSY_SECONDS = metrics.Counter(
+    "bus_busy_seconds_total", "Bus time used per device", ("device",)
+)
+_DEADLINE_MISSES = metrics.Counter(
+    "bus_deadline_misses_total", "Transactions dropped past their deadline", ("device",)
+)
+
+
+class DeadlineMissed(Exception):
+    """Raised when a transaction was still queued at its deadline and was not sent"""
+
+
+class _Transaction:
+    __slots__ = (
+        "address",
+        "data",
+        "num_bytes",
+        "priority",
+        "queued",
+        "deadline",
+        "result",
+        "done",
+    )
+
+    address: int
+    data: bytes
+    num_bytes: int
+    priority: int
+    queued: float
+    deadline: Optional[float]
+    result: object  # the bytes read back, or the exception to raise
+    done: threading.Event
+
+    def __init__(self, address, data, num_bytes, priority, queued, deadline):
+        self.address = address
+        self.data = data
+        self.num_bytes = num_bytes
+        self.priority = priority
+        self.queued = queued
+        self.deadline = deadline
+        self.result = None
+        self.done = threading.Event()
+
+
+class _Device:
+    """Per-device queues and the bus time the device has been given"""
+
+    queues: List[Deque[_Transaction]]
+    served: float  # fair queueing virtual time, bus seconds plus idle catch-up
+    busy: float
+    transactions: int
+    deadline_misses: int
+
+    def __init__(self):
+        self.queues = [collections.deque() for _ in PRIORITIES]
+        self.served = 0.00
+        self.busy = 0.00
+        self.transactions = 0
+        self.deadline_misses = 0
+
+    def pending(self) -> bool:
+        return any(self.queues)
+
+
+class BusScheduler:
+    """
+    Class owning one I2C bus and running every transaction on it from a single thread.
+
+    Controllers for the devices on the bus call transact() from their own threads. Queued
+    control writes go ahead of reads. Between devices with work at the same priority, the
+    one that has used the least bus time goes next, so a device with slow transactions gets
+    fewer turns instead of holding up the others. A transaction still queued at its deadline
+    is dropped. Resets happen on the controller threads and never hold the bus.
+    """
+
+    __bus: object
+    __messages: MessageCache
+    __clock: Callable[[], float]
+    __devices: Dict[int, _Device]
+    __cond: threading.Condition
+    __thread: Optional[threading.Thread]
+    __running: bool
+    __virtual_time: float
+
+    def __init__(self, bus, clock: Callable[[], float] = time.monotonic):
+        """
+        bus: an smbus2.SMBus, or any object with `i2c_rdwr(*msgs)` and `close()`
+        clock: monotonic clock in seconds, used for deadlines and fairness
+        """
+        self.__bus = bus
+        self.__messages = MessageCache()
+        self.__clock = clock
+        self.__devices = {}
+        self.__cond = threading.Condition()
+        self.__thread = None
+        self.__running = False
+        self.__virtual_time = 0.00
+
+    # Internal functions
+    def __next_transaction(self) -> Optional[_Transaction]:
+        # Called with the condition held
+        for priority in PRIORITIES:
+            best = None
+            for device in self.__devices.values():
+                if device.queues[priority] and (
+                    best is None or device.served < best.served
+                ):
+                    best = device
+            if best is not None:
+                self.__virtual_time = best.served
+                return best.queues[priority].popleft()
+        return None
+
+    def __execute(self, txn: _Transaction):
+        device = self.__devices[txn.address]
+        start = self.__clock()
+        _QUEUE_SECONDS.labels(_PRIORITY_NAMES[txn.priority]).observe(start - txn.queued)
+
+        try:
+            if txn.deadline is not None and start > txn.deadline:
+                device.deadline_misses += 1
+                _DEADLINE_MISSES.labels(f"{txn.address:#04x}").inc()
+                txn.result = DeadlineMissed(
+                    f"Device {txn.address:#04x} missed its deadline"
+                )
+                return
+            try:
+                # Only the bus thread runs transactions, so it can reuse the same messages
+                write_message = self.__messages.write(txn.address, txn.data)
+                read_message = self.__messages.read(txn.address, txn.num_bytes)
+                self.__bus.i2c_rdwr(write_message.msg, read_message.msg)
+                txn.result = read_message.view.tobytes()
+            except Exception as err:
+                # Fails only this caller, the bus thread goes on with the next transaction
+                txn.result = err
+            elapsed = self.__clock() - start
+            device.served += elapsed
+            device.busy += elapsed
+            device.transactions += 1
+            _BUSY_SECONDS.labels(f"{txn.address:#04x}").inc(elapsed)
+        finally:
+            txn.done.set()
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                txn = self.__next_transaction()
+                while txn is None and self.__running:
+                    self.__cond.wait()
+                    txn = self.__next_transaction()
+                if txn is None:
+                    return
+            self.__execute(txn)
+
+    # Public Functions
+    def add_device(self, address: int):
+        with self.__cond:
+            self.__devices.setdefault(address, _Device())
+
+    def start(self):
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Finishes the queued transactions, then closes the bus"""
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+        self.__bus.close()
+
+    def transact(
+        self,
+        address: int,
+        data: bytes,
+        num_bytes: int,
+        priority: int = PRIORITY_TELEMETRY,
+        timeout: Optional[float] = None,
+    ) -> bytes:
+        """
+        Writes `data` to `address` and reads `num_bytes` back in one transaction once the
+        bus is free, blocking until it is done. Raises whatever the bus raised (normally
+        OSError), or DeadlineMissed if it could not start within `timeout` seconds.
+        """
+        now = self.__clock()
+        deadline = None if timeout is None else now + timeout
+        txn = _Transaction(address, bytes(data), num_bytes, priority, now, deadline)
+        with self.__cond:
+            if not self.__running:
+                raise RuntimeError("Bus scheduler is not running")
+            device = self.__devices.get(address)
+            if device is None:
+                device = self.__devices[address] = _Device()
+            if not device.pending():
+                # An idle device starts level with the others instead of with saved credit
+                device.served = max(device.served, self.__virtual_time)
+            device.queues[priority].append(txn)
+            self.__cond.notify()
+
+        txn.done.wait()
+        if isinstance(txn.result, Exception):
+            raise txn.result
+        return txn.result
+
+    def stats(self) -> Dict[int, Dict[str, float]]:
+        """Returns per-device transaction counts, bus time used and deadline misses"""
+        with self.__cond:
+            return {
+                address: {
+                    "transactions": device.transactions,
+                    "bus_seconds": device.busy,
+                    "deadline_misses": device.deadline_misses,
+                }
+                for (address, device) in self.__devices.items()
+            }
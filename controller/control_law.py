@@ -0,0 +1,89 @@
+"""Module containing the throttle control law run by the controller every tick"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+from mpc import CruiseMpc
+from simple_pid import PID
+from typing import NamedTuple, Optional
+
+# Globals
+ACCEL_DIFF_RANGE = 5  # degrees the throttle may lag the accelerator before it is chased
+MAF_SETPOINT: float = 14.7  # stoichiometric air-fuel ratio
+
+# Cruise modes
+CRUISE_PID = "pid"  # cruise PID nudging the throttle from where it is
+CRUISE_MPC = "mpc"  # mpc.CruiseMpc choosing from simulated futures, needs numpy
+
+
+class Gains(NamedTuple):
+    p: float
+    i: float
+    d: float
+
+
+class ControlLaw:
+    """
+    Class choosing the throttle body command from the current vehicle state.
+
+    With cruise enabled the cruise PID, or with `cruise_mode` CRUISE_MPC the model
+    predictive controller, drives speed to the target. Otherwise the throttle PID chases the
+    accelerator until the throttle is within ACCEL_DIFF_RANGE degrees of it, after which the
+    MAF PID trims for air-fuel ratio.
+    """
+
+    branch: str  # "cruise", "throttle" or "maf", whichever the last update() ran
+    cruise_mpc: Optional[CruiseMpc]
+    cruise_pid: PID
+    maf_pid: PID
+    throttle_pid: PID
+
+    def __init__(
+        self, cruise: Gains, throttle: Gains, maf: Gains, cruise_mode: str = CRUISE_PID
+    ):
+        if cruise_mode not in (CRUISE_PID, CRUISE_MPC):
+            raise ValueError(f"Unknown cruise mode: {cruise_mode}")
+        self.branch = "maf"
+        self.cruise_mpc = CruiseMpc() if cruise_mode == CRUISE_MPC else None
+        # Every call passes dt, simple_pid's default sample_time would make calls closer
+        # together than 10 ms return the last output
+        self.cruise_pid = PID(*cruise, setpoint=0, sample_time=None)
+        self.maf_pid = PID(*maf, setpoint=MAF_SETPOINT, sample_time=None)
+        self.throttle_pid = PID(*throttle, setpoint=0, sample_time=None)
+
+    def update(
+        self,
+        throttle_position: int,
+        speed: float,
+        accelerator_position: float,
+        cruise_enabled: bool,
+        cruise_target_speed: int,
+        maf: float,
+        dt: float,
+    ) -> int:
+        """Returns the position to command, before clamping to the 0 - 90 degree range"""
+        global ACCEL_DIFF_RANGE
+
+        if cruise_enabled and self.cruise_mpc is not None:
+            self.branch = "cruise"
+            # Plans in absolute positions, not a correction to the current one
+            return self.cruise_mpc.update(
+                throttle_position, speed, cruise_target_speed, dt
+            )
+        elif cruise_enabled:
+            self.branch = "cruise"
+            self.cruise_pid.setpoint = cruise_target_speed
+            output = int(self.cruise_pid(speed, dt))
+        elif (
+            throttle_position > accelerator_position * 90 + ACCEL_DIFF_RANGE
+            or throttle_position < accelerator_position * 90 - ACCEL_DIFF_RANGE
+        ):
+            self.branch = "throttle"
+            self.throttle_pid.setpoint = accelerator_position * 90
+            output = int(self.throttle_pid(throttle_position, dt))
+        else:
+            self.branch = "maf"
+            output = int(self.maf_pid(maf, dt))
+        return output + throttle_position
@@ -5,30 +5,57 @@ __copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
 __license__ = "MIT"
 __version__ = "0.1"
 
-import time
+import asyncio, json, time
 import i2c_comms as i2c
-import RPi.GPIO as GPIO
-from simple_pid import PID
-from typing import Dict
-
-
-class DTC:
+import metrics
+import plant
+from bus_scheduler import DeadlineMissed
+from control_law import CRUISE_PID, MAF_SETPOINT, ControlLaw, Gains
+from diagnostics import DTC, DtcEvent, DtcLog, DtcStore, FreezeFrame
+from diagnostics import DTC_INTERMITTENT_COMMS, DTC_NOT_RESPONDING, DTC_SPEED_RANGE
+from recovery import Recovery
+from scheduler import TickScheduler, POLICY_SKIP
+from sensors import FILTER_MEDIAN, SensorPipeline
+from servo_cache import ServoCache
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    import RPi.GPIO as GPIO
+except (ImportError, RuntimeError):
+    # Not on a Pi, only controllers given a stand-in (see headless.py) can be built
+    GPIO = None
+
+
+class TelemetrySnapshot(NamedTuple):
     """
-    Class representing a diagnostic trouble code.
+    Immutable view of the controller state at the end of one tick.
 
-    Contains an integer identifier and a string description
+    A new snapshot replaces the previous one once per tick, so a reader holding a snapshot
+    always sees values that belong together. `seq` increases by one per snapshot.
     """
 
-    number: int
-    message: str
+    seq: int
+    timestamp: float
+    cruise_on: bool
+    cruise_speed: int
+    vehicle_speed: float
+    accelerator: float
+    throttle: int
+    maf: float
+    dtc: Tuple[Tuple[int, str], ...]
+
+
+class ControlInputs(NamedTuple):
+    """Operator inputs in effect for one tick"""
 
-    def __init__(self, num: int, mesg: str):
-        self.number = num
-        self.message = mesg
+    tick: int
+    accelerator: float
+    cruise_enabled: bool
+    cruise_target_speed: int
+    maf: float
 
 
 # Global tuning parameters
-_ACCEL_DIFF_RANGE = 5
 _CRUISE_P: float = 0.55
 _CRUISE_I: float = 0.01
 _CRUISE_D: float = 0.6
@@ -41,6 +68,55 @@ _THROTTLE_D: float = 0.1
 
 # Other globals
 _RESET_PIN: int = 17
+_LOOP_FREQUENCY: float = 1.00 / 0.30  # Hz
+_BUS_RETRIES: int = 2  # immediate retries of a failed call before resetting the board
+_SERVO_MAX_AGE: float = 1.00  # seconds a cached servo position is trusted
+_SERVO_VERIFY_INTERVAL: float = 5.00  # seconds between forced servo reads
+_BULK_TELEMETRY: bool = True  # falls back to plain servo calls on older firmware
+_FREEZE_FRAME_TICKS: int = 16  # ticks of history kept with each DTC that sets
+_SENSOR_RATE: float = 10.00  # Hz, stops on firmware without FUNC_GET_SENSOR_BURST
+_SENSOR_FILTER: str = FILTER_MEDIAN  # see sensors.make_filter
+_SENSOR_WINDOW: int = 5  # samples
+
+# Metrics, exposed by the dashboard at /metrics
+_TICK_SECONDS = metrics.Histogram(
+    "controller_tick_seconds", "Time for one control tick", ("branch",)
+)
+_PID_SECONDS = metrics.Histogram(
+    "controller_pid_seconds", "Time evaluating the control law", ("branch",)
+)
+_WAIT_SECONDS = metrics.Histogram(
+    "controller_wait_seconds", "Time sleeping until the next tick is due"
+)
+_OVERRUNS = metrics.Counter(
+    "controller_loop_overruns_total", "Ticks that started after their deadline"
+)
+
+
+def load_gains(path: str, rank: int = 0):
+    """
+    Loads PID gains written by tune_pid.py, taking the entry at `rank` for each loop.
+    Controllers constructed afterwards use the new gains.
+    """
+    global _CRUISE_P
+    global _CRUISE_I
+    global _CRUISE_D
+    global _MAF_P
+    global _MAF_I
+    global _MAF_D
+    global _THROTTLE_P
+    global _THROTTLE_I
+    global _THROTTLE_D
+
+    with open(path, "r") as f:
+        tuning = json.load(f)
+
+    if "cruise" in tuning:
+        (_CRUISE_P, _CRUISE_I, _CRUISE_D) = tuning["cruise"][rank]["gains"]
+    if "maf" in tuning:
+        (_MAF_P, _MAF_I, _MAF_D) = tuning["maf"][rank]["gains"]
+    if "throttle" in tuning:
+        (_THROTTLE_P, _THROTTLE_I, _THROTTLE_D) = tuning["throttle"][rank]["gains"]
 
 
 class Controller:
@@ -55,51 +131,154 @@ class Controller:
     # Instance Variables
     __running: bool
     __accelerator_position: float
-    __arduino_reset_count: float
+    __bus_errors: int
+    __call_function: Callable[..., Tuple[bool, Any]]
+    __clock: Callable[[], float]
     __cruise_enabled: bool
-    __cruise_pid: PID
+    __control_law: ControlLaw
     __cruise_target_speed: int
-    __current_speed: int
-    __dtc_list: Dict[int, DTC]
+    __current_speed: float
+    __dtc: DtcStore
+    __executor: Any
+    __gpio: Any
+    __last_command: int
+    __last_tick: Optional[float]
+    __looping: bool
     __maf_value: float
-    __maf_pid: PID
-    __throttle_pid: PID
+    __recovery: Recovery
+    __reset_pin: int
+    __scheduler: TickScheduler
+    __sensors: Optional[SensorPipeline]
+    __servo_cache: ServoCache
+    __snapshot: TelemetrySnapshot
+    __snapshot_listeners: List[Callable[[TelemetrySnapshot], None]]
     __throttle_position: int
+    __tick_count: int
 
     # Constructor
-    def __init__(self):
+    def __init__(
+        self,
+        frequency: float = _LOOP_FREQUENCY,
+        overrun_policy: str = POLICY_SKIP,
+        device: i2c.Device = None,
+        reset_pin: int = _RESET_PIN,
+        gpio=None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+        dtc_log: Optional[str] = None,
+        cruise_mode: str = CRUISE_PID,
+        sensor_rate: float = _SENSOR_RATE,
+    ):
+        """
+        device: the throttle body to drive when several share a bus, by default calls go to
+            i2c_comms.ADDR through simple_i2c
+        reset_pin: BCM pin wired to the throttle body Arduino's reset line
+        gpio: object with the RPi.GPIO interface, by default RPi.GPIO itself
+        clock: monotonic clock in seconds, used for tick deadlines, recovery and snapshots
+        sleep: sleeps on `clock`, pass headless.VirtualClock's pair to run without waiting
+        dtc_log: file to append DTC events and freeze frames to (see diagnostics.DtcLog)
+        cruise_mode: control_law.CRUISE_PID or CRUISE_MPC
+        sensor_rate: Hz the MAF and O2 sensors are read at while simulate() or run() is
+            running, on a thread of its own paced by `clock` and `sleep`. 0 leaves the MAF
+            value alone, which headless runs on a VirtualClock need.
+        """
         global _CRUISE_P
         global _CRUISE_I
         global _CRUISE_D
+        global _MAF_P
+        global _MAF_I
+        global _MAF_D
         global _THROTTLE_P
         global _THROTTLE_I
         global _THROTTLE_D
+        global _SERVO_MAX_AGE
+        global _SERVO_VERIFY_INTERVAL
+        global _BULK_TELEMETRY
+        global _FREEZE_FRAME_TICKS
+        global _SENSOR_FILTER
+        global _SENSOR_WINDOW
+
+        if gpio is None:
+            if GPIO is None:
+                raise RuntimeError("RPi.GPIO is not available, pass a gpio stand-in")
+            gpio = GPIO
 
         self.__running = False
         self.__accelerator_position = 0.00
-        self.__arduino_reset_count = 0.00
+        self.__bus_errors = 0
+        self.__servo_cache = ServoCache(
+            device.call_function if device is not None else i2c.call_function,
+            _SERVO_MAX_AGE,
+            _SERVO_VERIFY_INTERVAL,
+            clock=clock,
+            bulk=_BULK_TELEMETRY,
+        )
+        self.__call_function = self.__servo_cache.call_function
+        self.__clock = clock
         self.__cruise_enabled = False
-        self.__cruise_pid = PID(_CRUISE_P, _CRUISE_I, _CRUISE_D, setpoint=0)
+        self.__control_law = ControlLaw(
+            cruise=Gains(_CRUISE_P, _CRUISE_I, _CRUISE_D),
+            throttle=Gains(_THROTTLE_P, _THROTTLE_I, _THROTTLE_D),
+            maf=Gains(_MAF_P, _MAF_I, _MAF_D),
+            cruise_mode=cruise_mode,
+        )
         self.__cruise_target_speed = 0
-        self.__current_speed = 0
-        self.__dtc_list = {}
+        self.__current_speed = 0.00
+        self.__dtc = DtcStore(
+            device.address if device is not None else i2c.ADDR,
+            _FREEZE_FRAME_TICKS,
+            clock=clock,
+            log=DtcLog(dtc_log, _FREEZE_FRAME_TICKS) if dtc_log else None,
+        )
+        self.__executor = device.executor if device is not None else i2c.BUS_EXECUTOR
+        self.__gpio = gpio
+        self.__last_command = 0
+        self.__last_tick = None
+        self.__looping = False
         self.__maf_value = 14.7
-        self.__maf_pid = PID(_MAF_P, _MAF_I, _MAF_D, setpoint=14.7)
-        self.__throttle_pid = PID(_THROTTLE_P, _THROTTLE_I, _THROTTLE_D, setpoint=0)
+        self.__recovery = Recovery(self.__drive_reset_pin, clock)
+        self.__reset_pin = reset_pin
+        self.__scheduler = TickScheduler(frequency, overrun_policy, clock, sleep)
+        self.__sensors = None
+        if sensor_rate > 0:
+            # Straight to the bus, sensor reads have nothing to do with the servo cache
+            self.__sensors = SensorPipeline(
+                device.call_function if device is not None else i2c.call_function,
+                sensor_rate,
+                _SENSOR_FILTER,
+                _SENSOR_WINDOW,
+                clock=clock,
+                sleep=sleep,
+            )
         self.__throttle_position = 0
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(17, GPIO.OUT)
+        self.__tick_count = 0
+        self.__snapshot_listeners = []
+        self.__snapshot = None
+        self.__publish_snapshot()
+        self.__gpio.setmode(self.__gpio.BCM)
+        self.__gpio.setup(self.__reset_pin, self.__gpio.OUT)
 
     # Internal functions
-    def __reset_throttle_body_board(self):
-        self.__arduino_reset_count += 1.00
-        if self.__arduino_reset_count > 3.00:
-            self.__dtc_list[1] = DTC(1, "Intermittent I2C comms")
-        print("----------------------\nRESETTING ARDUINO!\n----------------------")
-        GPIO.output(17, GPIO.HIGH)
-        time.sleep(0.2)
-        GPIO.output(17, GPIO.LOW)
-        time.sleep(2.0)
+    def __drive_reset_pin(self, high: bool):
+        self.__gpio.output(
+            self.__reset_pin, self.__gpio.HIGH if high else self.__gpio.LOW
+        )
+
+    def __call(self, function: i2c.Function, *args) -> Optional[Tuple[bool, Any]]:
+        # Returns None once the retries are used up, recovery takes over from there
+        global _BUS_RETRIES
+
+        for attempt in range(_BUS_RETRIES + 1):
+            try:
+                result = self.__call_function(function, *args)
+            except OSError:
+                self.__bus_errors += 1
+                if attempt == _BUS_RETRIES:
+                    self.__recovery.report_failure()
+            else:
+                self.__recovery.report_success()
+                return result
+        return None
 
     def __set_throttle_body(self, pos: int):
         # Restrict throttle body to 0 - 90 degrees
@@ -108,33 +287,66 @@ class Controller:
         elif pos < 0:
             pos = 0
         try:
-            i2c.call_function(i2c.Function.FUNC_SET_SERVO, pos)
-        except OSError:
-            self.__reset_throttle_body_board()
-            self.__set_throttle_body(pos)
-        else:
-            # Slowly decrease intermittent reset count for DTC
-            self.__arduino_reset_count -= 0.10
-            if self.__arduino_reset_count < 3.00:
-                self.__dtc_list.pop(1, None)
-            if self.__arduino_reset_count < 0.00:
-                self.__arduino_reset_count = 0.00
+            result = self.__call(i2c.Function.FUNC_SET_SERVO, pos)
+        except DeadlineMissed:
+            # Shared bus too busy, the next tick sends a fresh command
+            return
+        if result is not None and result[0]:
+            self.__last_command = pos
 
     def __update_throttle(self):
         try:
-            (response, result) = i2c.call_function(i2c.Function.FUNC_GET_SERVO)
-        except OSError:
-            self.__reset_throttle_body_board()
-            self.get_throttle_body()
-        else:
-            # Slowly decrease intermittent reset count for DTC
-            self.__arduino_reset_count -= 0.10
-            if self.__arduino_reset_count < 3.00:
-                self.__dtc_list.pop(1, None)
-            if self.__arduino_reset_count < 0.00:
-                self.__arduino_reset_count = 0.00
-            if response:
-                self.__throttle_position = result
+            result = self.__call(i2c.Function.FUNC_GET_SERVO)
+        except DeadlineMissed:
+            # Shared bus too busy, keep the last known position for this tick
+            return
+        if result is not None and result[0]:
+            self.__throttle_position = result[1]
+
+    def __update_maf(self):
+        # Ticks driven by hand, without the acquisition thread, keep the value they have
+        if self.__sensors is None or not self.__sensors.running():
+            return
+        values = self.__sensors.values()
+        # With no fresh readings trim for nothing rather than chase a stale one
+        self.__maf_value = values.afr if values is not None else MAF_SETPOINT
+
+    def __release(self):
+        self.__gpio.cleanup()
+        self.__dtc.close()
+
+    def __end_loop(self):
+        if self.__sensors is not None:
+            # Joins the thread, at most one sensor period
+            self.__sensors.stop()
+        self.__looping = False
+        # The last tick may still drive the reset pin or log a DTC, so both are released
+        # only once the loop is done. cleanup() releases them itself when no loop runs.
+        if not self.__running:
+            self.__release()
+
+    def __update_comms_dtcs(self):
+        self.__dtc.update(DTC_INTERMITTENT_COMMS, self.__recovery.intermittent())
+        # Not breaker_open(), which drops during each reset tried while the board is down
+        self.__dtc.update(DTC_NOT_RESPONDING, self.__recovery.breaker_tripped())
+
+    def __publish_snapshot(self):
+        prev = self.__snapshot
+        snapshot = TelemetrySnapshot(
+            seq=prev.seq + 1 if prev is not None else 0,
+            timestamp=self.__clock(),
+            cruise_on=self.__cruise_enabled,
+            cruise_speed=self.__cruise_target_speed if self.__cruise_enabled else 0,
+            vehicle_speed=self.__current_speed,
+            accelerator=self.__accelerator_position,
+            throttle=self.__throttle_position,
+            maf=self.__maf_value,
+            dtc=self.__dtc.codes(),
+        )
+        # A single reference swap, readers never see a half-built snapshot
+        self.__snapshot = snapshot
+        for listener in self.__snapshot_listeners:
+            listener(snapshot)
 
     # Functions only used for testing, do not simulate real world behavior
     def __test__set_maf(self, maf: float):
@@ -143,7 +355,8 @@ class Controller:
     # Public Functions
     def cleanup(self):
         self.__running = False
-        GPIO.cleanup()
+        if not self.__looping:
+            self.__release()
 
     def get_accelerator_position(self) -> float:
         return self.__accelerator_position
@@ -156,30 +369,29 @@ class Controller:
             pos = 0.00
         self.__accelerator_position = pos
 
-    def update_speed(self) -> int:
-        # Max acceleration (m/s2)
-        a_max = 4.5
-
-        cur_throttle = self.get_throttle_body() / 90.00
-
-        # Acceleration curve equation
-        a_x = a_max * (8.073 * (cur_throttle ** 4) - 18.252 * (cur_throttle ** 3) + 12.212 * (cur_throttle ** 2) - 1.022 * cur_throttle - 0.005)
-        # Subtract for friction and air resistance
-        a_x -= 0.89
-        # Convert to mph/s
-        a_x *= 2.237
-        self.__current_speed += int(a_x)
+    def update_speed(self, dt: float) -> float:
+        """Integrates the vehicle speed over `dt` seconds at the current throttle"""
+        a_x = plant.acceleration(self.get_throttle_body())
+        self.__current_speed += a_x * dt
         if self.__current_speed < 0:
-            self.__current_speed = 0
-
-        if self.__current_speed > 100:
-            self.__dtc_list[2] = DTC(2, "Speed value out of range")
-        else:
-            self.__dtc_list.pop(2, None)
+            self.__current_speed = 0.00
+        self.__dtc.update(DTC_SPEED_RANGE, self.__current_speed > 100)
         return self.__current_speed
 
     def get_dtc_list(self) -> Dict[int, DTC]:
-        return self.__dtc_list
+        # Copy, the control loop sets and clears codes while callers iterate
+        return self.__dtc.active()
+
+    def get_freeze_frames(self, code: Optional[int] = None) -> List[FreezeFrame]:
+        """Returns the freeze frames captured when codes set, newest last"""
+        return self.__dtc.freeze_frames(code)
+
+    def add_dtc_listener(self, listener: Callable[[DtcEvent], None]):
+        """
+        Registers `listener` to be called from the control loop when a DTC sets or clears.
+        Listeners run on the control thread, so they should only hand the event off.
+        """
+        self.__dtc.add_listener(listener)
 
     def get_cruise_control_status(self) -> bool:
         return self.__cruise_enabled
@@ -204,30 +416,147 @@ class Controller:
     def get_maf_value(self) -> float:
         return self.__maf_value
 
-    def simulate(self):
-        global _ACCEL_DIFF_RANGE
+    def set_maf_value(self, afr: float):
+        """Sets the AFR reading, for replays. The sensor thread replaces it while running."""
+        self.__maf_value = afr
 
-        self.__running = True
+    def get_current_speed(self) -> float:
+        return self.__current_speed
 
-        while self.__running:
-            time.sleep(0.3)
+    def get_snapshot(self) -> TelemetrySnapshot:
+        """Returns the snapshot published by the last tick, safe to call from any thread"""
+        return self.__snapshot
+
+    def add_snapshot_listener(self, listener: Callable[[TelemetrySnapshot], None]):
+        """
+        Registers `listener` to be called from the control loop with each tick's snapshot.
+        Listeners run on the control thread, so they should only hand the snapshot off.
+        """
+        self.__snapshot_listeners.append(listener)
+
+    def get_loop_stats(self) -> Dict[str, float]:
+        return self.__scheduler.stats()
+
+    def reset_loop_stats(self):
+        self.__scheduler.reset_stats()
+
+    def get_recovery_stats(self) -> Dict[str, object]:
+        return self.__recovery.stats()
+
+    def get_servo_cache_stats(self) -> Dict[str, float]:
+        return self.__servo_cache.stats()
+
+    def get_sensor_stats(self) -> Optional[Dict[str, float]]:
+        return self.__sensors.stats() if self.__sensors is not None else None
+
+    def get_board_telemetry(self) -> Optional[i2c.Telemetry]:
+        """Returns the newest health frame from the throttle body firmware, if any"""
+        return self.__servo_cache.telemetry()
+
+    def get_inputs(self) -> ControlInputs:
+        return ControlInputs(
+            self.__tick_count,
+            self.__accelerator_position,
+            self.__cruise_enabled,
+            self.__cruise_target_speed,
+            self.__maf_value,
+        )
+
+    def tick(self, dt: float):
+        """Runs one iteration of the control loop, `dt` being the tick period in seconds"""
+        start = time.perf_counter()
+        self.__tick_count += 1
+        i2c.record_tick()
+        # The plant integrates the time that really passed, so late or skipped ticks
+        # still move the vehicle the right distance
+        now = self.__clock()
+        elapsed = dt if self.__last_tick is None else now - self.__last_tick
+        self.__last_tick = now
+        self.__recovery.poll()
+        if self.__recovery.ok():
             self.__update_throttle()
-            if self.__cruise_enabled:
-                speed = self.update_speed()
-                self.__cruise_pid.setpoint = self.__cruise_target_speed
-                output = int(self.__cruise_pid(speed))
-                self.__set_throttle_body(output + self.__throttle_position)
-            else:
-                if (
-                    self.__throttle_position
-                    > self.__accelerator_position * 90 + _ACCEL_DIFF_RANGE
-                    or self.__throttle_position
-                    < self.__accelerator_position * 90 - _ACCEL_DIFF_RANGE
-                ):
-                    self.__throttle_pid.setpoint = self.__accelerator_position * 90
-                    output = int(self.__throttle_pid(self.__throttle_position))
-                    self.__set_throttle_body(output + self.__throttle_position)
-                else:
-                    cur_maf = self.get_maf_value()
-                    output = int(self.__maf_pid(cur_maf))
-                    self.__set_throttle_body(output + self.__throttle_position)
+        self.__update_maf()
+        speed = self.update_speed(elapsed)
+
+        if self.__recovery.ok():
+            pid_start = time.perf_counter()
+            pos = self.__control_law.update(
+                self.__throttle_position,
+                speed,
+                self.__accelerator_position,
+                self.__cruise_enabled,
+                self.__cruise_target_speed,
+                self.get_maf_value(),
+                dt,
+            )
+            branch = self.__control_law.branch
+            _PID_SECONDS.labels(branch).observe(time.perf_counter() - pid_start)
+            self.__set_throttle_body(pos)
+        else:
+            # Degraded, hold the last command the board acknowledged. Sending it again is
+            # also the probe that ends recovery once the board is back.
+            branch = "degraded"
+            if self.__recovery.probe_due():
+                self.__set_throttle_body(self.__last_command)
+        self.__update_comms_dtcs()
+        self.__dtc.sample(
+            self.__tick_count,
+            self.__throttle_position,
+            speed,
+            self.__accelerator_position,
+            self.__maf_value,
+            self.__bus_errors,
+        )
+        self.__publish_snapshot()
+        _TICK_SECONDS.labels(branch).observe(time.perf_counter() - start)
+
+    def simulate(self, ticks: Optional[int] = None):
+        """Runs the control loop until cleanup(), or for `ticks` ticks if given"""
+        self.__running = True
+        # PIDs are evaluated on the nominal tick period so tuning holds under load
+        dt = self.__scheduler.period
+        self.__last_tick = None
+        self.__looping = True
+        self.__scheduler.start()
+        if self.__sensors is not None:
+            self.__sensors.start()
+
+        try:
+            while self.__running and (ticks is None or ticks > 0):
+                if ticks is not None:
+                    ticks -= 1
+                start = time.perf_counter()
+                if self.__scheduler.wait():
+                    _OVERRUNS.inc()
+                _WAIT_SECONDS.observe(time.perf_counter() - start)
+                self.tick(dt)
+        finally:
+            self.__end_loop()
+
+    async def run(self, ticks: Optional[int] = None):
+        """
+        Same as simulate(), for asyncio. Ticks are timed on the running event loop and each
+        one runs on the bus executor (i2c_comms.BUS_EXECUTOR, or the device's), so the loop
+        is free for other tasks while the bus is busy. Snapshot listeners are called on the
+        executor thread, use loop.call_soon_threadsafe() to get back onto the loop.
+        """
+        loop = asyncio.get_running_loop()
+        self.__running = True
+        dt = self.__scheduler.period
+        self.__last_tick = None
+        self.__looping = True
+        self.__scheduler.start()
+        if self.__sensors is not None:
+            self.__sensors.start()
+
+        try:
+            while self.__running and (ticks is None or ticks > 0):
+                if ticks is not None:
+                    ticks -= 1
+                start = time.perf_counter()
+                if await self.__scheduler.wait_async():
+                    _OVERRUNS.inc()
+                _WAIT_SECONDS.observe(time.perf_counter() - start)
+                await loop.run_in_executor(self.__executor, self.tick, dt)
+        finally:
+            self.__end_loop()
@@ -0,0 +1,557 @@
+"""Module for running the controllers in their own process, away from the web server"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import multiprocessing, os.path, queue, signal, struct, sys, threading, time
+import i2c_comms as i2c
+import metrics
+from bus_recording import BusRecorder
+from bus_scheduler import BusScheduler
+from control_law import CRUISE_PID
+from controller import Controller, TelemetrySnapshot, load_gains
+from multiprocessing import shared_memory
+from smbus2 import SMBus
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Commands, sent as (device address, command, value)
+CMD_ACCELERATOR = "accelerator"
+CMD_CRUISE_ON = "cruise-on"
+CMD_CRUISE_SPEED = "cruise-speed"
+
+_COMMAND_QUEUE_SIZE = 64
+_METRICS_SIZE = 1 << 20  # bytes of rendered metrics text shared with the web server
+_METRICS_PERIOD = 1.00  # seconds between metrics updates from the controller process
+_READ_RETRIES = 100
+_QUICK_FAILURE = 10.00  # seconds, a process dying sooner than this counts as failing
+
+# Shared telemetry layout, little endian with no padding:
+#   u64 write counter, odd while a write is in progress
+#   seq, timestamp, cruise on, cruise speed, vehicle speed, accelerator, throttle, maf,
+#   number of DTCs, then _DTC_SLOTS (code, UTF-8 message) slots
+_COUNTER = struct.Struct("<Q")
+_SNAPSHOT = struct.Struct("<Qd?iddidB")
+_DTC = struct.Struct("<h30s")
+_DTC_SLOTS = 8
+_TELEMETRY_SIZE = _COUNTER.size + _SNAPSHOT.size + _DTC_SLOTS * _DTC.size
+_LENGTH = struct.Struct("<I")
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    # Only the creator may unlink the block. Before Python 3.13 attaching always registers
+    # the block with the resource tracker, which is harmless here: a spawned process shares
+    # its parent's tracker, and the parent's unlink drops the registration.
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name)
+
+
+class _SeqlockBlock:
+    """
+    Shared memory block with one writer process and any number of readers.
+
+    The writer bumps a counter to an odd value, writes the payload, then bumps it to even.
+    A reader copies the payload and keeps the copy only if the counter was even and did not
+    change meanwhile, so it never blocks the writer and never sees a half-written payload.
+    """
+
+    name: str
+
+    __shm: shared_memory.SharedMemory
+    __counter: int
+    __owner: bool
+
+    def __init__(self, size: int, name: Optional[str] = None):
+        """name: block to attach to, a new block is created when None"""
+        if name is None:
+            self.__shm = shared_memory.SharedMemory(create=True, size=size)
+            self.__owner = True
+        else:
+            self.__shm = _attach(name)
+            self.__owner = False
+        self.name = self.__shm.name
+        [counter] = _COUNTER.unpack_from(self.__shm.buf, 0)
+        # A writer that died mid-write leaves the counter odd, start from the next even
+        self.__counter = counter + (counter & 1)
+
+    def _write(self, fill: Callable[[memoryview], None]):
+        buf = self.__shm.buf
+        _COUNTER.pack_into(buf, 0, self.__counter + 1)
+        fill(buf[_COUNTER.size :])
+        self.__counter += 2
+        _COUNTER.pack_into(buf, 0, self.__counter)
+
+    def _read(self, size: int) -> Optional[bytes]:
+        buf = self.__shm.buf
+        end = _COUNTER.size + size
+        for _ in range(_READ_RETRIES):
+            [before] = _COUNTER.unpack_from(buf, 0)
+            if before == 0:
+                return None  # nothing written yet
+            if before & 1:
+                continue
+            data = bytes(buf[_COUNTER.size : end])
+            [after] = _COUNTER.unpack_from(buf, 0)
+            if before == after:
+                return data
+        return None
+
+    def close(self):
+        self.__shm.close()
+        if self.__owner:
+            self.__shm.unlink()
+
+
+class TelemetryBlock(_SeqlockBlock):
+    """Latest TelemetrySnapshot of one controller in a fixed binary layout"""
+
+    def __init__(self, name: Optional[str] = None):
+        super().__init__(_TELEMETRY_SIZE, name)
+
+    def write(self, snapshot: TelemetrySnapshot):
+        """Publishes `snapshot`, usable as a Controller snapshot listener"""
+
+        def fill(buf: memoryview):
+            dtc = snapshot.dtc[0:_DTC_SLOTS]
+            _SNAPSHOT.pack_into(
+                buf,
+                0,
+                snapshot.seq,
+                snapshot.timestamp,
+                snapshot.cruise_on,
+                snapshot.cruise_speed,
+                snapshot.vehicle_speed,
+                snapshot.accelerator,
+                snapshot.throttle,
+                snapshot.maf,
+                len(dtc),
+            )
+            for (idx, (num, mesg)) in enumerate(dtc):
+                offset = _SNAPSHOT.size + idx * _DTC.size
+                _DTC.pack_into(buf, offset, num, mesg.encode("utf-8")[0:30])
+
+        self._write(fill)
+
+    def read(self) -> Optional[TelemetrySnapshot]:
+        """Returns the latest snapshot, or None if there is none yet"""
+        data = self._read(_TELEMETRY_SIZE - _COUNTER.size)
+        if data is None:
+            return None
+        values = _SNAPSHOT.unpack_from(data, 0)
+        dtc = []
+        for idx in range(values[-1]):
+            (num, raw) = _DTC.unpack_from(data, _SNAPSHOT.size + idx * _DTC.size)
+            dtc.append((num, raw.rstrip(b"\0").decode("utf-8", errors="replace")))
+        return TelemetrySnapshot(*values[:-1], tuple(dtc))
+
+
+class TextBlock(_SeqlockBlock):
+    """Length-prefixed UTF-8 text, cut at a line boundary if it does not fit"""
+
+    __capacity: int
+
+    def __init__(self, size: int = _METRICS_SIZE, name: Optional[str] = None):
+        super().__init__(size, name)
+        self.__capacity = size - _COUNTER.size - _LENGTH.size
+
+    def write(self, text: str):
+        data = text.encode("utf-8")
+        if len(data) > self.__capacity:
+            data = data[0 : data.rfind(b"\n", 0, self.__capacity) + 1]
+
+        def fill(buf: memoryview):
+            _LENGTH.pack_into(buf, 0, len(data))
+            buf[_LENGTH.size : _LENGTH.size + len(data)] = data
+
+        self._write(fill)
+
+    def read(self) -> str:
+        for _ in range(_READ_RETRIES):
+            header = self._read(_LENGTH.size)
+            if header is None:
+                return ""
+            [length] = _LENGTH.unpack(header)
+            # Copy only the text in use, then make sure it was not replaced meanwhile
+            data = self._read(_LENGTH.size + length)
+            if data is not None and _LENGTH.unpack_from(data)[0] == length:
+                return data[_LENGTH.size :].decode("utf-8")
+        return ""
+
+
+class ControllerClient:
+    """
+    Stand-in for a Controller that lives in the controller process.
+
+    Snapshots come from the device's TelemetryBlock and setters are sent over the command
+    queue, so the dashboard can use it like a local Controller. poll() passes new snapshots
+    to the listeners, call it at least as often as the controller ticks.
+    """
+
+    address: int
+
+    __block: TelemetryBlock
+    __send: Callable[[int, str, object], bool]
+    __listeners: List[Callable[[TelemetrySnapshot], None]]
+    __last_key: Optional[Tuple[int, float]]
+    __inputs: Dict[str, object]
+
+    def __init__(
+        self,
+        address: int,
+        block: TelemetryBlock,
+        send: Callable[[int, str, object], bool],
+    ):
+        self.address = address
+        self.__block = block
+        self.__send = send
+        self.__listeners = []
+        self.__last_key = None
+        self.__inputs = {}
+
+    # Internal functions
+    def __command(self, command: str, value):
+        self.__inputs[command] = value
+        self.__send(self.address, command, value)
+
+    # Public Functions
+    def get_snapshot(self) -> Optional[TelemetrySnapshot]:
+        return self.__block.read()
+
+    def add_snapshot_listener(self, listener: Callable[[TelemetrySnapshot], None]):
+        self.__listeners.append(listener)
+
+    def poll(self):
+        snapshot = self.__block.read()
+        if snapshot is None:
+            return
+        # seq starts over when the controller process restarts, the timestamp does not
+        key = (snapshot.seq, snapshot.timestamp)
+        if key != self.__last_key:
+            self.__last_key = key
+            for listener in self.__listeners:
+                listener(snapshot)
+
+    def set_accelerator_position(self, pos: float):
+        self.__command(CMD_ACCELERATOR, pos)
+
+    def set_cruise_control_status(self, val: bool):
+        self.__command(CMD_CRUISE_ON, val)
+
+    def set_cruise_target_speed(self, speed: int):
+        self.__command(CMD_CRUISE_SPEED, speed)
+
+    def resend_inputs(self):
+        """Sends the last operator inputs again, for a freshly started controller"""
+        for command in (CMD_CRUISE_SPEED, CMD_ACCELERATOR, CMD_CRUISE_ON):
+            if command in self.__inputs:
+                self.__send(self.address, command, self.__inputs[command])
+
+
+def _apply_commands(controllers, commands, stop):
+    # `stop` is the read end of a pipe, it turns readable when the web server wants out
+    setters = {
+        CMD_ACCELERATOR: lambda controller: controller.set_accelerator_position,
+        CMD_CRUISE_ON: lambda controller: controller.set_cruise_control_status,
+        CMD_CRUISE_SPEED: lambda controller: controller.set_cruise_target_speed,
+    }
+    while not stop.poll():
+        try:
+            (address, command, value) = commands.get(timeout=0.25)
+        except queue.Empty:
+            continue
+        controller = controllers.get(address)
+        if controller is not None and command in setters:
+            setters[command](controller)(value)
+
+
+def _serve(
+    devices: List[Tuple[int, int]],
+    bus: Callable[[int], object],
+    bus_num: int,
+    telemetry_names: Dict[int, str],
+    metrics_name: str,
+    commands,
+    stop,
+    gains_file: Optional[str],
+    recording_file: Optional[str],
+    dtc_log: Optional[str],
+    cruise_mode: str,
+):
+    # Runs in the controller process. Ctrl-C reaches the whole process group, the web
+    # server decides when this process stops.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if gains_file is not None and os.path.isfile(gains_file):
+        load_gains(gains_file)
+    scheduler = BusScheduler(bus(bus_num))
+    scheduler.start()
+    blocks = []
+    controllers = {}
+    for (address, reset_pin) in devices:
+        device = i2c.Device(scheduler, address)
+        controller = Controller(
+            device=device, reset_pin=reset_pin, dtc_log=dtc_log, cruise_mode=cruise_mode
+        )
+        # A call still queued a whole tick later is stale, the next tick replaces it
+        device.deadline = 1.00 / controller.get_loop_stats()["frequency"]
+        block = TelemetryBlock(telemetry_names[address])
+        controller.add_snapshot_listener(block.write)
+        blocks.append(block)
+        controllers[address] = controller
+    metrics_block = TextBlock(name=metrics_name)
+
+    recorder = None
+    if recording_file:
+        if len(controllers) == 1:
+            [controller] = controllers.values()
+            recorder = BusRecorder(recording_file, controller.get_inputs)
+            i2c.set_recorder(recorder)
+        else:
+            print("Bus recording only supports a single device", file=sys.stderr)
+
+    threads = [threading.Thread(target=c.simulate) for c in controllers.values()]
+    threads.append(
+        threading.Thread(target=_apply_commands, args=(controllers, commands, stop))
+    )
+    for thread in threads:
+        thread.start()
+    try:
+        while not stop.poll(_METRICS_PERIOD):
+            metrics_block.write(metrics.render())
+    finally:
+        for controller in controllers.values():
+            controller.cleanup()
+        for thread in threads:
+            thread.join()
+        scheduler.stop()
+        if recorder is not None:
+            i2c.set_recorder(None)
+            recorder.close()
+        for block in blocks:
+            block.close()
+        metrics_block.close()
+
+
+class ControllerProcess:
+    """
+    Class running the controllers for every device in a separate process.
+
+    Socket.IO handling, JSON encoding and template rendering then no longer compete with
+    the control loops for the GIL. Telemetry comes back through one TelemetryBlock per
+    device and operator inputs go out through a bounded command queue. A command that
+    does not fit is dropped and counted instead of blocking the web server. The shared
+    blocks belong to this object, so the process can be restarted, by restart() or by
+    poll() when it has died, without the web server noticing more than a gap in telemetry.
+
+    poll() waits `backoff` seconds before restarting a dead process, doubled for each one
+    in a row that died within _QUICK_FAILURE seconds of starting, up to `max_backoff`.
+    After `max_failures` such quick failures it gives up until restart() is called, since
+    a process failing at startup (the bus will not open, RPi.GPIO is missing) would only
+    fail again.
+    """
+
+    clients: Dict[int, ControllerClient]
+    restarts: int
+    dropped_commands: int
+    consecutive_failures: int
+    gave_up: bool
+
+    backoff: float
+    max_backoff: float
+    max_failures: int
+
+    __context: multiprocessing.context.BaseContext
+    __devices: List[Tuple[int, int]]
+    __bus: Callable[[int], object]
+    __bus_num: int
+    __gains_file: Optional[str]
+    __recording_file: Optional[str]
+    __dtc_log: Optional[str]
+    __cruise_mode: str
+    __blocks: Dict[int, TelemetryBlock]
+    __metrics: TextBlock
+    __queue_size: int
+    __commands: object
+    __stop: Optional[Tuple[object, object]]  # (read, write) ends of the stop pipe
+    __process: Optional[multiprocessing.process.BaseProcess]
+    __clock: Callable[[], float]
+    __started: float
+    __restart_at: Optional[float]
+
+    def __init__(
+        self,
+        devices: List[Tuple[int, int]],
+        bus_num: int = 1,
+        gains_file: Optional[str] = None,
+        recording_file: Optional[str] = None,
+        queue_size: int = _COMMAND_QUEUE_SIZE,
+        bus: Callable[[int], object] = SMBus,
+        dtc_log: Optional[str] = None,
+        cruise_mode: str = CRUISE_PID,
+        backoff: float = 1.00,
+        max_backoff: float = 30.00,
+        max_failures: int = 5,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        devices: (address, reset pin) for each throttle body on the bus
+        bus: opens bus `bus_num` in the controller process, must be importable by name
+        gains_file: tune_pid.py output to load in the controller process, if it exists
+        recording_file: bus recording for replay.py, single device only
+        dtc_log: DTC event log shared by all devices, read it with diagnostics.read_log()
+        cruise_mode: control_law.CRUISE_PID or CRUISE_MPC for every device
+        backoff: wait before restarting a dead process, doubled for each quick failure
+        max_failures: quick failures in a row after which poll() stops restarting
+        """
+        # A fresh interpreter, forking a threaded web server is not safe
+        self.__context = multiprocessing.get_context("spawn")
+        self.__devices = list(devices)
+        self.__bus = bus
+        self.__bus_num = bus_num
+        self.__gains_file = gains_file
+        self.__recording_file = recording_file
+        self.__dtc_log = dtc_log
+        self.__cruise_mode = cruise_mode
+        self.__blocks = {address: TelemetryBlock() for (address, _) in devices}
+        self.__metrics = TextBlock()
+        self.__queue_size = queue_size
+        self.__commands = self.__context.Queue(queue_size)
+        self.__stop = None
+        self.__process = None
+        self.clients = {
+            address: ControllerClient(address, block, self.__send)
+            for (address, block) in self.__blocks.items()
+        }
+        self.restarts = 0
+        self.dropped_commands = 0
+        self.consecutive_failures = 0
+        self.gave_up = False
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_failures = max_failures
+        self.__clock = clock
+        self.__started = 0.00
+        self.__restart_at = None
+
+    # Internal functions
+    def __process_died(self, now: float):
+        if now - self.__started < _QUICK_FAILURE:
+            self.consecutive_failures += 1
+        else:
+            self.consecutive_failures = 1
+        if self.consecutive_failures >= self.max_failures:
+            self.gave_up = True
+            print(
+                f"Controller process failed {self.consecutive_failures} times in a row, "
+                "not restarting it",
+                file=sys.stderr,
+            )
+            return
+        wait = self.backoff * 2 ** (self.consecutive_failures - 1)
+        wait = min(wait, self.max_backoff)
+        print(f"Controller process exited, restarting in {wait:.1f} s", file=sys.stderr)
+        self.__restart_at = now + wait
+
+    def __send(self, address: int, command: str, value) -> bool:
+        try:
+            self.__commands.put_nowait((address, command, value))
+        except queue.Full:
+            self.dropped_commands += 1
+            print(f"Controller command queue full, dropped {command}", file=sys.stderr)
+            return False
+        return True
+
+    # Public Functions
+    def start(self):
+        # A killed process can leave a queue lock or an Event's condition held, so every
+        # process gets a new queue and a plain pipe to be told to stop
+        self.__commands = self.__context.Queue(self.__queue_size)
+        self.__stop = self.__context.Pipe(duplex=False)
+        self.__process = self.__context.Process(
+            target=_serve,
+            args=(
+                self.__devices,
+                self.__bus,
+                self.__bus_num,
+                {address: block.name for (address, block) in self.__blocks.items()},
+                self.__metrics.name,
+                self.__commands,
+                self.__stop[0],
+                self.__gains_file,
+                self.__recording_file,
+                self.__dtc_log,
+                self.__cruise_mode,
+            ),
+            name="controller",
+            daemon=True,
+        )
+        self.__process.start()
+        self.__started = self.__clock()
+        for client in self.clients.values():
+            client.resend_inputs()
+
+    def stop(self, timeout: float = 5.00):
+        """Stops the controller process, killing it if it does not stop in `timeout`"""
+        if self.__stop is not None:
+            self.__stop[1].send(None)
+        if self.__process is not None:
+            self.__process.join(timeout)
+            if self.__process.is_alive():
+                self.__process.kill()
+                self.__process.join()
+            self.__process = None
+        if self.__stop is not None:
+            for conn in self.__stop:
+                conn.close()
+            self.__stop = None
+
+    def restart(self):
+        """Restarts the process now, also after poll() gave up on it"""
+        self.stop()
+        self.restarts += 1
+        self.gave_up = False
+        self.__restart_at = None
+        self.start()
+
+    def alive(self) -> bool:
+        return self.__process is not None and self.__process.is_alive()
+
+    def poll(self):
+        """
+        Restarts a dead controller process once its backoff is over and hands new snapshots
+        to the listeners
+        """
+        if not self.gave_up and self.__process is not None:
+            now = self.__clock()
+            if self.__restart_at is None:
+                if not self.__process.is_alive():
+                    self.__process_died(now)
+            elif now >= self.__restart_at:
+                self.stop()
+                self.restarts += 1
+                self.__restart_at = None
+                self.start()
+        for client in self.clients.values():
+            client.poll()
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "alive": self.alive(),
+            "restarts": self.restarts,
+            "consecutive_failures": self.consecutive_failures,
+            "gave_up": self.gave_up,
+            "dropped_commands": self.dropped_commands,
+        }
+
+    def metrics_text(self) -> str:
+        """The controller process's metrics in the Prometheus text format"""
+        return self.__metrics.read()
+
+    def close(self):
+        """Stops the process and frees the shared memory"""
+        self.stop()
+        for block in self.__blocks.values():
+            block.close()
+        self.__metrics.close()
@@ -0,0 +1,366 @@
+"""Module for tracking diagnostic trouble codes with freeze frames and an on-disk fault log"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import math, os, struct, time
+import metrics
+from array import array
+from history import _Ring
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Codes
+DTC_INTERMITTENT_COMMS = 1
+DTC_SPEED_RANGE = 2
+DTC_NOT_RESPONDING = 3
+
+MESSAGES: Dict[int, str] = {
+    DTC_INTERMITTENT_COMMS: "Intermittent I2C comms",
+    DTC_SPEED_RANGE: "Speed value out of range",
+    DTC_NOT_RESPONDING: "Throttle body not responding",
+}
+
+# Per tick values kept for freeze frames, "time" is relative to the tick the code set on
+FRAME_FIELDS: Tuple[str, ...] = (
+    "time",
+    "throttle",
+    "vehicle_speed",
+    "accelerator",
+    "maf",
+    "bus_errors",
+)
+
+# Log format
+MAGIC = b"TBDTCLOG"
+VERSION = 1
+_HEADER = struct.Struct("<8sHHH")  # magic, version, frame ticks, frame fields
+# wall time, tick, device address, code, active; a set event is followed by its frame
+_EVENT = struct.Struct("<dIBH?")
+
+_DTC_SET = metrics.Counter(
+    "controller_dtc_set_total", "DTCs becoming active", ("code",)
+)
+_DTC_CLEARED = metrics.Counter(
+    "controller_dtc_cleared_total", "DTCs being cleared", ("code",)
+)
+
+
+class DTC:
+    """
+    Class representing a diagnostic trouble code.
+
+    Contains an integer identifier and a string description
+    """
+
+    number: int
+    message: str
+
+    def __init__(self, num: int, mesg: str):
+        self.number = num
+        self.message = mesg
+
+
+class FreezeFrame(NamedTuple):
+    """The ticks leading up to a code setting, oldest first, NaN where none were run yet"""
+
+    code: int
+    time: float
+    samples: Dict[str, List[float]]
+
+
+class DtcEvent(NamedTuple):
+    """
+    A code setting or clearing. `time` is on the wall clock for events read from a log and
+    on the controller's clock for events passed to DtcStore listeners.
+    """
+
+    time: float
+    tick: int
+    device: int
+    code: int
+    active: bool
+    frame: Optional[FreezeFrame]  # set events only
+
+
+def _frame_struct(frame_ticks: int) -> struct.Struct:
+    return struct.Struct(f"<{frame_ticks * len(FRAME_FIELDS)}f")
+
+
+def read_log(
+    path: str,
+    code: Optional[int] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    device: Optional[int] = None,
+) -> List[DtcEvent]:
+    """
+    Returns the events in the log at `path` for `code` and `device` (any by default) with
+    wall clock times between `start` and `end` inclusive
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) < _HEADER.size:
+        return []
+    events: List[DtcEvent] = []
+    with open(path, "rb") as f:
+        data = f.read()
+    (magic, version, frame_ticks, fields) = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or fields != len(FRAME_FIELDS):
+        raise ValueError(f"{path} is not a version {VERSION} DTC log")
+    frame = _frame_struct(frame_ticks)
+    offset = _HEADER.size
+    # A partially written last event (e.g. after a crash) is ignored
+    while offset + _EVENT.size <= len(data):
+        (t, tick, address, num, active) = _EVENT.unpack_from(data, offset)
+        offset += _EVENT.size
+        frame_offset = offset
+        if active:
+            offset += frame.size
+            if offset > len(data):
+                break
+        if (
+            (code is not None and num != code)
+            or (device is not None and address != device)
+            or (start is not None and t < start)
+            or (end is not None and t > end)
+        ):
+            continue
+        freeze = None
+        if active:
+            values = frame.unpack_from(data, frame_offset)
+            freeze = FreezeFrame(
+                num,
+                t,
+                {
+                    name: list(values[idx :: len(FRAME_FIELDS)])
+                    for (idx, name) in enumerate(FRAME_FIELDS)
+                },
+            )
+        events.append(DtcEvent(t, tick, address, num, active, freeze))
+    return events
+
+
+class DtcLog:
+    """
+    Class appending DTC events to a file, one fixed-size record per event plus the freeze
+    frame for codes setting.
+
+    Events are timestamped with `clock`, the wall clock by default, so a log kept across
+    restarts stays in order. Several controllers may append to the same file, each event
+    carries the device address.
+    """
+
+    path: str
+    frame_ticks: int
+
+    __file: object
+    __frame: struct.Struct
+    __clock: Callable[[], float]
+
+    def __init__(
+        self, path: str, frame_ticks: int, clock: Callable[[], float] = time.time
+    ):
+        self.path = path
+        self.frame_ticks = frame_ticks
+        self.__frame = _frame_struct(frame_ticks)
+        self.__clock = clock
+        try:
+            # Only the log that creates the file writes the header, and it goes out at
+            # once, so another log opening the same new file never writes a second one
+            with open(path, "xb", buffering=0) as f:
+                f.write(_HEADER.pack(MAGIC, VERSION, frame_ticks, len(FRAME_FIELDS)))
+        except FileExistsError:
+            if os.path.getsize(path) < _HEADER.size:
+                raise ValueError(f"{path} is not a version {VERSION} DTC log")
+            with open(path, "rb") as f:
+                (magic, version, ticks, fields) = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC or version != VERSION or fields != len(FRAME_FIELDS):
+                raise ValueError(f"{path} is not a version {VERSION} DTC log")
+            if ticks != frame_ticks:
+                raise ValueError(f"{path} holds {ticks} tick freeze frames")
+        self.__file = open(path, "ab")
+
+    def append(self, tick: int, device: int, code: int, frame: Optional[List[float]]):
+        """Writes one event, `frame` being the flattened freeze frame of a set event"""
+        record = _EVENT.pack(self.__clock(), tick, device, code, frame is not None)
+        if frame is not None:
+            record += self.__frame.pack(*frame)
+        # One write per event, so appends from other controllers never interleave
+        self.__file.write(record)
+        self.__file.flush()
+
+    def query(
+        self,
+        code: Optional[int] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        device: Optional[int] = None,
+    ) -> List[DtcEvent]:
+        """Same as read_log() for this log"""
+        return read_log(self.path, code, start, end, device)
+
+    def close(self):
+        self.__file.close()
+
+
+class DtcStore:
+    """
+    Class holding the active DTCs and recording their transitions.
+
+    update() is called with each code's condition every tick and only does work when the
+    code changes state. sample() records the tick's values into a preallocated ring of the
+    last `frame_ticks` ticks and then handles the transitions from that tick: a code that
+    set gets a freeze frame from the ring, kept in memory for the newest `frame_capacity`
+    codes, and each transition is counted, written to `log` and passed to the listeners.
+    """
+
+    device: int
+    frame_ticks: int
+
+    __clock: Callable[[], float]
+    __log: Optional[DtcLog]
+    __active: Dict[int, DTC]
+    __codes: Tuple[Tuple[int, str], ...]
+    __ring: _Ring
+    __frames: List[Optional[FreezeFrame]]
+    __frames_written: int
+    __pending: List[Tuple[int, bool]]
+    __tick: int
+    __listeners: List[Callable[[DtcEvent], None]]
+
+    def __init__(
+        self,
+        device: int = 0,
+        frame_ticks: int = 16,
+        frame_capacity: int = 32,
+        clock: Callable[[], float] = time.monotonic,
+        log: Optional[DtcLog] = None,
+    ):
+        """
+        device: address written to the log with each event
+        clock: clock the freeze frame times are taken from
+        log: fault log, its freeze frames must be `frame_ticks` long
+        """
+        if log is not None and log.frame_ticks != frame_ticks:
+            raise ValueError(f"Log freeze frames are {log.frame_ticks} ticks")
+        self.device = device
+        self.frame_ticks = frame_ticks
+        self.__clock = clock
+        self.__log = log
+        self.__active = {}
+        self.__codes = ()
+        self.__ring = _Ring(frame_ticks, FRAME_FIELDS)
+        # Ticks before the first sample read as NaN in early freeze frames
+        for col in self.__ring.columns.values():
+            col[:] = array("d", [math.nan]) * frame_ticks
+        self.__frames = [None] * frame_capacity
+        self.__frames_written = 0
+        self.__pending = []
+        self.__tick = 0
+        self.__listeners = []
+
+    # Internal functions
+    def __capture(self, code: int, now: float) -> FreezeFrame:
+        ring = self.__ring
+        start = ring.written - self.frame_ticks
+        samples = {
+            name: list(ring.slice(name, start, ring.written)) for name in FRAME_FIELDS
+        }
+        samples["time"] = [t - now for t in samples["time"]]
+        frame = FreezeFrame(code, now, samples)
+        self.__frames[self.__frames_written % len(self.__frames)] = frame
+        self.__frames_written += 1
+        return frame
+
+    def __transition(self, code: int, active: bool, now: float):
+        frame = None
+        if active:
+            _DTC_SET.labels(code).inc()
+            frame = self.__capture(code, now)
+        else:
+            _DTC_CLEARED.labels(code).inc()
+        if self.__log is not None:
+            flat = None
+            if frame is not None:
+                flat = [
+                    value
+                    for row in zip(*(frame.samples[name] for name in FRAME_FIELDS))
+                    for value in row
+                ]
+            self.__log.append(self.__tick, self.device, code, flat)
+        if self.__listeners:
+            event = DtcEvent(now, self.__tick, self.device, code, active, frame)
+            for listener in self.__listeners:
+                listener(event)
+
+    # Public Functions
+    def update(self, code: int, active: bool):
+        """Sets or clears `code`, nothing happens unless that changes its state"""
+        if active == (code in self.__active):
+            return
+        if active:
+            self.__active[code] = DTC(code, MESSAGES.get(code, f"DTC {code}"))
+        else:
+            del self.__active[code]
+        self.__codes = tuple(
+            (dtc.number, dtc.message) for dtc in self.__active.values()
+        )
+        self.__pending.append((code, active))
+
+    def sample(
+        self,
+        tick: int,
+        throttle: float,
+        vehicle_speed: float,
+        accelerator: float,
+        maf: float,
+        bus_errors: int,
+    ):
+        """Records one tick, call it once per tick after the tick's update() calls"""
+        now = self.__clock()
+        ring = self.__ring
+        idx = ring.written % ring.capacity
+        cols = ring.columns
+        cols["time"][idx] = now
+        cols["throttle"][idx] = throttle
+        cols["vehicle_speed"][idx] = vehicle_speed
+        cols["accelerator"][idx] = accelerator
+        cols["maf"][idx] = maf
+        cols["bus_errors"][idx] = bus_errors
+        ring.written += 1
+        self.__tick = tick
+
+        if self.__pending:
+            pending = self.__pending
+            self.__pending = []
+            for (code, active) in pending:
+                self.__transition(code, active, now)
+
+    def codes(self) -> Tuple[Tuple[int, str], ...]:
+        """Returns the active (code, message) pairs, the same tuple until one changes"""
+        return self.__codes
+
+    def active(self) -> Dict[int, DTC]:
+        return dict(self.__active)
+
+    def freeze_frames(self, code: Optional[int] = None) -> List[FreezeFrame]:
+        """Returns the freeze frames still held in memory, oldest first"""
+        written = self.__frames_written
+        capacity = len(self.__frames)
+        frames = [
+            self.__frames[idx % capacity]
+            for idx in range(max(written - capacity, 0), written)
+        ]
+        return [f for f in frames if code is None or f.code == code]
+
+    def add_listener(self, listener: Callable[[DtcEvent], None]):
+        """
+        Registers `listener` to be called with each set and clear event. Listeners run on
+        the control thread, so they should only hand the event off.
+        """
+        self.__listeners.append(listener)
+
+    def close(self):
+        (log, self.__log) = (self.__log, None)
+        if log is not None:
+            log.close()
@@ -0,0 +1,94 @@
+"""Module with stand-ins for the clock and GPIO so the controller can run off the Pi"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class VirtualClock:
+    """
+    Clock that only moves when something sleeps on it.
+
+    Pass `now` and `sleep` wherever a clock and sleep function are taken (Controller,
+    TickScheduler, ArduinoEmulator, ...). Sleeping returns at once with the clock moved
+    forward, so a loop paced against it runs as fast as the CPU allows while every tick
+    still lands exactly on its deadline.
+    """
+
+    __time: float
+
+    def __init__(self, start: float = 0.00):
+        self.__time = start
+
+    def now(self) -> float:
+        return self.__time
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            self.__time += seconds
+
+    def advance_to(self, t: float):
+        self.__time = max(self.__time, t)
+
+
+class HeadlessGPIO:
+    """
+    Stand-in for the RPi.GPIO module that records pin levels instead of driving pins.
+
+    `on_output(pin, level)` is called for every output() call, which is how a simulated
+    board sees its reset line.
+    """
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    mode: Optional[int]
+    pins: Dict[int, int]  # pin -> direction
+    levels: Dict[int, int]  # output pin -> level
+    history: List[Tuple[float, int, int]]  # (time, pin, level) of each output() call
+
+    __clock: Callable[[], float]
+    __on_output: Optional[Callable[[int, int], None]]
+
+    def __init__(
+        self,
+        clock: Callable[[], float] = lambda: 0.00,
+        on_output: Optional[Callable[[int, int], None]] = None,
+    ):
+        self.mode = None
+        self.pins = {}
+        self.levels = {}
+        self.history = []
+        self.__clock = clock
+        self.__on_output = on_output
+
+    def setmode(self, mode: int):
+        self.mode = mode
+
+    def setup(self, pin: int, direction: int):
+        self.pins[pin] = direction
+        if direction == self.OUT:
+            self.levels.setdefault(pin, self.LOW)
+
+    def output(self, pin: int, level: int):
+        if self.pins.get(pin) != self.OUT:
+            raise RuntimeError(f"Pin {pin} is not set up as an output")
+        level = self.HIGH if level else self.LOW
+        self.levels[pin] = level
+        self.history.append((self.__clock(), pin, level))
+        if self.__on_output is not None:
+            self.__on_output(pin, level)
+
+    def input(self, pin: int) -> int:
+        return self.levels.get(pin, self.LOW)
+
+    def cleanup(self):
+        self.pins.clear()
+        self.levels.clear()
@@ -0,0 +1,185 @@
+"""Module for recording controller telemetry into fixed-memory ring buffers"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+# Globals
+FIELDS: Tuple[str, ...] = ("vehicle_speed", "throttle", "accelerator", "maf")
+_READ_SLACK = 64  # samples a reader stays clear of the write position
+
+
+def _dtc_mask(dtc: Tuple[Tuple[int, str], ...]) -> int:
+    mask = 0
+    for (num, _) in dtc:
+        mask |= 1 << num
+    return mask
+
+
+def _dtc_codes(mask: int) -> List[int]:
+    return [num for num in range(mask.bit_length()) if mask >> num & 1]
+
+
+def _empty_result(fields: List[str]) -> Dict:
+    return {
+        "t": [],
+        "fields": {name: {"min": [], "max": [], "mean": []} for name in fields},
+    }
+
+
+class _Ring:
+    """Preallocated float columns sharing one write position"""
+
+    capacity: int
+    written: int
+    columns: Dict[str, array]
+
+    def __init__(self, capacity: int, names: Tuple[str, ...], typecode: str = "d"):
+        self.capacity = capacity
+        self.written = 0
+        self.columns = {name: array(typecode, bytes(8 * capacity)) for name in names}
+
+    def slice(self, name: str, start: int, stop: int) -> array:
+        """Returns samples `start` to `stop` (absolute sample numbers) of column `name`"""
+        col = self.columns[name]
+        lo = start % self.capacity
+        hi = lo + (stop - start)
+        if hi <= self.capacity:
+            return col[lo:hi]
+        return col[lo:] + col[0 : hi - self.capacity]
+
+
+class HistoryRecorder:
+    """
+    Class recording one sample per controller tick into a ring buffer of array columns.
+
+    Memory is fixed at construction and no Python object is kept per sample. DTC changes are
+    kept in a second, smaller ring as (time, bit mask) pairs. record() is meant to be
+    registered with Controller.add_snapshot_listener(); queries can run on any other thread
+    without locking, they retry if the writer laps them.
+    """
+
+    __samples: _Ring
+    __dtc_events: _Ring
+    __last_dtc_mask: int
+
+    def __init__(self, capacity: int, dtc_capacity: int = 1024):
+        if capacity <= _READ_SLACK:
+            raise ValueError(f"Capacity must be more than {_READ_SLACK} samples")
+        self.__samples = _Ring(capacity, ("time",) + FIELDS)
+        self.__dtc_events = _Ring(dtc_capacity, ("time", "mask"))
+        self.__last_dtc_mask = 0
+
+    # Internal functions
+    def __bucket(self, start: int, stop: int, points: int, fields: List[str]) -> Dict:
+        samples = self.__samples
+        count = stop - start
+        size = max(-(-count // points), 1)  # ceil division
+        times = samples.slice("time", start, stop)
+        result = _empty_result(fields)
+
+        for name in fields:
+            col = samples.slice(name, start, stop)
+            out = result["fields"][name]
+            for lo in range(0, count, size):
+                seg = col[lo : lo + size]
+                out["min"].append(min(seg))
+                out["max"].append(max(seg))
+                out["mean"].append(sum(seg) / len(seg))
+        for lo in range(0, count, size):
+            seg = times[lo : lo + size]
+            result["t"].append((seg[0] + seg[-1]) / 2.00)
+        return result
+
+    def __search(self, t: float, lo: int, hi: int, inclusive: bool) -> int:
+        # First sample number in [lo, hi) after `t`, or at `t` when not inclusive
+        times = self.__samples.columns["time"]
+        capacity = self.__samples.capacity
+        while lo < hi:
+            mid = (lo + hi) // 2
+            sample_time = times[mid % capacity]
+            if sample_time < t or (inclusive and sample_time == t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Public Functions
+    def record(self, snapshot):
+        """Appends one TelemetrySnapshot"""
+        samples = self.__samples
+        idx = samples.written % samples.capacity
+        cols = samples.columns
+        cols["time"][idx] = snapshot.timestamp
+        cols["vehicle_speed"][idx] = snapshot.vehicle_speed
+        cols["throttle"][idx] = snapshot.throttle
+        cols["accelerator"][idx] = snapshot.accelerator
+        cols["maf"][idx] = snapshot.maf
+        # Publish only after the row is complete
+        samples.written += 1
+
+        mask = _dtc_mask(snapshot.dtc)
+        if mask != self.__last_dtc_mask:
+            events = self.__dtc_events
+            idx = events.written % events.capacity
+            events.columns["time"][idx] = snapshot.timestamp
+            events.columns["mask"][idx] = mask
+            events.written += 1
+            self.__last_dtc_mask = mask
+
+    def query(
+        self,
+        window: float,
+        points: int = 500,
+        end: float = 0.00,
+        fields: Optional[List[str]] = None,
+    ) -> Dict:
+        """
+        Returns the samples from `window` seconds before `end` (seconds before the newest
+        sample) downsampled into at most `points` buckets holding the min, max and mean of
+        each field. Times are relative to the newest sample. DTC changes in the window are
+        listed separately.
+        """
+        fields = list(FIELDS) if fields is None else [f for f in fields if f in FIELDS]
+        points = max(points, 1)
+
+        while True:
+            samples = self.__samples
+            written = samples.written
+            if written == 0:
+                result = _empty_result(fields)
+                result["dtc"] = []
+                return result
+            oldest = written - min(written, samples.capacity - _READ_SLACK)
+            newest_time = samples.columns["time"][(written - 1) % samples.capacity]
+            t_hi = newest_time - end
+            t_lo = t_hi - window
+
+            start = self.__search(t_lo, oldest, written, False)
+            stop = self.__search(t_hi, start, written, True)
+            if stop > start:
+                result = self.__bucket(start, stop, points, fields)
+            else:
+                result = _empty_result(fields)
+
+            events = self.__dtc_events
+            ev_written = events.written
+            ev_oldest = ev_written - min(ev_written, events.capacity - 1)
+            ev_times = events.slice("time", ev_oldest, ev_written)
+            ev_masks = events.slice("mask", ev_oldest, ev_written)
+
+            # Retry if the writer overwrote part of what was read
+            if samples.written - written < _READ_SLACK:
+                break
+
+        result["t"] = [t - newest_time for t in result["t"]]
+        result["dtc"] = [
+            {"t": t - newest_time, "codes": _dtc_codes(int(mask))}
+            for (t, mask) in zip(ev_times, ev_masks)
+            if t_lo <= t <= t_hi
+        ]
+        return result
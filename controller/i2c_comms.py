@@ -5,19 +5,35 @@ __copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
 __license__ = "MIT"
 __version__ = "0.1"
 
+from bus_scheduler import PRIORITY_CONTROL, PRIORITY_TELEMETRY, BusScheduler
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum, unique
-from typing import Any, Dict, List, Tuple
-from simple_i2c import read_bytes, write_bytes
-import struct, sys
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from simple_i2c import (
+    read_bytes,
+    session,
+    write_bytes,
+    write_read_bytes,
+    write_read_many,
+)
+import asyncio, metrics, struct, threading, time
 
 # Globals
 ADDR = 0x08  # bus address
+FRAME_SIZE = 29  # sizeof(i2c_buffer) on the AVR
+USE_REPEATED_START = True  # send each call and read its reply in one transaction
+RECORDER = None  # optional bus_recording.BusRecorder, see set_recorder()
+# Runs call_function_async() transactions one at a time, off the event loop
+BUS_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="i2c")
 
 
 @unique
 class Function(IntEnum):
     FUNC_GET_SERVO = 1
     FUNC_SET_SERVO = 2
+    FUNC_GET_TELEMETRY = 3
+    FUNC_SET_SERVO_READBACK = 4  # sets the servo, then returns a telemetry frame
+    FUNC_GET_SENSOR_BURST = 5  # returns the newest sensor samples
 
 
 @unique
@@ -26,102 +42,344 @@ class ErrorCode(IntEnum):
     ERROR_GENERIC = -1
 
 
+# Bits of Telemetry.error_flags, mirrored from error_flag in i2c_buffer.hpp
+ERROR_FLAG_BAD_FRAME_SIZE = 0x01
+ERROR_FLAG_UNKNOWN_COMMAND = 0x02
+ERROR_FLAG_POSITION_OUT_OF_RANGE = 0x04
+ERROR_FLAG_RESET_CAUSE_SHIFT = 8  # bits 8 - 15 hold the reset cause, see MCUSR
+
+
+class Telemetry(NamedTuple):
+    """Firmware state returned by FUNC_GET_TELEMETRY and FUNC_SET_SERVO_READBACK"""
+
+    position: int  # degrees, as FUNC_GET_SERVO returns it
+    servo_angle: int  # raw angle written to the servo
+    sensor_0: int  # raw ADC readings
+    sensor_1: int
+    loop_count: int  # firmware loop() iterations since boot
+    error_flags: int  # ERROR_FLAG_* bits raised since the last telemetry frame
+    uptime_ms: int
+
+
+SENSOR_BURST_SIZE = 6  # sensor_burst::SAMPLES in i2c_buffer.hpp
+
+
+class SensorBurst(NamedTuple):
+    """Sensor samples returned by FUNC_GET_SENSOR_BURST"""
+
+    count: int  # samples the firmware has taken since boot
+    samples: Tuple[Tuple[int, int], ...]  # raw (sensor_0, sensor_1), oldest first
+
+
+# Precompiled codecs for each member of the params_t union, all FRAME_SIZE bytes long
+_CODECS: Dict[str, struct.Struct] = {
+    "void": struct.Struct("<b28x"),
+    "int": struct.Struct("<b7i"),
+    "uint": struct.Struct("<b7I"),
+    "float": struct.Struct("<b7f"),
+    "string": struct.Struct("<b28s"),
+}
+_CMD_CODEC = struct.Struct("<b")
+# Codecs for the first union member, which is where every function returns its result
+_RESULT_CODECS: Dict[str, struct.Struct] = {
+    "int": struct.Struct("<i"),
+    "uint": struct.Struct("<I"),
+    "float": struct.Struct("<f"),
+    "telemetry": struct.Struct("<4i3I"),
+    "burst": struct.Struct(f"<I{2 * SENSOR_BURST_SIZE}H"),
+}
+_INT_CODEC = _CODECS["int"]
+_STRING_CODEC = _CODECS["string"]
+_NO_ARGS = (0, 0, 0, 0, 0, 0, 0)
+
+# Reusable frames for outgoing calls, one per thread. Requests are packed before the bus
+# lock is taken, so threads sharing a bus must not share a frame.
+_TX_FRAMES = threading.local()
+
+_CALL_SECONDS = metrics.Histogram(
+    "i2c_call_seconds", "Time for one call_function, packing to decoding", ("function",)
+)
+_CODEC_SECONDS = metrics.Histogram(
+    "i2c_codec_seconds", "Time spent packing requests and decoding replies", ("step",)
+)
+_BUS_ERRORS = metrics.Counter(
+    "i2c_errors_total", "Transactions that raised OSError", ("function",)
+)
+_ERROR_REPLIES = metrics.Counter(
+    "i2c_error_replies_total", "Replies carrying an error code", ("code",)
+)
+_CALL_TIME = {function: _CALL_SECONDS.labels(function.name) for function in Function}
+_PACK_TIME = _CODEC_SECONDS.labels("pack")
+_DECODE_TIME = _CODEC_SECONDS.labels("decode")
+
+
 class Buffer:
+    """
+    Python side of the firmware's i2c_buffer.
+
+    `params` holds the seven 32-bit union members as ints or floats depending on
+    `union_type`, `string` holds the union when it is read as a string.
+    """
+
+    __slots__ = ("cmd", "params", "string", "union_type")
+
     cmd: int
-    params: Dict[str, List]
+    params: List
+    string: str
     union_type: str
 
-    def __init__(self, cmd):
+    def __init__(self, cmd, union_type: str = "int"):
         self.cmd = cmd
-        self.params = {
-            "ints": [0, 0, 0, 0, 0, 0, 0],
-            "floats": [0.00, 0.00, 0.00, 0.00, 0.00, 0.00, 0.00],
-            "string": "",
-        }
-        self.union_type = "int"
+        self.params = [0, 0, 0, 0, 0, 0, 0]
+        self.string = ""
+        self.union_type = union_type
 
     def pack(self) -> bytes:
+        if self.union_type not in _CODECS:
+            return bytes()
+        frame = bytearray(FRAME_SIZE)
+        self.pack_into(frame)
+        return bytes(frame)
+
+    def pack_into(self, frame: bytearray, offset: int = 0):
+        codec = _CODECS.get(self.union_type)
+        if codec is None:
+            raise ValueError(f"Unknown union type: {self.union_type}")
         if self.union_type == "void":
-            data = struct.pack("<b", self.cmd)
-            while len(data) < 28:
-                data += bytes([0])
-            return data
-        elif self.union_type == "int":
-            return struct.pack("<biiiiiii", self.cmd, *self.params["ints"][0:7])
-        elif self.union_type == "uint":
-            return struct.pack("<bIIIIIII", self.cmd, *self.params["ints"][0:7])
-        elif self.union_type == "float":
-            return struct.pack("<bfffffff", self.cmd, *self.params["floats"][0:7])
+            codec.pack_into(frame, offset, self.cmd)
         elif self.union_type == "string":
-            data = struct.pack(
-                "<bs", self.cmd, self.params["string"].encode("utf-8")[0:27]
-            )
-            while len(data) < 28:
-                data += bytes([0])
-            return data
+            codec.pack_into(frame, offset, self.cmd, self.string.encode("utf-8")[0:27])
         else:
-            return bytes()
+            codec.pack_into(frame, offset, self.cmd, *self.params)
 
     @classmethod
     def unpack(cls, data: bytes, u_type: str):
-        if u_type == "void":
-            [cmd] = struct.unpack("<b", data[0:1])
-            inst = cls(cmd)
-            inst.union_type = "void"
-            return inst
-        elif u_type == "int":
-            [cmd, i1, i2, i3, i4, i5, i6, i7] = struct.unpack("<biiiiiii", data)
-            inst = cls(cmd)
-            inst.params["ints"] = [i1, i2, i3, i4, i5, i6, i7]
-            inst.union_type = "int"
-            return inst
-        elif u_type == "uint":
-            [cmd, i1, i2, i3, i4, i5, i6, i7] = struct.unpack("<bIIIIIII", data)
-            inst = cls(cmd)
-            inst.params["ints"] = [i1, i2, i3, i4, i5, i6, i7]
-            inst.union_type = "uint"
-            return inst
-        elif u_type == "float":
-            [cmd, i1, i2, i3, i4, i5, i6, i7] = struct.unpack("<bfffffff", data)
-            inst = cls(cmd)
-            inst.params["floats"] = [i1, i2, i3, i4, i5, i6, i7]
-            inst.union_type = "float"
-            return inst
-        elif u_type == "string":
-            [cmd] = struct.unpack("<b", data[0:1])
-            s = data[1:28].decode("utf-8")
-            inst = cls(cmd)
-            inst.params["string"] = s
-            inst.union_type = "string"
-            return inst
+        codec = _CODECS.get(u_type)
+        if codec is None:
+            return None
+        values = codec.unpack_from(data)
+        inst = cls(values[0], u_type)
+        if u_type == "string":
+            inst.string = _decode_string(values[1])
+        elif u_type != "void":
+            inst.params[:] = values[1:]
+        return inst
 
 
-def call_function(function: Function, *args) -> Tuple[bool, Any]:
-    global ADDR
+def _decode_string(raw: bytes) -> str:
+    # Firmware strings are NUL terminated inside the 28 byte union
+    return raw.split(b"\0", 1)[0].decode("utf-8", errors="replace")
+
+
+def _return_type(function: Function) -> str:
+    if function == Function.FUNC_SET_SERVO:
+        return "void"
+    if function in (Function.FUNC_GET_TELEMETRY, Function.FUNC_SET_SERVO_READBACK):
+        return "telemetry"
+    if function == Function.FUNC_GET_SENSOR_BURST:
+        return "burst"
+    return "int"
+
+
+def _priority(function: Function) -> int:
+    if function in (Function.FUNC_SET_SERVO, Function.FUNC_SET_SERVO_READBACK):
+        return PRIORITY_CONTROL
+    return PRIORITY_TELEMETRY
+
+
+def _tx_frame(frames: threading.local) -> bytearray:
+    try:
+        return frames.frame
+    except AttributeError:
+        frames.frame = bytearray(FRAME_SIZE)
+        return frames.frame
+
+
+def _pack_call(frame: bytearray, function: Function, args: Tuple) -> str:
+    # Returns the return type of `function` after packing the call into `frame`
+    start = time.perf_counter()
+    _INT_CODEC.pack_into(frame, 0, function, *args, *_NO_ARGS[len(args) :])
+    _PACK_TIME.observe(time.perf_counter() - start)
+    return _return_type(function)
+
 
-    mesg_buf = Buffer(function)
-    return_type: str = "int"
+def _call_failed(function: Function, frame: bytes):
+    global RECORDER
 
-    if function == Function.FUNC_GET_SERVO:
-        pass
-    elif function == Function.FUNC_SET_SERVO:
-        mesg_buf.params["ints"][0] = args[0]
-        mesg_buf.union_type = "int"
-        return_type = "void"
+    _BUS_ERRORS.labels(Function(function).name).inc()
+    if RECORDER is not None:
+        RECORDER.record(frame, None)
 
-    write_bytes(ADDR, mesg_buf.pack())
 
-    response = read_bytes(ADDR, 29)
-    mesg_buf = Buffer.unpack(response, return_type)
+def _call_done(
+    function: Function, frame: bytes, response: bytes, return_type: str, start: float
+) -> Tuple[bool, Any]:
+    global RECORDER
 
-    if mesg_buf.cmd != ErrorCode.ERROR_NONE:
-        mesg_buf = Buffer.unpack(response, "string")
-        print(f"Error {mesg_buf.cmd}: {mesg_buf.params['string']}")
-        return (False, mesg_buf.cmd)
+    if RECORDER is not None:
+        RECORDER.record(frame, response)
+    received = time.perf_counter()
+    result = _decode_response(response, return_type)
+    end = time.perf_counter()
+    _DECODE_TIME.observe(end - received)
+    _CALL_TIME[function].observe(end - start)
+    return result
+
+
+def _decode_response(response: bytes, return_type: str) -> Tuple[bool, Any]:
+    [cmd] = _CMD_CODEC.unpack_from(response)
+
+    if cmd != ErrorCode.ERROR_NONE:
+        _ERROR_REPLIES.labels(cmd).inc()
+        [_, raw] = _STRING_CODEC.unpack_from(response)
+        print(f"Error {cmd}: {_decode_string(raw)}")
+        return (False, cmd)
 
     if return_type == "void":
         return (True, None)
-    elif return_type == "int" or return_type == "uint":
-        return (True, mesg_buf.params["ints"][0])
-    elif return_type == "float":
-        return (True, mesg_buf.params["floats"][0])
+    values = _RESULT_CODECS[return_type].unpack_from(response, 1)
+    if return_type == "telemetry":
+        return (True, Telemetry._make(values))
+    if return_type == "burst":
+        # Slots before the firmware's first sample are padding
+        pairs = tuple(zip(values[1::2], values[2::2]))
+        padding = max(SENSOR_BURST_SIZE - values[0], 0)
+        return (True, SensorBurst(values[0], pairs[padding:]))
+    return (True, values[0])
+
+
+def set_recorder(recorder):
+    """
+    Starts passing every request/response pair to `recorder.record(request, response)`,
+    response being None if the bus raised OSError. Pass None to stop recording.
+    """
+    global RECORDER
+
+    RECORDER = recorder
+
+
+def record_tick():
+    """Marks the start of a control tick in the recording, if one is being made"""
+    global RECORDER
+
+    if RECORDER is not None:
+        RECORDER.record_tick()
+
+
+def call_function(function: Function, *args) -> Tuple[bool, Any]:
+    global ADDR
+    global USE_REPEATED_START
+
+    start = time.perf_counter()
+    frame = _tx_frame(_TX_FRAMES)
+    return_type = _pack_call(frame, function, args)
+    try:
+        if USE_REPEATED_START:
+            response = write_read_bytes(ADDR, frame, FRAME_SIZE)
+        else:
+            # Keep other threads' transactions from landing between the two halves
+            with session():
+                write_bytes(ADDR, frame)
+                response = read_bytes(ADDR, FRAME_SIZE)
+    except OSError:
+        _call_failed(function, frame)
+        raise
+    return _call_done(function, frame, response, return_type, start)
+
+
+async def call_function_async(function: Function, *args) -> Tuple[bool, Any]:
+    """
+    Same as call_function(), for asyncio code. The call runs on BUS_EXECUTOR, so the event
+    loop keeps running while the bus is busy.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(BUS_EXECUTOR, call_function, function, *args)
+
+
+def call_many(calls: List[Tuple[Function, Tuple]]) -> List[Tuple[bool, Any]]:
+    """
+    Calls several functions in order while holding the bus, one repeated start transaction
+    each, so no other thread's calls land in between.
+
+    `calls` is a list of (function, args) pairs, the results are returned in the same order
+    and in the same form as call_function(). An OSError fails the whole batch.
+    """
+    global ADDR
+    global RECORDER
+
+    frames = [
+        _INT_CODEC.pack(function, *args, *_NO_ARGS[len(args) :])
+        for (function, args) in calls
+    ]
+    try:
+        responses = write_read_many(ADDR, frames, FRAME_SIZE)
+    except OSError:
+        _BUS_ERRORS.labels("batch").inc()
+        if RECORDER is not None:
+            for frame in frames:
+                RECORDER.record(frame, None)
+        raise
+
+    if RECORDER is not None:
+        for (frame, response) in zip(frames, responses):
+            RECORDER.record(frame, response)
+    return [
+        _decode_response(response, _return_type(function))
+        for ((function, _), response) in zip(calls, responses)
+    ]
+
+
+class Device:
+    """
+    Class for calling functions on one of several Arduinos sharing a bus.
+
+    Calls go through a bus_scheduler.BusScheduler instead of simple_i2c, so controllers on
+    other threads can use the same bus. Servo writes are queued ahead of reads, and a call
+    that cannot start within `deadline` seconds raises bus_scheduler.DeadlineMissed. Calls
+    from different threads each pack their own frame, `executor` runs
+    call_function_async() calls one at a time.
+    """
+
+    address: int
+    deadline: Optional[float]
+    executor: ThreadPoolExecutor
+
+    __scheduler: BusScheduler
+    __frames: threading.local
+
+    def __init__(
+        self, scheduler: BusScheduler, address: int, deadline: Optional[float] = None
+    ):
+        self.address = address
+        self.deadline = deadline
+        self.__scheduler = scheduler
+        self.__frames = threading.local()
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"i2c-{address:#04x}"
+        )
+        scheduler.add_device(address)
+
+    def call_function(self, function: Function, *args) -> Tuple[bool, Any]:
+        """Same as the module level call_function(), for this device"""
+        start = time.perf_counter()
+        frame = _tx_frame(self.__frames)
+        return_type = _pack_call(frame, function, args)
+        try:
+            response = self.__scheduler.transact(
+                self.address,
+                frame,
+                FRAME_SIZE,
+                _priority(function),
+                self.deadline,
+            )
+        except OSError:
+            _call_failed(function, frame)
+            raise
+        return _call_done(function, frame, response, return_type, start)
+
+    async def call_function_async(self, function: Function, *args) -> Tuple[bool, Any]:
+        """Same as call_function_async(), for this device"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.call_function, function, *args
+        )
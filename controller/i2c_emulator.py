@@ -0,0 +1,328 @@
+"""Module for emulating the throttle body Arduino on an in-process I2C bus"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import ctypes, errno, random, struct, time
+from plant import reported_position, servo_angle
+from sensors import raw_from_afr, raw_from_maf
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Globals
+FRAME_SIZE = 29  # sizeof(i2c_buffer) on the AVR
+I2C_M_RD = 0x0001  # read flag of struct i2c_msg (linux/i2c.h)
+
+# Values mirrored from the firmware
+_CMD_ERROR_GENERIC = -1
+_CMD_ERROR_NONE = 0
+_CMD_GET_SERVO = 1
+_CMD_SET_SERVO = 2
+_CMD_GET_TELEMETRY = 3
+_CMD_SET_SERVO_READBACK = 4
+_CMD_GET_SENSOR_BURST = 5
+_FLAG_BAD_FRAME_SIZE = 0x01
+_FLAG_UNKNOWN_COMMAND = 0x02
+_FLAG_POSITION_OUT_OF_RANGE = 0x04
+_FLAG_RESET_CAUSE_SHIFT = 8
+_MCUSR_EXTRF = 0x02  # external reset flag, set by a pulse on the reset line
+_LOOP_PERIOD = 0.115  # LOOP_DELAY + SERVO_READ_DELAY
+_SERVO_DEFAULT_POSITION = 90  # Servo::read() after attach() with no write()
+_SENSOR_PERIOD = _LOOP_PERIOD / 6  # five samples through LOOP_DELAY, one after the servo
+_SENSOR_RING_SIZE = 8
+_SENSOR_BURST_SIZE = 6
+
+# Engine model used by engine_sensors()
+_STOICH_THROTTLE = 20.00  # degrees at which the fixed fuelling gives 14.7:1
+_AFR_PER_DEGREE = 0.05  # leaner per degree of throttle past that
+_AFR_NOISE = 0.15  # standard deviation of the O2 reading
+_AFR_SPIKE_RATE = 0.02  # chance a sample is hit by ignition noise
+_AFR_SPIKE = 3.00
+
+_CMD = struct.Struct("<b")
+_INT = struct.Struct("<i")
+_TELEMETRY = struct.Struct("<4i3I")
+_BURST = struct.Struct(f"<I{2 * _SENSOR_BURST_SIZE}H")
+
+
+def engine_sensors(position: int, rng: random.Random) -> Tuple[int, int]:
+    """
+    Sensor model for ArduinoEmulator, returns raw (MAF, wideband O2) readings at throttle
+    `position`. Fuelling is fixed, so the mixture leans out as the throttle opens. The O2
+    reading is noisy with the odd spike.
+    """
+    afr = 14.7 + _AFR_PER_DEGREE * (position - _STOICH_THROTTLE)
+    afr += rng.gauss(0.00, _AFR_NOISE)
+    if rng.random() < _AFR_SPIKE_RATE:
+        afr += rng.choice((-_AFR_SPIKE, _AFR_SPIKE))
+    return (raw_from_maf(1.00 + 3.00 * position / 90), raw_from_afr(afr))
+
+
+class ArduinoEmulator:
+    """
+    Loopback stand-in for an smbus2.SMBus with the throttle body firmware on the other end.
+
+    Speaks the i2c_buffer wire format from the firmware (29 byte frames) and mimics its
+    receiveEvent/requestEvent handlers, so it can be handed to simple_i2c.init_bus() to run
+    the comms and controller code on any machine. Latency, error replies and OSError bursts
+    can be injected to approximate a noisy bus.
+
+    The board's reset line is driven with set_reset(). It does not answer while the line is
+    held or for `boot_delay` seconds after it is released, then comes back like a freshly
+    booted board. Clearing `connected` makes every call fail, like a pulled cable.
+    """
+
+    address: int
+    latency: float
+    bus_speed: float
+    error_rate: float
+    oserror_rate: float
+    oserror_burst: int
+    boot_delay: float
+    connected: bool
+    transactions: int
+    frames_received: int
+    frames_requested: int
+    injected_errors: int
+    injected_oserrors: int
+    sensors: List[int]  # raw ADC readings reported in telemetry frames
+    sensor_model: Optional[Callable[[int, random.Random], Tuple[int, int]]]
+
+    __frame: bytearray
+    __servo_position: int
+    __burst_remaining: int
+    __error_flags: int
+    __samples: List[Tuple[int, int]]
+    __sample_count: int
+    __boot_time: float
+    __in_reset: bool
+    __rng: random.Random
+    __sleep: Callable[[float], None]
+    __clock: Callable[[], float]
+
+    def __init__(
+        self,
+        address: int = 0x08,
+        latency: float = 0.00,
+        bus_speed: float = 0.00,
+        error_rate: float = 0.00,
+        oserror_rate: float = 0.00,
+        oserror_burst: int = 1,
+        seed: int = None,
+        boot_delay: float = 1.00,
+        sleep: Callable[[float], None] = time.sleep,
+        clock: Callable[[], float] = time.monotonic,
+        sensor_model: Optional[Callable[[int, random.Random], Tuple[int, int]]] = None,
+    ):
+        """
+        latency: fixed seconds added to every i2c_rdwr call
+        bus_speed: bus clock in Hz used to add wire time per byte, 0 disables it
+        error_rate: chance a handled command is answered with Error_Generic
+        oserror_rate: chance an i2c_rdwr call starts a burst of OSErrors
+        oserror_burst: number of consecutive i2c_rdwr calls failing in a burst
+        boot_delay: seconds the board stays silent after its reset line is released
+        clock: monotonic clock in seconds, drives the loop counter and uptime
+        sensor_model: returns the raw readings for the throttle position and the
+            emulator's random generator each time the firmware samples, e.g.
+            engine_sensors. By default every sample is `sensors`.
+        """
+        self.address = address
+        self.latency = latency
+        self.bus_speed = bus_speed
+        self.error_rate = error_rate
+        self.oserror_rate = oserror_rate
+        self.oserror_burst = oserror_burst
+        self.boot_delay = boot_delay
+        self.connected = True
+        self.transactions = 0
+        self.frames_received = 0
+        self.frames_requested = 0
+        self.injected_errors = 0
+        self.injected_oserrors = 0
+        self.sensors = [0, 0]
+        self.sensor_model = sensor_model
+        self.__frame = bytearray(FRAME_SIZE)
+        self.__servo_position = _SERVO_DEFAULT_POSITION
+        self.__burst_remaining = 0
+        self.__error_flags = 0
+        self.__samples = [(0, 0)] * _SENSOR_RING_SIZE
+        self.__sample_count = 0
+        self.__rng = random.Random(seed)
+        self.__sleep = sleep
+        self.__clock = clock
+        self.__boot_time = clock()
+        self.__in_reset = False
+
+    # Internal functions
+    def __wire_time(self, msgs) -> float:
+        if self.bus_speed <= 0:
+            return 0.00
+        # Start + address byte per message, 9 clocks (8 data + ACK) per byte
+        bits = sum(1 + 9 * (1 + msg.len) for msg in msgs) + 1
+        return bits / self.bus_speed
+
+    def __set_error(self, code: int, mesg: str):
+        self.__frame[:] = bytes(FRAME_SIZE)
+        _CMD.pack_into(self.__frame, 0, code)
+        data = mesg.encode("utf-8")[0:27]
+        self.__frame[1 : 1 + len(data)] = data
+
+    def __clear_error(self):
+        self.__frame[:] = bytes(FRAME_SIZE)
+
+    def __set_servo(self, pos: int):
+        if pos < 0 or pos > 90:
+            self.__error_flags |= _FLAG_POSITION_OUT_OF_RANGE
+        self.__servo_position = servo_angle(pos)
+
+    def __take_samples(self):
+        # Catch up on the samples loop() would have taken since the last call, only the
+        # ones still in the ring matter
+        count = int(max(self.__clock() - self.__boot_time, 0.00) / _SENSOR_PERIOD)
+        first = max(self.__sample_count, count - _SENSOR_RING_SIZE)
+        position = reported_position(self.__servo_position)
+        for idx in range(first, count):
+            if self.sensor_model is not None:
+                self.sensors[:] = self.sensor_model(position, self.__rng)
+            self.__samples[idx % _SENSOR_RING_SIZE] = (self.sensors[0], self.sensors[1])
+        self.__sample_count = count
+
+    def __pack_sensor_burst(self):
+        self.__take_samples()
+        count = self.__sample_count
+        values = [0] * (2 * _SENSOR_BURST_SIZE)
+        for i in range(min(count, _SENSOR_BURST_SIZE)):
+            slot = _SENSOR_BURST_SIZE - 1 - i
+            values[2 * slot : 2 * slot + 2] = self.__samples[
+                (count - 1 - i) % _SENSOR_RING_SIZE
+            ]
+        self.__clear_error()
+        _BURST.pack_into(self.__frame, 1, count & 0xFFFFFFFF, *values)
+
+    def __pack_telemetry(self):
+        uptime = self.__clock() - self.__boot_time
+        if self.sensor_model is not None:
+            self.__take_samples()
+        self.__clear_error()
+        _TELEMETRY.pack_into(
+            self.__frame,
+            1,
+            reported_position(self.__servo_position),
+            self.__servo_position,
+            self.sensors[0],
+            self.sensors[1],
+            int(uptime / _LOOP_PERIOD) & 0xFFFFFFFF,
+            self.__error_flags,
+            int(uptime * 1000) & 0xFFFFFFFF,
+        )
+        self.__error_flags = 0
+
+    def __receive_event(self, data: bytes):
+        # Firmware drops any frame that is not exactly sizeof(g_buf)
+        if len(data) != FRAME_SIZE:
+            self.__error_flags |= _FLAG_BAD_FRAME_SIZE
+            return
+
+        self.frames_received += 1
+        self.__frame[:] = data
+        [cmd] = _CMD.unpack_from(self.__frame, 0)
+
+        if cmd == _CMD_GET_SERVO:
+            pos = reported_position(self.__servo_position)
+            self.__clear_error()
+            _INT.pack_into(self.__frame, 1, pos)
+        elif cmd == _CMD_SET_SERVO:
+            [pos] = _INT.unpack_from(self.__frame, 1)
+            self.__set_servo(pos)
+            self.__clear_error()
+        elif cmd == _CMD_GET_TELEMETRY:
+            self.__pack_telemetry()
+        elif cmd == _CMD_SET_SERVO_READBACK:
+            [pos] = _INT.unpack_from(self.__frame, 1)
+            self.__set_servo(pos)
+            self.__pack_telemetry()
+        elif cmd == _CMD_GET_SENSOR_BURST:
+            self.__pack_sensor_burst()
+        else:
+            # Unknown commands are echoed back untouched, like the firmware
+            self.__error_flags |= _FLAG_UNKNOWN_COMMAND
+            return
+
+        if self.error_rate > 0 and self.__rng.random() < self.error_rate:
+            self.injected_errors += 1
+            self.__set_error(_CMD_ERROR_GENERIC, "Injected fault")
+
+    def __request_event(self, msg):
+        self.frames_requested += 1
+        # Wire.write() sends the whole buffer, extra clocks read back a released (high) bus
+        data = bytes(self.__frame[0 : msg.len]) + b"\xff" * (msg.len - FRAME_SIZE)
+        ctypes.memmove(msg.buf, data, msg.len)
+
+    # Public Functions
+    def get_servo_position(self) -> int:
+        """Returns the raw servo angle the firmware would write to the PWM pin"""
+        return self.__servo_position
+
+    def set_reset(self, asserted: bool):
+        """Drives the reset line, releasing it reboots the board"""
+        if asserted:
+            self.__in_reset = True
+        elif self.__in_reset:
+            self.__in_reset = False
+            self.__frame[:] = bytes(FRAME_SIZE)
+            self.__servo_position = _SERVO_DEFAULT_POSITION
+            self.__burst_remaining = 0
+            self.__sample_count = 0
+            self.__error_flags = _MCUSR_EXTRF << _FLAG_RESET_CAUSE_SHIFT
+            self.__boot_time = self.__clock() + self.boot_delay
+
+    def i2c_rdwr(self, *msgs):
+        self.transactions += 1
+
+        delay = self.latency + self.__wire_time(msgs)
+        if delay > 0:
+            self.__sleep(delay)
+
+        if not self.connected or self.__in_reset or self.__clock() < self.__boot_time:
+            # Nobody ACKs the address
+            raise OSError(errno.ENXIO, "No such device or address")
+
+        if self.__burst_remaining == 0 and self.oserror_rate > 0:
+            if self.__rng.random() < self.oserror_rate:
+                self.__burst_remaining = max(self.oserror_burst, 1)
+        if self.__burst_remaining > 0:
+            self.__burst_remaining -= 1
+            self.injected_oserrors += 1
+            raise OSError(errno.EREMOTEIO, "Remote I/O error")
+
+        for msg in msgs:
+            if msg.addr != self.address:
+                raise OSError(errno.EREMOTEIO, "Remote I/O error")
+            if msg.flags & I2C_M_RD:
+                self.__request_event(msg)
+            else:
+                self.__receive_event(bytes(msg))
+
+    def close(self):
+        pass
+
+
+class EmulatedBus:
+    """Stand-in for an smbus2.SMBus with several ArduinoEmulators on it, one per address"""
+
+    devices: Dict[int, ArduinoEmulator]
+
+    def __init__(self, *devices: ArduinoEmulator):
+        self.devices = {device.address: device for device in devices}
+
+    def i2c_rdwr(self, *msgs):
+        device = self.devices.get(msgs[0].addr)
+        if device is None:
+            # Nobody ACKs the address
+            raise OSError(errno.ENXIO, "No such device or address")
+        device.i2c_rdwr(*msgs)
+
+    def close(self):
+        for device in self.devices.values():
+            device.close()
@@ -0,0 +1,169 @@
+"""Module for low-overhead counters and latency histograms in Prometheus text format"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+# Globals
+# Upper bounds in seconds, from sub-transaction times up to an Arduino reset
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_REGISTRY: List["_Metric"] = []
+
+
+def _format_labels(
+    names: Tuple[str, ...], values: Tuple[str, ...], extra: str = ""
+) -> str:
+    pairs = [f'{name}="{value}"' for (name, value) in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind: str
+    name: str
+    help_text: str
+    label_names: Tuple[str, ...]
+    _children: Dict[Tuple[str, ...], object]
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._children = {}
+        _REGISTRY.append(self)
+
+    def labels(self, *values):
+        """Returns the child for one set of label values, keep it to skip this lookup"""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self, key: Tuple[str, ...], child) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for (key, child) in list(self._children.items()):
+            lines.extend(self._samples(key, child))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    """Monotonic count, inc() is a single attribute add on the hot path"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, label_names)
+        if not label_names:
+            self.inc = self.labels().inc
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _samples(self, key, child) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, key)} {child.value}"]
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.00
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    """
+    Latency histogram with fixed buckets. Only the bucket count and the sum change per
+    observation, cumulative counts are worked out when rendering.
+    """
+
+    kind = "histogram"
+    bounds: Tuple[float, ...]
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Tuple[str, ...] = (),
+        bounds: Tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        self.bounds = bounds
+        super().__init__(name, help_text, label_names)
+        if not label_names:
+            self.observe = self.labels().observe
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def _samples(self, key, child) -> List[str]:
+        lines = []
+        counts = list(child.counts)
+        total = 0
+        for (bound, count) in zip(self.bounds + (float("inf"),), counts):
+            total += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            labels = _format_labels(self.label_names, key, f'le="{le}"')
+            lines.append(f"{self.name}_bucket{labels} {total}")
+        labels = _format_labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {child.sum}")
+        lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+def render() -> str:
+    """Returns every registered metric in the Prometheus text exposition format"""
+    lines: List[str] = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,134 @@
+"""Module for model-predictive cruise control, choosing each throttle move from a batch of
+simulated futures"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import plant
+from plant import reported_position, servo_angle
+from typing import Dict
+
+try:
+    import numpy as np
+except ImportError:  # Only MPC cruise control needs numpy
+    np = None
+
+# Globals
+HORIZON: int = 16  # ticks looked ahead
+HOLD: int = 3  # ticks the first move is held before the second
+SECOND_MOVE_STEP: int = 5  # degrees between the second move candidates
+MOVE_COST: float = 0.01  # per degree the throttle moves this tick, in mph2 of error
+WRITE_COST: float = 0.50  # for moving at all, each move is a servo write
+SETTLE_COST: float = 4.00  # per (mph/s)2 still accelerating at the end of the horizon
+
+
+class CruiseMpc:
+    """
+    Class choosing the cruise throttle by simulating many candidate futures and keeping
+    the cheapest.
+
+    A candidate moves the throttle to one position for `hold` ticks and then to a second
+    position for the rest of the horizon. The first move covers every position the servo
+    can report, the second a coarser grid. Since the plant's acceleration depends only on
+    the throttle, each candidate's summed acceleration is computed once up front and a tick
+    only adds the current speed, floors it at zero and scores the whole batch. The cost is
+    the squared speed error over the horizon, plus penalties for moving the throttle (each
+    move is a servo write) and for still accelerating when the horizon ends. Only the first
+    move of the winner is applied, the next tick plans again from the measured speed.
+    """
+
+    horizon: int
+    hold: int
+
+    __commands: Dict[int, int]  # reported position -> command that gets there
+    __first: "np.ndarray"  # (N,) first move of each candidate
+    __accel_sum: "np.ndarray"  # (N, H) running sum of acceleration, per second of dt
+    __accel_min: "np.ndarray"  # (N, H) running minimum of __accel_sum
+    __lowest: float  # smallest value in __accel_min
+    __fixed_cost: "np.ndarray"  # (N,) cost not depending on the vehicle state
+    __speed: "np.ndarray"  # (N, H) scratch for the predicted speeds
+    __floor: "np.ndarray"  # (N, H) scratch for the zero speed floor
+    __cost: "np.ndarray"  # (N,) scratch for the total cost
+    __moved: "np.ndarray"  # (N,) scratch for the first move's size
+
+    def __init__(
+        self,
+        horizon: int = HORIZON,
+        hold: int = HOLD,
+        second_move_step: int = SECOND_MOVE_STEP,
+    ):
+        if np is None:
+            raise ImportError("numpy is required for MPC cruise control")
+        if not 0 < hold < horizon:
+            raise ValueError("hold must be between 0 and horizon")
+        self.horizon = horizon
+        self.hold = hold
+
+        # A SET_SERVO goes through the firmware's map() both ways, not every position can
+        # be reported back, and the plant only ever sees the reported one
+        self.__commands = {}
+        for command in range(int(plant.MAX_THROTTLE) + 1):
+            self.__commands.setdefault(reported_position(servo_angle(command)), command)
+        positions = np.array(sorted(self.__commands), dtype=np.float64)
+        second = positions[positions % second_move_step == 0]
+
+        first = np.repeat(positions, len(second))
+        then = np.tile(second, len(positions))
+        steps = np.concatenate(
+            (
+                np.repeat(first[:, np.newaxis], hold, axis=1),
+                np.repeat(then[:, np.newaxis], horizon - hold, axis=1),
+            ),
+            axis=1,
+        )
+        # v[t] = max(v[t-1] + a[t] * dt, 0) in closed form, same as plant.simulate_fleet,
+        # with the dt and speed independent parts done here
+        self.__accel_sum = np.cumsum(plant.acceleration_array(steps), axis=1)
+        self.__accel_min = np.minimum.accumulate(self.__accel_sum, axis=1)
+        self.__lowest = float(self.__accel_min.min())
+        self.__first = first
+        settle = plant.acceleration_array(then)
+        self.__fixed_cost = (
+            MOVE_COST * np.abs(then - first)
+            + (np.abs(then - first) > 0) * WRITE_COST
+            + SETTLE_COST * settle * settle
+        )
+        self.__speed = np.empty_like(self.__accel_sum)
+        self.__floor = np.empty_like(self.__accel_sum)
+        self.__cost = np.empty_like(first)
+        self.__moved = np.empty_like(first)
+
+    # Public Functions
+    def candidates(self) -> int:
+        return len(self.__first)
+
+    def update(
+        self, throttle_position: int, speed: float, target_speed: float, dt: float
+    ) -> int:
+        """Returns the position to command this tick, `dt` being the tick period"""
+        v = self.__speed
+        np.multiply(self.__accel_sum, dt, out=v)
+        v += speed
+        if speed + self.__lowest * dt < 0:
+            # Some candidates would stop the vehicle inside the horizon
+            floor = self.__floor
+            np.multiply(self.__accel_min, dt, out=floor)
+            floor += speed
+            np.minimum(floor, 0.00, out=floor)
+            v -= floor
+        # Squared speed error summed over the horizon
+        v -= target_speed
+        np.square(v, out=v)
+        cost = self.__cost
+        np.sum(v, axis=1, out=cost)
+        cost /= self.horizon
+
+        moved = self.__moved
+        np.subtract(self.__first, throttle_position, out=moved)
+        np.abs(moved, out=moved)
+        cost += MOVE_COST * moved
+        cost += (moved > 0) * WRITE_COST
+        cost += self.__fixed_cost
+        return self.__commands[int(self.__first[int(np.argmin(cost))])]
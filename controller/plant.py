@@ -0,0 +1,146 @@
+"""
+Module modelling the vehicle driven by the throttle body, for one vehicle or whole fleets,
+and how the throttle body firmware maps positions onto its servo
+"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+from typing import Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:  # Only the batch functions need numpy
+    np = None
+
+# Plant parameters
+MAX_ACCELERATION: float = 4.5  # m/s2
+DRAG: float = 0.89  # m/s2 lost to friction and air resistance
+MPS2_TO_MPHPS: float = 2.237
+MAX_THROTTLE: float = 90.00  # degrees
+# Acceleration curve coefficients over throttle fraction, highest power first
+CURVE = (8.073, -18.252, 12.212, -1.022, -0.005)
+
+# Servo calibration, mirrored from throttle-body/include/calibrations.hpp
+SERVO_MIN_POSITION = 16
+SERVO_MAX_POSITION = 118
+
+
+def _arduino_map(x: int, in_min: int, in_max: int, out_min: int, out_max: int) -> int:
+    # Arduino's map() uses long arithmetic, so division truncates toward zero
+    num = (x - in_min) * (out_max - out_min)
+    den = in_max - in_min
+    quot = abs(num) // abs(den)
+    if (num < 0) != (den < 0):
+        quot = -quot
+    return quot + out_min
+
+
+def servo_angle(pos: int) -> int:
+    """Returns the raw servo angle the firmware writes for a SET_SERVO to `pos` degrees"""
+    return _arduino_map(pos, 0, 90, SERVO_MIN_POSITION, SERVO_MAX_POSITION)
+
+
+def reported_position(angle: int) -> int:
+    """Returns the position GET_SERVO reports while the servo is at raw `angle`"""
+    return _arduino_map(angle, SERVO_MIN_POSITION, SERVO_MAX_POSITION, 0, 90)
+
+
+def _curve(throttle: float) -> float:
+    x = throttle / MAX_THROTTLE
+    (c4, c3, c2, c1, c0) = CURVE
+    a_x = MAX_ACCELERATION * ((((c4 * x + c3) * x + c2) * x + c1) * x + c0)
+    return (a_x - DRAG) * MPS2_TO_MPHPS
+
+
+# Acceleration in mph/s at each whole throttle degree, the servo only moves in whole degrees
+ACCELERATION_TABLE: Tuple[float, ...] = tuple(
+    _curve(deg) for deg in range(int(MAX_THROTTLE) + 1)
+)
+_LAST_DEGREE = len(ACCELERATION_TABLE) - 1
+if np is not None:
+    _DEGREE_ARRAY = np.arange(len(ACCELERATION_TABLE), dtype=np.float64)
+    _TABLE_ARRAY = np.array(ACCELERATION_TABLE, dtype=np.float64)
+
+
+def acceleration(throttle: float) -> float:
+    """
+    Returns the acceleration in mph/s at `throttle` degrees, clipped to 0 - 90. Whole
+    degrees are a table lookup, anything between is interpolated linearly.
+    """
+    if throttle <= 0:
+        return ACCELERATION_TABLE[0]
+    if throttle >= _LAST_DEGREE:
+        return ACCELERATION_TABLE[_LAST_DEGREE]
+    idx = int(throttle)
+    frac = throttle - idx
+    low = ACCELERATION_TABLE[idx]
+    if frac == 0:
+        return low
+    return low + frac * (ACCELERATION_TABLE[idx + 1] - low)
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required for fleet simulation")
+
+
+def acceleration_array(throttle: "np.ndarray") -> "np.ndarray":
+    """Vectorized acceleration(), `throttle` is an array of degrees"""
+    _require_numpy()
+    # Same table as acceleration(), so fleet runs match the controller exactly
+    return np.interp(
+        np.asarray(throttle, dtype=np.float64), _DEGREE_ARRAY, _TABLE_ARRAY
+    )
+
+
+def simulate_fleet(
+    throttle: "np.ndarray",
+    dt: float = 1.00,
+    initial_speed: Union[float, "np.ndarray"] = 0.00,
+) -> "np.ndarray":
+    """
+    Integrates the speed of N vehicles over T steps in one pass.
+
+    throttle: (N, T) array of throttle positions in degrees, clipped to 0 - 90
+    dt: seconds per step
+    initial_speed: scalar or (N,) array in mph
+
+    Returns an (N, T) float array with each vehicle's speed after every step. Speed never
+    drops below zero, same as Controller.update_speed.
+    """
+    _require_numpy()
+    throttle = np.clip(
+        np.atleast_2d(np.asarray(throttle, dtype=np.float64)), 0, MAX_THROTTLE
+    )
+    v0 = np.broadcast_to(
+        np.asarray(initial_speed, dtype=np.float64), (throttle.shape[0],)
+    )[:, np.newaxis]
+
+    # v[t] = max(v[t-1] + a[t] * dt, 0) is a Lindley recursion, so it has a closed form on
+    # the running sum: v[t] = c[t] - min(0, min(c[1..t]))
+    cum = v0 + np.cumsum(acceleration_array(throttle) * dt, axis=1)
+    floor = np.minimum(np.minimum.accumulate(cum, axis=1), 0.00)
+    return cum - floor
+
+
+class FleetPlant:
+    """
+    Class holding float speed state for N vehicles, for closed loop simulations that need to
+    pick each step's throttle from the previous step's speed.
+    """
+
+    speed: "np.ndarray"
+
+    def __init__(self, count: int, initial_speed: Union[float, "np.ndarray"] = 0.00):
+        _require_numpy()
+        self.speed = np.empty(count, dtype=np.float64)
+        self.speed[:] = initial_speed
+
+    def step(self, throttle: "np.ndarray", dt: float = 1.00) -> "np.ndarray":
+        """Advances every vehicle by `dt` seconds at `throttle` degrees, returns the speeds"""
+        self.speed += acceleration_array(np.clip(throttle, 0, MAX_THROTTLE)) * dt
+        np.maximum(self.speed, 0.00, out=self.speed)
+        return self.speed
@@ -0,0 +1,178 @@
+"""Module for recovering the throttle body Arduino from bus faults without blocking"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import time
+import metrics
+from typing import Callable, Dict
+
+# States
+STATE_OK = "ok"  # talking to the board normally
+STATE_RESET = "reset"  # reset line held high
+STATE_BOOTING = "booting"  # reset released, waiting for the bootloader and setup()
+STATE_PROBE = "probe"  # board should be up, the next call decides
+STATE_BACKOFF = "backoff"  # a reset did not help, waiting before the next one
+STATE_OPEN = "open"  # circuit breaker open, resets stopped for a cooldown
+
+_RESETS = metrics.Counter("controller_resets_total", "Throttle body board resets")
+_BREAKER_TRIPS = metrics.Counter(
+    "controller_breaker_trips_total", "Times repeated failed resets opened the breaker"
+)
+_RECOVERY_SECONDS = metrics.Histogram(
+    "controller_recovery_seconds",
+    "Time from a bus fault to the throttle body answering again",
+    bounds=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0),
+)
+
+
+class Recovery:
+    """
+    State machine that resets the throttle body board after bus faults.
+
+    The controller reports the outcome of its bus calls and calls poll() every tick. A
+    failure starts a reset pulse, which is timed against the clock instead of slept through,
+    so ticks keep running while the board reboots. Once it should be up the controller gets
+    one probe call. Each failed probe doubles the wait before the next reset, and after
+    `breaker_threshold` failed resets in a row the breaker opens and resets stop for
+    `breaker_cooldown` seconds. After the cooldown one more reset is tried, and the breaker
+    opens again straight away if it fails. The breaker counts as tripped from then until a
+    probe succeeds, through the resets tried between cooldowns. Whenever the state is not
+    STATE_OK the controller holds its last good command.
+    """
+
+    state: str
+    resets: int
+    breaker_trips: int
+    consecutive_failures: int
+
+    pulse: float
+    boot_time: float
+    backoff: float
+    max_backoff: float
+    breaker_threshold: int
+    breaker_cooldown: float
+
+    __reset_output: Callable[[bool], None]
+    __clock: Callable[[], float]
+    __until: float
+    __tripped: bool
+    __fault_time: float
+    __reset_score: float
+
+    def __init__(
+        self,
+        reset_output: Callable[[bool], None],
+        clock: Callable[[], float] = time.monotonic,
+        pulse: float = 0.20,
+        boot_time: float = 2.00,
+        backoff: float = 1.00,
+        max_backoff: float = 30.00,
+        breaker_threshold: int = 5,
+        breaker_cooldown: float = 60.00,
+    ):
+        """
+        reset_output: drives the board's reset line, True for high
+        clock: monotonic clock in seconds
+        pulse: seconds the reset line is held high
+        boot_time: seconds the board needs after a reset before it answers
+        backoff: wait after the first failed reset, doubled for each one after it
+        """
+        self.state = STATE_OK
+        self.resets = 0
+        self.breaker_trips = 0
+        self.consecutive_failures = 0
+        self.pulse = pulse
+        self.boot_time = boot_time
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.__reset_output = reset_output
+        self.__clock = clock
+        self.__until = 0.00
+        self.__tripped = False
+        self.__fault_time = 0.00
+        self.__reset_score = 0.00
+
+    # Internal functions
+    def __start_reset(self, now: float):
+        self.resets += 1
+        self.__reset_score += 1.00
+        _RESETS.inc()
+        print("----------------------\nRESETTING ARDUINO!\n----------------------")
+        self.__reset_output(True)
+        self.state = STATE_RESET
+        self.__until = now + self.pulse
+
+    # Public Functions
+    def ok(self) -> bool:
+        return self.state == STATE_OK
+
+    def probe_due(self) -> bool:
+        return self.state == STATE_PROBE
+
+    def intermittent(self) -> bool:
+        """True while resets are frequent enough to flag intermittent comms"""
+        return self.__reset_score > 3.00
+
+    def breaker_open(self) -> bool:
+        return self.state == STATE_OPEN
+
+    def breaker_tripped(self) -> bool:
+        """True from the breaker opening until a probe succeeds, unlike breaker_open()"""
+        return self.__tripped
+
+    def poll(self):
+        """Advances timed states, call once per tick"""
+        now = self.__clock()
+        if now < self.__until:
+            return
+
+        if self.state == STATE_RESET:
+            self.__reset_output(False)
+            self.state = STATE_BOOTING
+            self.__until = now + self.boot_time
+        elif self.state == STATE_BOOTING:
+            self.state = STATE_PROBE
+        elif self.state in (STATE_BACKOFF, STATE_OPEN):
+            self.__start_reset(now)
+
+    def report_success(self):
+        if self.state == STATE_OK:
+            # Slowly decrease intermittent reset score for DTC
+            self.__reset_score = max(self.__reset_score - 0.10, 0.00)
+        elif self.state == STATE_PROBE:
+            _RECOVERY_SECONDS.observe(self.__clock() - self.__fault_time)
+            self.consecutive_failures = 0
+            self.__tripped = False
+            self.state = STATE_OK
+
+    def report_failure(self):
+        now = self.__clock()
+        if self.state == STATE_OK:
+            self.__fault_time = now
+            self.__start_reset(now)
+        elif self.state == STATE_PROBE:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.breaker_threshold:
+                self.breaker_trips += 1
+                _BREAKER_TRIPS.inc()
+                self.__tripped = True
+                self.state = STATE_OPEN
+                self.__until = now + self.breaker_cooldown
+            else:
+                wait = self.backoff * 2 ** (self.consecutive_failures - 1)
+                self.state = STATE_BACKOFF
+                self.__until = now + min(wait, self.max_backoff)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "state": self.state,
+            "resets": self.resets,
+            "breaker_trips": self.breaker_trips,
+            "breaker_tripped": self.__tripped,
+            "consecutive_failures": self.consecutive_failures,
+        }
@@ -0,0 +1,94 @@
+"""Script for replaying a bus recording through the controller faster than real time"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import argparse, csv, time
+import simple_i2c as si2c
+from bus_recording import Recording, ReplayBus
+from controller import Controller, _LOOP_FREQUENCY
+from headless import HeadlessGPIO, VirtualClock
+
+
+def replay(path: str, frequency: float, output: str = None):
+    """
+    Drives a Controller tick by tick with the operator inputs from the recording at `path`,
+    answering its bus calls from the recorded responses instead of the Arduino.
+    """
+    recording = Recording(path)
+    bus = ReplayBus(recording)
+    starts = recording.tick_starts()
+    si2c.init_bus(1, bus)
+    dt = 1.00 / frequency
+    # Ticks run on the recorded times, so the plant sees the same tick spacing
+    clock = VirtualClock(recording[0].timestamp - dt if len(recording) else 0.00)
+    # The reset line is not replayed, keep the controller off the Pi's pins
+    controller = Controller(
+        frequency,
+        gpio=HeadlessGPIO(clock.now),
+        clock=clock.now,
+        sleep=clock.sleep,
+        sensor_rate=0,
+    )
+    writer = None
+    out_file = None
+    if output is not None:
+        out_file = open(output, "w", newline="")
+        writer = csv.writer(out_file)
+        writer.writerow(
+            ["tick", "vehicle_speed", "throttle", "accelerator", "cruise_on"]
+        )
+
+    start = time.perf_counter()
+    try:
+        for (tick, idx) in starts:
+            rec = recording[idx]
+            clock.advance_to(rec.timestamp)
+            controller.set_accelerator_position(rec.accelerator)
+            controller.set_cruise_target_speed(rec.cruise_target_speed)
+            controller.set_cruise_control_status(rec.cruise_enabled)
+            controller.set_maf_value(rec.maf)
+            # Resync on the tick boundary, a diverged tick may use more or fewer calls
+            bus.seek(idx)
+            controller.tick(dt)
+            if writer is not None:
+                snap = controller.get_snapshot()
+                writer.writerow(
+                    [
+                        tick,
+                        snap.vehicle_speed,
+                        snap.throttle,
+                        snap.accelerator,
+                        snap.cruise_on,
+                    ]
+                )
+    finally:
+        elapsed = time.perf_counter() - start
+        si2c.close_bus()
+        controller.cleanup()
+        if out_file is not None:
+            out_file.close()
+
+    recorded = recording[-1].timestamp - recording[0].timestamp if len(recording) else 0
+    print(
+        f"Replayed {len(starts)} ticks ({len(recording)} transactions) in {elapsed:.2f} s"
+    )
+    if elapsed > 0:
+        print(f"Recorded span {recorded:.1f} s, {recorded / elapsed:.0f}x real time")
+    print(f"Divergent requests: {bus.divergences}")
+    recording.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("recording")
+    parser.add_argument("--frequency", type=float, default=_LOOP_FREQUENCY, help="Hz")
+    parser.add_argument("--output", help="CSV file for the per tick replayed state")
+    args = parser.parse_args()
+    replay(args.recording, args.frequency, args.output)
+
+
+if __name__ == "__main__":
+    main()
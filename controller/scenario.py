@@ -0,0 +1,194 @@
+"""Script for running scripted drives through a headless controller faster than real time"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import argparse, csv, time
+import simple_i2c as si2c
+from control_law import CRUISE_MPC, CRUISE_PID
+from controller import Controller, TelemetrySnapshot, _LOOP_FREQUENCY, _RESET_PIN
+from headless import HeadlessGPIO, VirtualClock
+from i2c_emulator import ArduinoEmulator
+from typing import Dict, List, NamedTuple
+
+# Actions
+ACTION_ACCELERATOR = "accelerator"  # value: pedal position, 0 - 1
+ACTION_CRUISE_SPEED = "cruise-speed"  # value: target speed
+ACTION_CRUISE_ON = "cruise-on"
+ACTION_CRUISE_OFF = "cruise-off"
+ACTION_BUS_DOWN = "bus-down"  # board stops answering, like a pulled cable
+ACTION_BUS_UP = "bus-up"
+
+
+class Event(NamedTuple):
+    """Operator input or fault, applied on the first tick at or after `time`"""
+
+    time: float
+    action: str
+    value: float = 0.00
+
+
+class ScenarioResult(NamedTuple):
+    trace: List[TelemetrySnapshot]
+    loop: Dict[str, float]
+    recovery: Dict[str, object]
+    servo: Dict[str, float]
+    wall_seconds: float
+
+
+def ramp(start: float, end: float, v0: float, v1: float, step: float = 0.10):
+    """Accelerator events moving the pedal from `v0` to `v1` between `start` and `end`"""
+    count = max(int(round((end - start) / step)), 1)
+    return [
+        Event(
+            start + i * (end - start) / count,
+            ACTION_ACCELERATOR,
+            v0 + i * (v1 - v0) / count,
+        )
+        for i in range(count + 1)
+    ]
+
+
+SCENARIOS: Dict[str, List[Event]] = {
+    # Pedal up to 80% over a minute, held, then back off
+    "ramp": ramp(0.00, 60.00, 0.00, 0.80) + ramp(240.00, 300.00, 0.80, 0.00),
+    # Accelerate, set cruise at 60, lift off the pedal, cancel after five minutes
+    "cruise": [
+        Event(0.00, ACTION_ACCELERATOR, 0.60),
+        Event(30.00, ACTION_CRUISE_SPEED, 60),
+        Event(30.00, ACTION_CRUISE_ON),
+        Event(31.00, ACTION_ACCELERATOR, 0.00),
+        Event(330.00, ACTION_CRUISE_OFF),
+    ],
+    # Short dropout the first reset clears, then one long enough to open the breaker
+    "bus-fault": [
+        Event(0.00, ACTION_ACCELERATOR, 0.40),
+        Event(60.00, ACTION_BUS_DOWN),
+        Event(61.00, ACTION_BUS_UP),
+        Event(180.00, ACTION_BUS_DOWN),
+        Event(300.00, ACTION_BUS_UP),
+    ],
+}
+
+
+def run(
+    events: List[Event],
+    duration: float,
+    frequency: float = _LOOP_FREQUENCY,
+    cruise_mode: str = CRUISE_PID,
+) -> ScenarioResult:
+    """
+    Runs a Controller for `duration` seconds of virtual time against the Arduino emulator
+    and the plant model, applying `events` as it goes. The loop never sleeps, so the run
+    takes only as long as the ticks themselves.
+    """
+    clock = VirtualClock()
+    emulator = ArduinoEmulator(sleep=clock.sleep, clock=clock.now)
+
+    def on_output(pin: int, level: int):
+        if pin == _RESET_PIN:
+            emulator.set_reset(level == HeadlessGPIO.HIGH)
+
+    gpio = HeadlessGPIO(clock.now, on_output)
+    si2c.init_bus(1, emulator)
+    controller = Controller(
+        frequency,
+        gpio=gpio,
+        clock=clock.now,
+        sleep=clock.sleep,
+        cruise_mode=cruise_mode,
+        sensor_rate=0,
+    )
+
+    pending = sorted(events, key=lambda event: event.time)
+    period = 1.00 / frequency
+    trace: List[TelemetrySnapshot] = []
+
+    def apply_due(until: float):
+        # A small slack keeps accumulated float error from pushing an event a tick late
+        while pending and pending[0].time <= until + 1e-9:
+            event = pending.pop(0)
+            if event.action == ACTION_ACCELERATOR:
+                controller.set_accelerator_position(event.value)
+            elif event.action == ACTION_CRUISE_SPEED:
+                controller.set_cruise_target_speed(int(event.value))
+            elif event.action == ACTION_CRUISE_ON:
+                controller.set_cruise_control_status(True)
+            elif event.action == ACTION_CRUISE_OFF:
+                controller.set_cruise_control_status(False)
+            elif event.action == ACTION_BUS_DOWN:
+                emulator.connected = False
+            elif event.action == ACTION_BUS_UP:
+                emulator.connected = True
+            else:
+                raise ValueError(f"Unknown scenario action: {event.action}")
+
+    def on_snapshot(snapshot: TelemetrySnapshot):
+        trace.append(snapshot)
+        apply_due(snapshot.timestamp + period)
+
+    controller.add_snapshot_listener(on_snapshot)
+    apply_due(clock.now() + period)
+
+    start = time.perf_counter()
+    try:
+        controller.simulate(int(round(duration * frequency)))
+    finally:
+        elapsed = time.perf_counter() - start
+        si2c.close_bus()
+        controller.cleanup()
+
+    return ScenarioResult(
+        trace,
+        controller.get_loop_stats(),
+        controller.get_recovery_stats(),
+        controller.get_servo_cache_stats(),
+        elapsed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--duration", type=float, default=600.00, help="seconds")
+    parser.add_argument("--frequency", type=float, default=_LOOP_FREQUENCY, help="Hz")
+    parser.add_argument(
+        "--cruise-mode", choices=(CRUISE_PID, CRUISE_MPC), default=CRUISE_PID
+    )
+    parser.add_argument("--output", help="CSV file for the per tick state")
+    args = parser.parse_args()
+
+    result = run(
+        SCENARIOS[args.scenario], args.duration, args.frequency, args.cruise_mode
+    )
+    if args.output is not None:
+        with open(args.output, "w", newline="") as out_file:
+            writer = csv.writer(out_file)
+            writer.writerow(
+                ["time", "vehicle_speed", "throttle", "accelerator", "cruise_on", "dtc"]
+            )
+            for snap in result.trace:
+                writer.writerow(
+                    [
+                        f"{snap.timestamp:.3f}",
+                        snap.vehicle_speed,
+                        snap.throttle,
+                        snap.accelerator,
+                        snap.cruise_on,
+                        " ".join(str(num) for (num, _) in snap.dtc),
+                    ]
+                )
+
+    print(
+        f"Ran {len(result.trace)} ticks ({args.duration:.0f} s) "
+        f"in {result.wall_seconds:.2f} s"
+    )
+    print(f"Loop: {result.loop}")
+    print(f"Recovery: {result.recovery}")
+    print(f"Servo: {result.servo}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Module for running a loop at a fixed rate against absolute deadlines"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import asyncio, math, time
+from typing import Callable, Dict
+
+# Overrun policies
+POLICY_SKIP = "skip"  # drop the ticks that were missed and realign to the next deadline
+POLICY_CATCH_UP = "catch-up"  # run the missed ticks back to back to get back on time
+
+
+class TickScheduler:
+    """
+    Class that paces a loop at a fixed frequency.
+
+    Each call to wait() sleeps until the next absolute deadline on a monotonic clock, so
+    time spent doing work inside the loop does not stretch the period. Deadlines that were
+    already missed when wait() is called count as overruns and are handled per `policy`.
+    """
+
+    frequency: float
+    period: float
+    policy: str
+
+    __clock: Callable[[], float]
+    __sleep: Callable[[float], None]
+    __deadline: float
+    __ticks: int
+    __overruns: int
+    __skipped: int
+    __jitter_mean: float
+    __jitter_m2: float
+    __jitter_max: float
+    __last_jitter: float
+
+    def __init__(
+        self,
+        frequency: float,
+        policy: str = POLICY_SKIP,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        if frequency <= 0:
+            raise ValueError("Frequency must be positive")
+        if policy not in (POLICY_SKIP, POLICY_CATCH_UP):
+            raise ValueError(f"Unknown overrun policy: {policy}")
+
+        self.frequency = frequency
+        self.period = 1.00 / frequency
+        self.policy = policy
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__deadline = math.nan
+        self.reset_stats()
+
+    # Internal functions
+    def __record_jitter(self, jitter: float):
+        # Welford's running mean/variance, keeps the per-tick cost constant
+        self.__ticks += 1
+        delta = jitter - self.__jitter_mean
+        self.__jitter_mean += delta / self.__ticks
+        self.__jitter_m2 += delta * (jitter - self.__jitter_mean)
+        if jitter > self.__jitter_max:
+            self.__jitter_max = jitter
+        self.__last_jitter = jitter
+
+    def __delay(self) -> float:
+        if math.isnan(self.__deadline):
+            self.start()
+        return self.__deadline - self.__clock()
+
+    def __woke(self, overrun: bool) -> bool:
+        now = self.__clock()
+        if overrun:
+            self.__overruns += 1
+
+        jitter = now - self.__deadline
+        self.__record_jitter(jitter)
+
+        self.__deadline += self.period
+        if now >= self.__deadline and self.policy == POLICY_SKIP:
+            missed = int((now - self.__deadline) // self.period) + 1
+            self.__skipped += missed
+            self.__deadline += missed * self.period
+        return overrun
+
+    # Public Functions
+    def start(self):
+        """Sets the first deadline one period from now"""
+        self.__deadline = self.__clock() + self.period
+
+    def wait(self) -> bool:
+        """Blocks until the next tick is due, returns True if the deadline was missed"""
+        delay = self.__delay()
+        if delay > 0:
+            self.__sleep(delay)
+        return self.__woke(delay <= 0)
+
+    async def wait_async(self) -> bool:
+        """
+        Same as wait(), sleeping on the running event loop instead of blocking. The loop
+        keeps its own time, so this is only exact with the default monotonic clock.
+        """
+        delay = self.__delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self.__woke(delay <= 0)
+
+    def reset_stats(self):
+        self.__ticks = 0
+        self.__overruns = 0
+        self.__skipped = 0
+        self.__jitter_mean = 0.00
+        self.__jitter_m2 = 0.00
+        self.__jitter_max = 0.00
+        self.__last_jitter = 0.00
+
+    def stats(self) -> Dict[str, float]:
+        """Returns tick counts and wake-up jitter (seconds late versus the deadline)"""
+        variance = self.__jitter_m2 / self.__ticks if self.__ticks > 1 else 0.00
+        return {
+            "frequency": self.frequency,
+            "ticks": self.__ticks,
+            "overruns": self.__overruns,
+            "skipped": self.__skipped,
+            "jitter_last": self.__last_jitter,
+            "jitter_mean": self.__jitter_mean,
+            "jitter_stddev": math.sqrt(variance),
+            "jitter_max": self.__jitter_max,
+        }
@@ -0,0 +1,319 @@
+"""Module for acquiring and filtering the MAF and O2 sensor readings from the throttle body"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import threading, time
+import i2c_comms as i2c
+import metrics
+from array import array
+from bisect import bisect_left, insort
+from bus_scheduler import DeadlineMissed
+from scheduler import TickScheduler, POLICY_SKIP
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Sensor calibration, sensor_0 is the MAF and sensor_1 the wideband O2 controller's output
+ADC_MAX = 1023  # 10 bit analogRead()
+ADC_VOLTS = 5.00
+AFR_MIN = 10.00  # air-fuel ratio at 0 V on the wideband output
+AFR_MAX = 20.00  # air-fuel ratio at 5 V
+
+# Filters
+FILTER_AVERAGE = "average"  # mean of the last `window` samples
+FILTER_MEDIAN = "median"  # median of the last `window` samples, ignores spikes
+FILTER_KALMAN = "kalman"  # scalar Kalman filter, `window` is not used
+KALMAN_Q: float = 0.002  # process variance per sample, how fast the mixture can drift
+KALMAN_R: float = 0.0225  # measurement variance of the O2 reading
+
+_SAMPLES = metrics.Counter(
+    "sensor_samples_total", "Sensor samples by what became of them", ("outcome",)
+)
+_READ_ERRORS = metrics.Counter(
+    "sensor_read_errors_total", "Sensor bursts that failed or were not sent"
+)
+_USED = _SAMPLES.labels("used")
+_MISSED = _SAMPLES.labels("missed")
+_REJECTED = _SAMPLES.labels("rejected")
+
+
+def afr_from_raw(raw: int) -> float:
+    return AFR_MIN + (AFR_MAX - AFR_MIN) * raw / ADC_MAX
+
+
+def raw_from_afr(afr: float) -> int:
+    raw = round((afr - AFR_MIN) / (AFR_MAX - AFR_MIN) * ADC_MAX)
+    return min(max(raw, 0), ADC_MAX)
+
+
+def volts_from_raw(raw: int) -> float:
+    return ADC_VOLTS * raw / ADC_MAX
+
+
+def raw_from_maf(volts: float) -> int:
+    return min(max(round(volts / ADC_VOLTS * ADC_MAX), 0), ADC_MAX)
+
+
+class MovingAverage:
+    """Mean of the last `window` values, kept as a running sum over a ring"""
+
+    window: int
+
+    __values: array
+    __count: int
+    __sum: float
+
+    def __init__(self, window: int):
+        if window < 1:
+            raise ValueError("Window must be at least 1")
+        self.window = window
+        self.__values = array("d", bytes(8 * window))
+        self.__count = 0
+        self.__sum = 0.00
+
+    def update(self, value: float) -> float:
+        idx = self.__count % self.window
+        if self.__count >= self.window:
+            self.__sum -= self.__values[idx]
+        self.__values[idx] = value
+        self.__count += 1
+        if idx == self.window - 1:
+            # Start over from the ring once per lap so rounding error cannot build up
+            self.__sum = sum(self.__values)
+        else:
+            self.__sum += value
+        return self.__sum / min(self.__count, self.window)
+
+
+class MovingMedian:
+    """Median of the last `window` values, kept sorted alongside the ring"""
+
+    window: int
+
+    __values: array
+    __sorted: List[float]
+    __count: int
+
+    def __init__(self, window: int):
+        if window < 1:
+            raise ValueError("Window must be at least 1")
+        self.window = window
+        self.__values = array("d", bytes(8 * window))
+        self.__sorted = []
+        self.__count = 0
+
+    def update(self, value: float) -> float:
+        idx = self.__count % self.window
+        if self.__count >= self.window:
+            del self.__sorted[bisect_left(self.__sorted, self.__values[idx])]
+        self.__values[idx] = value
+        insort(self.__sorted, value)
+        self.__count += 1
+        ordered = self.__sorted
+        mid = len(ordered) // 2
+        if len(ordered) % 2:
+            return ordered[mid]
+        return (ordered[mid - 1] + ordered[mid]) / 2
+
+
+class ScalarKalman:
+    """
+    Kalman filter for one value that drifts as a random walk with variance `q` per sample
+    and is measured with noise of variance `r`
+    """
+
+    q: float
+    r: float
+
+    __estimate: Optional[float]
+    __variance: float
+
+    def __init__(self, q: float = KALMAN_Q, r: float = KALMAN_R):
+        self.q = q
+        self.r = r
+        self.__estimate = None
+        self.__variance = r
+
+    def update(self, value: float) -> float:
+        if self.__estimate is None:
+            # The first measurement is the best guess there is
+            self.__estimate = value
+            return value
+        variance = self.__variance + self.q
+        gain = variance / (variance + self.r)
+        self.__estimate += gain * (value - self.__estimate)
+        self.__variance = (1.00 - gain) * variance
+        return self.__estimate
+
+
+def make_filter(kind: str, window: int):
+    if kind == FILTER_AVERAGE:
+        return MovingAverage(window)
+    if kind == FILTER_MEDIAN:
+        return MovingMedian(window)
+    if kind == FILTER_KALMAN:
+        return ScalarKalman()
+    raise ValueError(f"Unknown filter: {kind}")
+
+
+class SensorValues(NamedTuple):
+    afr: float  # filtered air-fuel ratio
+    maf_volts: float  # filtered MAF output
+    timestamp: float  # when the newest sample in them was read
+
+
+class SensorPipeline:
+    """
+    Class reading the throttle body's sensors in bursts at its own rate and filtering them.
+
+    The firmware samples its sensors about 52 times a second and keeps the newest few. Each
+    poll() reads up to i2c_comms.SENSOR_BURST_SIZE of them in one FUNC_GET_SENSOR_BURST
+    call, skips the ones already seen using the firmware's sample count, drops O2 readings
+    at the ADC rails (a disconnected or cold sensor) and runs the rest through the filters.
+    start() polls on a thread of its own at `rate` Hz, so the control loop never waits on
+    a sensor read, it takes the latest result from values(). Firmware without
+    FUNC_GET_SENSOR_BURST echoes the request back, after which polling stops for good and
+    values() stays None.
+    """
+
+    rate: float
+    supported: bool
+    max_age: float
+    bursts: int
+    samples: int
+    missed: int
+    rejected: int
+    errors: int
+
+    __call_function: Callable[..., Tuple[bool, Any]]
+    __clock: Callable[[], float]
+    __sleep: Callable[[float], None]
+    __afr_filter: Any
+    __maf_filter: Any
+    __count: Optional[int]
+    __values: Optional[SensorValues]
+    __running: bool
+    __thread: Optional[threading.Thread]
+
+    def __init__(
+        self,
+        call_function: Callable[..., Tuple[bool, Any]] = i2c.call_function,
+        rate: float = 10.00,
+        kind: str = FILTER_MEDIAN,
+        window: int = 5,
+        max_age: float = 1.00,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        """
+        rate: bursts per second read by the thread start() runs
+        kind: FILTER_AVERAGE, FILTER_MEDIAN or FILTER_KALMAN, over `window` samples
+        max_age: seconds after the last good sample that values() gives up on the sensors
+        """
+        self.rate = rate
+        self.max_age = max_age
+        self.supported = True
+        self.bursts = 0
+        self.samples = 0
+        self.missed = 0
+        self.rejected = 0
+        self.errors = 0
+        self.__call_function = call_function
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__afr_filter = make_filter(kind, window)
+        self.__maf_filter = make_filter(kind, window)
+        self.__count = None
+        self.__values = None
+        self.__running = False
+        self.__thread = None
+
+    # Internal functions
+    def __run(self):
+        scheduler = TickScheduler(self.rate, POLICY_SKIP, self.__clock, self.__sleep)
+        scheduler.start()
+        while self.__running and self.supported:
+            scheduler.wait()
+            self.poll()
+
+    # Public Functions
+    def poll(self) -> int:
+        """Reads one burst and filters the new samples in it, returns how many it used"""
+        if not self.supported:
+            return 0
+        try:
+            (ok, burst) = self.__call_function(i2c.Function.FUNC_GET_SENSOR_BURST)
+        except (OSError, DeadlineMissed):
+            ok = False
+        if not ok:
+            self.errors += 1
+            _READ_ERRORS.inc()
+            # Firmware that does not know a command replies with the request frame unchanged
+            if burst == i2c.Function.FUNC_GET_SENSOR_BURST:
+                self.supported = False
+            return 0
+        self.bursts += 1
+
+        samples = burst.samples
+        if self.__count is None or burst.count < self.__count:
+            # First burst, or the board reset and started counting again
+            new = len(samples)
+        else:
+            new = burst.count - self.__count
+            if new > len(samples):
+                self.missed += new - len(samples)
+                _MISSED.inc(new - len(samples))
+                new = len(samples)
+        self.__count = burst.count
+
+        used = 0
+        afr = maf = None
+        for (maf_raw, o2_raw) in samples[len(samples) - new :]:
+            if not 0 < o2_raw < ADC_MAX:
+                self.rejected += 1
+                _REJECTED.inc()
+                continue
+            afr = self.__afr_filter.update(afr_from_raw(o2_raw))
+            maf = self.__maf_filter.update(volts_from_raw(maf_raw))
+            used += 1
+        if used:
+            self.samples += used
+            _USED.inc(used)
+            # A single reference swap, the control loop never sees half an update
+            self.__values = SensorValues(afr, maf, self.__clock())
+        return used
+
+    def values(self) -> Optional[SensorValues]:
+        """Returns the newest filtered values, or None if there are none from `max_age`"""
+        values = self.__values
+        if values is None or self.__clock() - values.timestamp > self.max_age:
+            return None
+        return values
+
+    def start(self):
+        if self.__thread is not None:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name="sensors", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def running(self) -> bool:
+        return self.__thread is not None
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "rate": self.rate,
+            "supported": self.supported,
+            "bursts": self.bursts,
+            "samples": self.samples,
+            "missed": self.missed,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
@@ -0,0 +1,210 @@
+"""Module for cutting redundant servo traffic from the controller's bus calls"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import time
+import i2c_comms as i2c
+import metrics
+from plant import reported_position, servo_angle
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Globals
+_DURATION_WEIGHT = 0.10  # weight of the newest sample in the mean call duration
+
+_HITS = metrics.Counter(
+    "servo_cache_hits_total", "Calls answered without using the bus", ("function",)
+)
+_SAVED_SECONDS = metrics.Counter(
+    "servo_cache_saved_seconds_total", "Estimated bus time saved by the servo cache"
+)
+
+
+class ServoCache:
+    """
+    Class that sits in front of a call_function and skips servo calls the board does not
+    need to see.
+
+    A SET_SERVO that would leave the servo at the angle the board last acknowledged is not
+    sent, and GET_SERVO is answered from that angle. The cached angle is only trusted for
+    `max_age` seconds after the board last confirmed it, and a real read is forced at
+    least every `verify_interval` seconds. Any bus error or error reply drops the cache,
+    since the board may have reset. Bus time saved is estimated from the running mean
+    duration of real calls.
+
+    With `bulk` set, real reads use FUNC_GET_TELEMETRY and writes use
+    FUNC_SET_SERVO_READBACK. They cost one transaction each, like the calls they replace,
+    and also return firmware health data (see telemetry()). A readback also confirms the
+    cached angle, so fewer forced reads are needed. Firmware older than those functions
+    echoes the request back as an error reply, in which case the call is made again with
+    FUNC_GET_SERVO or FUNC_SET_SERVO and bulk mode is left off from then on.
+    """
+
+    bulk: bool
+    max_age: float
+    verify_interval: float
+    reads: int
+    cached_reads: int
+    writes: int
+    suppressed_writes: int
+    mismatches: int
+    saved_seconds: float
+
+    __call_function: Callable[..., Tuple[bool, Any]]
+    __read_function: i2c.Function
+    __write_function: i2c.Function
+    __telemetry: Optional[i2c.Telemetry]
+    __clock: Callable[[], float]
+    __angle: Optional[int]
+    __confirmed: float
+    __last_read: float
+    __durations: Dict[int, float]
+
+    def __init__(
+        self,
+        call_function: Callable[..., Tuple[bool, Any]] = i2c.call_function,
+        max_age: float = 1.00,
+        verify_interval: float = 5.00,
+        clock: Callable[[], float] = time.monotonic,
+        bulk: bool = False,
+    ):
+        self.bulk = bulk
+        self.max_age = max_age
+        self.verify_interval = verify_interval
+        self.reads = 0
+        self.cached_reads = 0
+        self.writes = 0
+        self.suppressed_writes = 0
+        self.mismatches = 0
+        self.saved_seconds = 0.00
+        self.__call_function = call_function
+        self.__read_function = (
+            i2c.Function.FUNC_GET_TELEMETRY if bulk else i2c.Function.FUNC_GET_SERVO
+        )
+        self.__write_function = (
+            i2c.Function.FUNC_SET_SERVO_READBACK
+            if bulk
+            else i2c.Function.FUNC_SET_SERVO
+        )
+        self.__telemetry = None
+        self.__clock = clock
+        self.__angle = None
+        self.__confirmed = 0.00
+        self.__last_read = 0.00
+        self.__durations = {}
+
+    # Internal functions
+    def __forward(self, function: i2c.Function, *args) -> Tuple[bool, Any]:
+        start = time.perf_counter()
+        try:
+            result = self.__call_function(function, *args)
+        except OSError:
+            self.invalidate()
+            raise
+        elapsed = time.perf_counter() - start
+        mean = self.__durations.get(function)
+        self.__durations[function] = (
+            elapsed if mean is None else mean + _DURATION_WEIGHT * (elapsed - mean)
+        )
+        return result
+
+    def __unsupported(self, function: i2c.Function, result: Any) -> bool:
+        # Firmware that does not know a command replies with the request frame unchanged
+        if not self.bulk or result != function:
+            return False
+        print(f"Throttle body does not support {function.name}, bulk telemetry disabled")
+        self.bulk = False
+        self.__read_function = i2c.Function.FUNC_GET_SERVO
+        self.__write_function = i2c.Function.FUNC_SET_SERVO
+        return True
+
+    def __saved(self, function: i2c.Function):
+        saved = self.__durations.get(function, 0.00)
+        self.saved_seconds += saved
+        _SAVED_SECONDS.inc(saved)
+        _HITS.labels(function.name).inc()
+
+    def __fresh(self, now: float) -> bool:
+        return self.__angle is not None and now - self.__confirmed <= self.max_age
+
+    def __set_servo(self, pos: int) -> Tuple[bool, Any]:
+        now = self.__clock()
+        angle = servo_angle(pos)
+        if angle == self.__angle and self.__fresh(now):
+            self.suppressed_writes += 1
+            self.__saved(self.__write_function)
+            return (True, None)
+
+        (response, result) = self.__forward(self.__write_function, pos)
+        self.writes += 1
+        if not response:
+            self.invalidate()
+            if self.__unsupported(self.__write_function, result):
+                return self.__set_servo(pos)
+            return (response, result)
+
+        self.__angle = angle
+        self.__confirmed = now
+        if result is not None:
+            # Readback frame, the board reported its state after the write
+            self.__telemetry = result
+            self.__angle = result.servo_angle
+            self.__last_read = now
+        return (True, None)
+
+    def __get_servo(self) -> Tuple[bool, Any]:
+        now = self.__clock()
+        if self.__fresh(now) and now - self.__last_read < self.verify_interval:
+            self.cached_reads += 1
+            self.__saved(self.__read_function)
+            return (True, reported_position(self.__angle))
+
+        (response, result) = self.__forward(self.__read_function)
+        self.reads += 1
+        self.__last_read = now
+        if not response:
+            self.invalidate()
+            if self.__unsupported(self.__read_function, result):
+                return self.__get_servo()
+            return (response, result)
+
+        if isinstance(result, i2c.Telemetry):
+            self.__telemetry = result
+            result = result.position
+        if self.__angle is not None:
+            if reported_position(self.__angle) == result:
+                self.__confirmed = now
+            else:
+                # The board holds something else, so the next write must go out
+                self.mismatches += 1
+                self.invalidate()
+        return (True, result)
+
+    # Public Functions
+    def call_function(self, function: i2c.Function, *args) -> Tuple[bool, Any]:
+        """Same as i2c_comms.call_function(), skipping redundant servo calls"""
+        if function == i2c.Function.FUNC_SET_SERVO:
+            return self.__set_servo(*args)
+        if function == i2c.Function.FUNC_GET_SERVO:
+            return self.__get_servo()
+        return self.__forward(function, *args)
+
+    def telemetry(self) -> Optional[i2c.Telemetry]:
+        """Returns the newest firmware telemetry frame, bulk mode only"""
+        return self.__telemetry
+
+    def invalidate(self):
+        """Forgets the cached angle, the next read and write both go to the bus"""
+        self.__angle = None
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "reads": self.reads,
+            "cached_reads": self.cached_reads,
+            "writes": self.writes,
+            "suppressed_writes": self.suppressed_writes,
+            "mismatches": self.mismatches,
+            "saved_seconds": self.saved_seconds,
+        }
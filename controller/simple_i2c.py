@@ -6,47 +6,299 @@ __license__ = "MIT"
 __version__ = "0.1"
 
 from smbus2 import SMBus, i2c_msg
-import struct, sys
+from typing import ContextManager, Dict, Iterator, List, Optional, Tuple
+import contextlib, ctypes, metrics, struct, sys, threading, time
+
+# Globals
+I2C_M_RD = 0x0001  # read flag of struct i2c_msg (linux/i2c.h)
+_MAX_CACHED_MESSAGES = 16  # per direction and bus, other sizes get one-off messages
 
 # Private globals
-__SMBUS_ACTIVE: bool = False
-__SMBUS_OBJ: SMBus = None
+__DEFAULT_BUS: Optional[int] = None  # bus used by the module level functions
+
+_TRANSACTION_SECONDS = metrics.Histogram(
+    "i2c_transaction_seconds", "Time spent in one i2c_rdwr call", ("op",)
+)
+# Children resolved once so timing a transaction is a clock read and an observe()
+_WRITE_TIME = _TRANSACTION_SECONDS.labels("write")
+_READ_TIME = _TRANSACTION_SECONDS.labels("read")
+_WRITE_READ_TIME = _TRANSACTION_SECONDS.labels("write_read")
+_WRITE_READ_MANY_TIME = _TRANSACTION_SECONDS.labels("write_read_many")
+
+
+class Message:
+    """An i2c_msg with its own buffer, which `view` fills or reads without new objects"""
+
+    __slots__ = ("msg", "view")
+
+    msg: i2c_msg
+    view: memoryview
+
+    def __init__(self, address: int, size: int, flags: int = 0):
+        buf = ctypes.create_string_buffer(size)
+        self.msg = i2c_msg(
+            addr=address,
+            flags=flags,
+            len=size,
+            buf=ctypes.cast(buf, ctypes.POINTER(ctypes.c_char)),
+        )
+        # Also keeps the buffer alive for as long as the message
+        self.view = memoryview(buf).cast("B")
+
+
+class MessageCache:
+    """
+    Class handing out preallocated messages for fixed-size frames.
+
+    Building an i2c_msg allocates a ctypes buffer and copies into it, and bytes() on a read
+    message goes through ctypes.string_at, which together cost more than the rest of a
+    call's Python work. A cached message is allocated once per address and size and only
+    has its buffer refilled. Messages are shared, so a cache must only be used by whoever
+    holds the bus, and read data must be copied out before the bus is released.
+    """
+
+    __writes: Dict[Tuple[int, int], Message]
+    __reads: Dict[Tuple[int, int], Message]
+
+    def __init__(self):
+        self.__writes = {}
+        self.__reads = {}
+
+    # Internal functions
+    def __get(self, messages: Dict, address: int, size: int, flags: int) -> Message:
+        key = (address, size)
+        message = messages.get(key)
+        if message is None:
+            message = Message(address, size, flags)
+            if len(messages) < _MAX_CACHED_MESSAGES:
+                messages[key] = message
+        return message
+
+    # Public Functions
+    def write(self, address: int, data: bytes) -> Message:
+        """Returns a write message holding `data`"""
+        message = self.__get(self.__writes, address, len(data), 0)
+        message.view[:] = data
+        return message
+
+    def read(self, address: int, num_bytes: int) -> Message:
+        """Returns a read message, view.tobytes() gives the data once it has run"""
+        return self.__get(self.__reads, address, num_bytes, I2C_M_RD)
+
+
+class Bus:
+    """
+    Class for one open I2C bus that several threads can share.
+
+    Each transaction holds `lock` only for the i2c_rdwr call and the copies in and out of
+    its cached messages. Hold the lock yourself (see BusManager.session()) to run several
+    transactions with nothing from other threads in between. It is reentrant, so the
+    methods still work inside a session.
+    """
+
+    num: int
+    lock: threading.RLock
+
+    __bus: SMBus
+    __messages: MessageCache
+
+    def __init__(self, num: int, bus: SMBus = None):
+        """
+        bus: used in place of a real SMBus, any object with `i2c_rdwr(*msgs)` and `close()`
+            will do (see i2c_emulator.ArduinoEmulator)
+        """
+        self.num = num
+        self.lock = threading.RLock()
+        self.__bus = bus if bus is not None else SMBus(num)
+        self.__messages = MessageCache()
+
+    def i2c_rdwr(self, *msgs: i2c_msg):
+        with self.lock:
+            self.__bus.i2c_rdwr(*msgs)
+
+    def write(self, address: int, data: bytes):
+        with self.lock:
+            message = self.__messages.write(address, data)
+            start = time.perf_counter()
+            self.__bus.i2c_rdwr(message.msg)
+            elapsed = time.perf_counter() - start
+        _WRITE_TIME.observe(elapsed)
+
+    def read(self, address: int, num_bytes: int) -> bytes:
+        with self.lock:
+            message = self.__messages.read(address, num_bytes)
+            start = time.perf_counter()
+            self.__bus.i2c_rdwr(message.msg)
+            elapsed = time.perf_counter() - start
+            result = message.view.tobytes()
+        _READ_TIME.observe(elapsed)
+        return result
+
+    def write_read(self, address: int, data: bytes, num_bytes: int) -> bytes:
+        """Writes `data` then reads `num_bytes` back in one transaction (repeated start)"""
+        with self.lock:
+            write_message = self.__messages.write(address, data)
+            read_message = self.__messages.read(address, num_bytes)
+            start = time.perf_counter()
+            self.__bus.i2c_rdwr(write_message.msg, read_message.msg)
+            elapsed = time.perf_counter() - start
+            result = read_message.view.tobytes()
+        _WRITE_READ_TIME.observe(elapsed)
+        return result
+
+    def write_read_many(
+        self, address: int, data: List[bytes], num_bytes: int
+    ) -> List[bytes]:
+        """
+        Writes each buffer in `data` and reads `num_bytes` back after each one, holding the
+        lock throughout so no other thread's traffic lands in between.
+
+        Each pair is a repeated start transaction of its own. The Pi's i2c-bcm2835 driver
+        only accepts a read as the last message of an I2C_RDWR, and the kernel takes at most
+        42 messages in one, so a single transaction would fail on real hardware.
+        """
+        results: List[bytes] = []
+        with self.lock:
+            start = time.perf_counter()
+            for buf in data:
+                write_message = self.__messages.write(address, buf)
+                read_message = self.__messages.read(address, num_bytes)
+                self.__bus.i2c_rdwr(write_message.msg, read_message.msg)
+                results.append(read_message.view.tobytes())
+            elapsed = time.perf_counter() - start
+        _WRITE_READ_MANY_TIME.observe(elapsed)
+        return results
+
+    def close(self):
+        with self.lock:
+            self.__bus.close()
+
+
+class BusManager:
+    """
+    Class holding the open buses by number, so every part of the program that talks to bus
+    `num` shares one Bus and its lock.
+    """
+
+    __buses: Dict[int, Bus]
+    __lock: threading.Lock
+
+    def __init__(self):
+        self.__buses = {}
+        self.__lock = threading.Lock()
+
+    def open(self, num: int, bus: SMBus = None) -> Bus:
+        """
+        Returns bus `num`, opening it first if needed. Raises ValueError if `bus` is given
+        and the bus is already open.
+        """
+        with self.__lock:
+            handle = self.__buses.get(num)
+            if handle is not None:
+                if bus is not None:
+                    raise ValueError(f"Bus {num} is already open")
+                return handle
+            handle = Bus(num, bus)
+            self.__buses[num] = handle
+            return handle
+
+    def get(self, num: int) -> Optional[Bus]:
+        return self.__buses.get(num)
+
+    def close(self, num: int):
+        with self.__lock:
+            handle = self.__buses.pop(num, None)
+        if handle is not None:
+            handle.close()
+
+    def close_all(self):
+        with self.__lock:
+            handles = list(self.__buses.values())
+            self.__buses.clear()
+        for handle in handles:
+            handle.close()
+
+    @contextlib.contextmanager
+    def session(self, num: int) -> Iterator[Bus]:
+        """
+        Holds bus `num` for the duration of a `with` block, for transactions that must not
+        have another thread's in between
+        """
+        handle = self.__buses.get(num)
+        if handle is None:
+            raise ValueError(f"Bus {num} is not open")
+        with handle.lock:
+            yield handle
+
+
+__MANAGER: BusManager = BusManager()
+
+
+def manager() -> BusManager:
+    """Returns the BusManager behind this module's functions"""
+    global __MANAGER
+
+    return __MANAGER
+
+
+def _active_bus() -> Optional[Bus]:
+    global __MANAGER
+    global __DEFAULT_BUS
+
+    handle = __MANAGER.get(__DEFAULT_BUS) if __DEFAULT_BUS is not None else None
+    if handle is None:
+        print("Bus is not active, please initialize the bus first", file=sys.stderr)
+    return handle
+
 
+def init_bus(num: int, bus: SMBus = None) -> bool:
+    """
+    Opens I2C bus `num` and makes it the bus the functions in this module use.
 
-def init_bus(num: int) -> bool:
-    global __SMBUS_ACTIVE
-    global __SMBUS_OBJ
+    If `bus` is given it is used in place of a real SMBus, any object with
+    `i2c_rdwr(*msgs)` and `close()` will do (see i2c_emulator.ArduinoEmulator). Other buses
+    can be open at the same time through manager().
+    """
+    global __MANAGER
+    global __DEFAULT_BUS
 
-    if __SMBUS_ACTIVE:
+    if __MANAGER.get(num) is not None:
         print(
             "Bus is already active, please close the bus before re-initializing",
             file=sys.stderr,
         )
         return False
 
-    __SMBUS_OBJ = SMBus(num)
-    __SMBUS_ACTIVE = True
+    __MANAGER.open(num, bus)
+    __DEFAULT_BUS = num
     return True
 
 
-def close_bus():
-    global __SMBUS_ACTIVE
-    global __SMBUS_OBJ
+def close_bus(num: Optional[int] = None):
+    """Closes bus `num`, by default the one opened by the last init_bus()"""
+    global __MANAGER
+    global __DEFAULT_BUS
 
-    __SMBUS_OBJ.close()
-    __SMBUS_ACTIVE = False
+    if num is None:
+        num = __DEFAULT_BUS
+    if num is not None:
+        __MANAGER.close(num)
+    if num == __DEFAULT_BUS:
+        __DEFAULT_BUS = None
 
 
-def write_bytes(address: int, data: bytes):
-    global __SMBUS_ACTIVE
-    global __SMBUS_OBJ
+def session() -> ContextManager[Bus]:
+    """Same as BusManager.session() for the bus opened by init_bus()"""
+    global __MANAGER
+    global __DEFAULT_BUS
+
+    return __MANAGER.session(__DEFAULT_BUS)
 
-    if not __SMBUS_ACTIVE:
-        print("Bus is not active, please initialize the bus first", file=sys.stderr)
-        return
 
-    msg: i2c_msg = i2c_msg.write(address, data)
-    __SMBUS_OBJ.i2c_rdwr(msg)
+def write_bytes(address: int, data: bytes):
+    bus = _active_bus()
+    if bus is not None:
+        bus.write(address, data)
 
 
 def write_int(
@@ -56,11 +308,8 @@ def write_int(
     signed: bool = True,
     byte_order: str = "little",
 ):
-    global __SMBUS_ACTIVE
-    global __SMBUS_OBJ
-
-    if not __SMBUS_ACTIVE:
-        print("Bus is not active, please initialize the bus first", file=sys.stderr)
+    bus = _active_bus()
+    if bus is None:
         return
 
     if int_sz < 0:
@@ -80,18 +329,12 @@ def write_int(
         elif int_sz < 64:
             int_sz = 64
 
-    msg: i2c_msg = i2c_msg.write(
-        address, value.to_bytes(int_sz // 8, byteorder=byte_order, signed=signed)
-    )
-    __SMBUS_OBJ.i2c_rdwr(msg)
+    bus.write(address, value.to_bytes(int_sz // 8, byteorder=byte_order, signed=signed))
 
 
 def write_float(address: int, value: float, double_precision: bool = False):
-    global __SMBUS_ACTIVE
-    global __SMBUS_OBJ
-
-    if not __SMBUS_ACTIVE:
-        print("Bus is not active, please initialize the bus first", file=sys.stderr)
+    bus = _active_bus()
+    if bus is None:
         return
 
     data: bytes
@@ -100,8 +343,7 @@ def write_float(address: int, value: float, double_precision: bool = False):
     else:
         data = struct.pack("f", value)
 
-    msg: i2c_msg = i2c_msg.write(address, data)
-    __SMBUS_OBJ.i2c_rdwr(msg)
+    bus.write(address, data)
 
 
 def write_int8(address: int, value: int, byte_order: str = "little"):
@@ -137,26 +379,39 @@ def write_uint64(address: int, value: int, byte_order: str = "little"):
 
 
 def read_bytes(address: int, num_bytes: int) -> bytes:
-    global __SMBUS_ACTIVE
-    global __SMBUS_OBJ
+    bus = _active_bus()
+    if bus is None:
+        return
 
-    if not __SMBUS_ACTIVE:
-        print("Bus is not active, please initialize the bus first", file=sys.stderr)
+    return bus.read(address, num_bytes)
+
+
+def write_read_bytes(address: int, data: bytes, num_bytes: int) -> bytes:
+    """Writes `data` then reads `num_bytes` back in one transaction (repeated start)"""
+    bus = _active_bus()
+    if bus is None:
         return
 
-    msg: i2c_msg = i2c_msg.read(address, num_bytes)
-    __SMBUS_OBJ.i2c_rdwr(msg)
-    return bytes(msg)
+    return bus.write_read(address, data, num_bytes)
+
+
+def write_read_many(address: int, data: List[bytes], num_bytes: int) -> List[bytes]:
+    """
+    Writes each buffer in `data` and reads `num_bytes` back after each one, with nothing from
+    other threads in between (see Bus.write_read_many())
+    """
+    bus = _active_bus()
+    if bus is None:
+        return
+
+    return bus.write_read_many(address, data, num_bytes)
 
 
 def read_int(
     address: int, int_sz: int = 32, signed: bool = True, byte_order: str = "little"
 ) -> int:
-    global __SMBUS_ACTIVE
-    global __SMBUS_OBJ
-
-    if not __SMBUS_ACTIVE:
-        print("Bus is not active, please initialize the bus first", file=sys.stderr)
+    bus = _active_bus()
+    if bus is None:
         return
 
     if int_sz < 0:
@@ -178,17 +433,13 @@ def read_int(
         elif int_sz < 64:
             int_sz = 64
 
-    msg: i2c_msg = i2c_msg.read(address, int_sz // 8)
-    __SMBUS_OBJ.i2c_rdwr(msg)
-    return int.from_bytes(bytes(msg), byteorder=byte_order, signed=signed)
+    data = bus.read(address, int_sz // 8)
+    return int.from_bytes(data, byteorder=byte_order, signed=signed)
 
 
 def read_float(address: int, double_precision: bool = False) -> float:
-    global __SMBUS_ACTIVE
-    global __SMBUS_OBJ
-
-    if not __SMBUS_ACTIVE:
-        print("Bus is not active, please initialize the bus first", file=sys.stderr)
+    bus = _active_bus()
+    if bus is None:
         return
 
     sz: int
@@ -200,9 +451,7 @@ def read_float(address: int, double_precision: bool = False) -> float:
         sz = 4
         fmt = "f"
 
-    msg = i2c_msg.read(address, sz)
-    __SMBUS_OBJ.i2c_rdwr(msg)
-    [x] = struct.unpack(fmt, bytes(msg))
+    [x] = struct.unpack(fmt, bus.read(address, sz))
     return x
 
 
@@ -0,0 +1,257 @@
+"""Script for auto-tuning the controller PID gains against the simulated plant and servo"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import argparse, itertools, json, os, random
+import i2c_comms as i2c
+import plant
+import simple_i2c as si2c
+from concurrent.futures import ProcessPoolExecutor
+from control_law import ACCEL_DIFF_RANGE, MAF_SETPOINT, ControlLaw, Gains
+from i2c_emulator import ArduinoEmulator
+from typing import Dict, List, NamedTuple, Tuple
+
+# Globals
+DEFAULT_FREQUENCY: float = 1.00 / 0.30  # Hz, Controller's default loop rate
+# Current hand-tuned gains, always evaluated so the ranking shows what beats them
+CURRENT_GAINS: Dict[str, Gains] = {
+    "cruise": Gains(0.55, 0.01, 0.6),
+    "throttle": Gains(1.0, 0.01, 0.1),
+}
+MAF_GAINS = Gains(4.0, 0.01, 0.1)  # no MAF dynamics to tune against yet
+# Search ranges (min, max) for P, I and D
+GAIN_RANGES: Tuple[Tuple[float, float], ...] = (
+    (0.05, 3.00),
+    (0.00, 0.50),
+    (0.00, 2.00),
+)
+
+# (initial speed, cruise target) pairs in mph
+CRUISE_SCENARIOS = ((0, 50), (30, 60), (70, 45))
+# Accelerator positions held for equal parts of the run
+THROTTLE_SCENARIOS = ((0.50, 0.20), (0.10, 0.90), (0.75, 0.70))
+
+
+class Settings(NamedTuple):
+    frequency: float
+    duration: float  # seconds per scenario
+    overshoot_weight: float  # seconds of score per percent of overshoot
+    activity_weight: float  # seconds of score per degree/s of throttle movement
+
+
+class Result(NamedTuple):
+    gains: Gains
+    score: float
+    settling_time: float
+    overshoot: float
+    activity: float
+
+
+def _score_trace(
+    values: List[float],
+    targets: List[float],
+    commands: List[int],
+    start: float,
+    band: float,
+    dt: float,
+) -> Tuple[float, float, float]:
+    """
+    Returns (settling time, overshoot %, throttle activity) for a run made of one or more
+    steps, settling time and overshoot being averaged over the steps.
+    """
+    settling_time = 0.00
+    overshoot = 0.00
+    steps = 0
+    seg_start = 0
+    for idx in range(1, len(targets) + 1):
+        if idx < len(targets) and targets[idx] == targets[seg_start]:
+            continue
+
+        target = targets[seg_start]
+        step = target - start
+        settle_idx = seg_start
+        worst = 0.00
+        for pos in range(seg_start, idx):
+            if abs(values[pos] - target) > band:
+                settle_idx = pos + 1
+            if step != 0:
+                worst = max(worst, (values[pos] - target) / step * 100.00)
+        settling_time += (settle_idx - seg_start) * dt
+        overshoot += worst
+        steps += 1
+        start = values[idx - 1]
+        seg_start = idx
+
+    moves = sum(abs(b - a) for (a, b) in zip(commands, commands[1:]))
+    activity = moves / (len(commands) * dt)
+    return (settling_time / steps, overshoot / steps, activity)
+
+
+def _run_scenario(
+    law: ControlLaw,
+    settings: Settings,
+    speed: float,
+    accelerator: List[float],
+    cruise_target: int,
+) -> Tuple[List[float], List[int], List[int]]:
+    """
+    Runs the control law tick by tick against a fresh Arduino emulator, the same way
+    Controller.simulate does. Returns the speed, throttle and command traces.
+    """
+    dt = 1.00 / settings.frequency
+    cruise_enabled = cruise_target is not None
+    throttle = 0
+    speeds: List[float] = []
+    throttles: List[int] = []
+    commands: List[int] = []
+
+    si2c.init_bus(1, ArduinoEmulator())
+    try:
+        for accel in accelerator:
+            (response, result) = i2c.call_function(i2c.Function.FUNC_GET_SERVO)
+            if response:
+                throttle = result
+            # Same integration as Controller.update_speed
+            speed = max(speed + plant.acceleration(throttle) * dt, 0.00)
+            pos = law.update(
+                throttle,
+                speed,
+                accel,
+                cruise_enabled,
+                cruise_target,
+                MAF_SETPOINT,
+                dt,
+            )
+            pos = min(max(pos, 0), 90)
+            i2c.call_function(i2c.Function.FUNC_SET_SERVO, pos)
+            speeds.append(speed)
+            throttles.append(throttle)
+            commands.append(pos)
+    finally:
+        si2c.close_bus()
+    return (speeds, throttles, commands)
+
+
+def evaluate(job: Tuple[str, Gains, Settings]) -> Result:
+    """Scores one gain set for the "cruise" or "throttle" loop over all its scenarios"""
+    (loop, gains, settings) = job
+    dt = 1.00 / settings.frequency
+    ticks = int(settings.duration * settings.frequency)
+    totals = [0.00, 0.00, 0.00]
+
+    if loop == "cruise":
+        for (speed, target) in CRUISE_SCENARIOS:
+            law = ControlLaw(gains, CURRENT_GAINS["throttle"], MAF_GAINS)
+            (speeds, _, commands) = _run_scenario(
+                law, settings, speed, [0.00] * ticks, target
+            )
+            band = max(abs(target - speed) * 0.02, 1.00)
+            metrics = _score_trace(speeds, [target] * ticks, commands, speed, band, dt)
+            totals = [a + b for (a, b) in zip(totals, metrics)]
+        count = len(CRUISE_SCENARIOS)
+    else:
+        for positions in THROTTLE_SCENARIOS:
+            law = ControlLaw(CURRENT_GAINS["cruise"], gains, MAF_GAINS)
+            accelerator = [
+                positions[idx * len(positions) // ticks] for idx in range(ticks)
+            ]
+            (_, throttles, commands) = _run_scenario(law, settings, 0, accelerator, None)
+            targets = [accel * 90 for accel in accelerator]
+            metrics = _score_trace(
+                throttles, targets, commands, throttles[0], ACCEL_DIFF_RANGE, dt
+            )
+            totals = [a + b for (a, b) in zip(totals, metrics)]
+        count = len(THROTTLE_SCENARIOS)
+
+    (settling_time, overshoot, activity) = [total / count for total in totals]
+    score = (
+        settling_time
+        + settings.overshoot_weight * overshoot
+        + settings.activity_weight * activity
+    )
+    return Result(gains, score, settling_time, overshoot, activity)
+
+
+def candidates(search: str, samples: int, seed: int) -> List[Gains]:
+    """Returns a grid of `samples` points per gain, or `samples` random gain sets"""
+    if search == "grid":
+        axes = [
+            [lo + (hi - lo) * idx / max(samples - 1, 1) for idx in range(samples)]
+            for (lo, hi) in GAIN_RANGES
+        ]
+        return [Gains(*point) for point in itertools.product(*axes)]
+
+    rng = random.Random(seed)
+    return [
+        Gains(*(rng.uniform(lo, hi) for (lo, hi) in GAIN_RANGES))
+        for _ in range(samples)
+    ]
+
+
+def tune(
+    loop: str, gain_sets: List[Gains], settings: Settings, workers: int
+) -> List[Result]:
+    jobs = [(loop, gains, settings) for gains in [CURRENT_GAINS[loop]] + gain_sets]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunk = max(len(jobs) // (workers * 4), 1)
+        results = list(pool.map(evaluate, jobs, chunksize=chunk))
+    return sorted(results, key=lambda result: result.score)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--loops", nargs="+", choices=CURRENT_GAINS, default=["cruise", "throttle"]
+    )
+    parser.add_argument("--search", choices=("grid", "random"), default="random")
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=500,
+        help="random draws, or points per gain for a grid search",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--frequency", type=float, default=DEFAULT_FREQUENCY)
+    parser.add_argument("--duration", type=float, default=60.00, help="seconds")
+    parser.add_argument("--overshoot-weight", type=float, default=0.20)
+    parser.add_argument("--activity-weight", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--top", type=int, default=10, help="gain sets kept per loop")
+    parser.add_argument("--output", default="gains.json")
+    args = parser.parse_args()
+
+    settings = Settings(
+        args.frequency, args.duration, args.overshoot_weight, args.activity_weight
+    )
+    gain_sets = candidates(args.search, args.samples, args.seed)
+
+    tuning: Dict[str, List[Dict]] = {}
+    for loop in args.loops:
+        ranked = tune(loop, gain_sets, settings, args.workers)
+        tuning[loop] = [
+            {
+                "gains": list(result.gains),
+                "score": result.score,
+                "settling_time": result.settling_time,
+                "overshoot": result.overshoot,
+                "activity": result.activity,
+            }
+            for result in ranked[0 : args.top]
+        ]
+        best = ranked[0]
+        current = next(r for r in ranked if r.gains == CURRENT_GAINS[loop])
+        print(
+            f"{loop}: best P={best.gains.p:.3f} I={best.gains.i:.3f} D={best.gains.d:.3f}"
+            f" score {best.score:.2f} (current gains score {current.score:.2f})"
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(tuning, f, indent=4)
+    print(f"Wrote {args.output}, load it with controller.load_gains()")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,33 +5,95 @@ __copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
 __license__ = "MIT"
 __version__ = "0.1"
 
-import threading, os.path, signal, sys
-from flask import Flask, render_template
-from flask_socketio import SocketIO, emit
+import math, threading, os.path, signal, sys, time
+from flask import Flask, Response, jsonify, render_template, request
+from flask_socketio import SocketIO, emit, join_room, leave_room
 
 # Add controller directory to import path
-sys.path.append(
-    os.path.abspath(
-        os.path.join(os.path.dirname(__file__), os.path.pardir, "controller")
-    )
+CONTROLLER_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.path.pardir, "controller")
 )
-import simple_i2c as si2c
-from controller import Controller
+sys.path.append(CONTROLLER_DIR)
+import i2c_comms as i2c
+import metrics
+from bus_recording import BusRecorder
+from bus_scheduler import BusScheduler
+from control_law import CRUISE_PID
+from controller import Controller, _LOOP_FREQUENCY, load_gains
+from controller_process import ControllerProcess
+from diagnostics import FreezeFrame, read_log
+from headless import HeadlessGPIO
+from history import HistoryRecorder
+from i2c_emulator import ArduinoEmulator, EmulatedBus, engine_sensors
+from smbus2 import SMBus
+from telemetry import TelemetryBroadcaster, pick_tier, room_name, to_view
+from typing import Dict, List, Optional, Tuple
+
+
+def _parse_devices(spec: str) -> List[Tuple[int, int]]:
+    # "0x08:17,0x09:27" -> [(address, reset pin), ...]
+    devices = []
+    for item in spec.split(","):
+        (address, reset_pin) = item.split(":")
+        devices.append((int(address, 0), int(reset_pin)))
+    return devices
+
 
 # Globals
-CONTROLLER_OBJ: Controller = None
-CONTROLLER_THREAD: threading.Thread = None
+# Set ECM_DEVICES to drive several throttle bodies on bus 1, as address:reset pin pairs
+DEVICES: List[Tuple[int, int]] = _parse_devices(
+    os.environ.get("ECM_DEVICES", "0x08:17")
+)
+BUS_NUM: int = 1
+BUS_SCHEDULER: BusScheduler = None
+CONTROLLERS: Dict[int, Controller] = {}  # device address -> controller or its client
+CONTROLLER_THREADS: List[threading.Thread] = []
+BROADCASTERS: Dict[int, TelemetryBroadcaster] = {}
+CLIENT_SUBSCRIPTIONS = {}  # Socket.IO session id -> (device address, rate tier)
+HISTORIES: Dict[int, HistoryRecorder] = {}
+HISTORY_SECONDS: float = 10 * 60 * 60  # trend history kept in memory
+# Set ECM_BUS_RECORDING to a file path to record all bus traffic for replay.py
+BUS_RECORDING_FILE = os.environ.get("ECM_BUS_RECORDING")
+BUS_RECORDER: BusRecorder = None
+# Set ECM_DTC_LOG to a file path to keep every DTC set and clear with its freeze frame
+DTC_LOG_FILE = os.environ.get("ECM_DTC_LOG")
+GAINS_FILE = os.path.join(CONTROLLER_DIR, "gains.json")  # written by tune_pid.py
+# Set ECM_CONTROLLER_PROCESS=1 to run the controllers in a process of their own
+CONTROLLER_PROCESS_MODE: bool = os.environ.get("ECM_CONTROLLER_PROCESS") == "1"
+CONTROLLER_PROCESS: ControllerProcess = None
+CONTROLLER_POLL_PERIOD: float = 0.02  # seconds between telemetry reads in process mode
+JOBS_STARTED: bool = False
+_JOBS_LOCK = threading.Lock()
+# Set ECM_EMULATE=1 to drive Arduino emulators instead of the bus (thread mode only)
+EMULATE: bool = os.environ.get("ECM_EMULATE") == "1"
+# Set ECM_CRUISE_MODE=mpc for model predictive cruise control, needs numpy
+CRUISE_MODE: str = os.environ.get("ECM_CRUISE_MODE", CRUISE_PID)
 
 
 def app_cleanup(sig, frame):
-    global CONTROLLER_OBJ
-    global CONTROLLER_THREAD
+    global CONTROLLERS
+    global CONTROLLER_THREADS
+    global BROADCASTERS
+    global BUS_SCHEDULER
+    global BUS_RECORDER
+    global CONTROLLER_PROCESS
 
     print("Closed by user!")
-    if CONTROLLER_OBJ != None:
-        CONTROLLER_OBJ.cleanup()
-    if CONTROLLER_THREAD != None:
-        CONTROLLER_THREAD.join()
+    for broadcaster in BROADCASTERS.values():
+        broadcaster.stop()
+    if CONTROLLER_PROCESS != None:
+        CONTROLLER_PROCESS.close()
+        CONTROLLER_PROCESS = None
+    else:
+        for controller in CONTROLLERS.values():
+            controller.cleanup()
+    for thread in CONTROLLER_THREADS:
+        thread.join()
+    if BUS_SCHEDULER != None:
+        BUS_SCHEDULER.stop()
+    if BUS_RECORDER != None:
+        i2c.set_recorder(None)
+        BUS_RECORDER.close()
     exit(0)
 
 
@@ -39,72 +101,326 @@ app = Flask(__name__)
 app.config["SECRET_KEY"] = "kCUs9h7KhTCZK6kSmfEUL8Ao"
 socketio = SocketIO(app)
 signal.signal(signal.SIGINT, app_cleanup)
+BROADCASTERS = {
+    address: TelemetryBroadcaster(
+        socketio.emit, socketio.sleep, time.monotonic, address
+    )
+    for (address, _) in DEVICES
+}
+
+
+def _client_device() -> int:
+    global CLIENT_SUBSCRIPTIONS
+    global DEVICES
+
+    (device, _) = CLIENT_SUBSCRIPTIONS.get(request.sid, (DEVICES[0][0], None))
+    return device
+
+
+def _emulated_gpio(emulator: ArduinoEmulator, reset_pin: int) -> HeadlessGPIO:
+    # Reset line wired straight to the emulated board
+    def on_output(pin: int, level: int):
+        if pin == reset_pin:
+            emulator.set_reset(level == HeadlessGPIO.HIGH)
+
+    return HeadlessGPIO(time.monotonic, on_output)
+
+
+def _poll_controller_process():
+    global CONTROLLER_PROCESS
+
+    while CONTROLLER_PROCESS != None:
+        CONTROLLER_PROCESS.poll()
+        socketio.sleep(CONTROLLER_POLL_PERIOD)
+
+
+def _start_controller_process():
+    global DEVICES
+    global BUS_NUM
+    global CONTROLLERS
+    global CONTROLLER_PROCESS
+    global BROADCASTERS
+    global HISTORIES
+    global BUS_RECORDING_FILE
+    global DTC_LOG_FILE
+    global CRUISE_MODE
+
+    CONTROLLER_PROCESS = ControllerProcess(
+        DEVICES,
+        BUS_NUM,
+        GAINS_FILE,
+        BUS_RECORDING_FILE,
+        dtc_log=DTC_LOG_FILE,
+        cruise_mode=CRUISE_MODE,
+    )
+    for (address, client) in CONTROLLER_PROCESS.clients.items():
+        client.add_snapshot_listener(BROADCASTERS[address].publish)
+        HISTORIES[address] = HistoryRecorder(int(HISTORY_SECONDS * _LOOP_FREQUENCY))
+        client.add_snapshot_listener(HISTORIES[address].record)
+        CONTROLLERS[address] = client
+    CONTROLLER_PROCESS.start()
+    socketio.start_background_task(_poll_controller_process)
+
+
+def _start_controller_threads():
+    global DEVICES
+    global BUS_NUM
+    global BUS_SCHEDULER
+    global CONTROLLERS
+    global CONTROLLER_THREADS
+    global BROADCASTERS
+    global HISTORIES
+    global BUS_RECORDING_FILE
+    global BUS_RECORDER
+    global DTC_LOG_FILE
+    global EMULATE
+    global CRUISE_MODE
+
+    if os.path.isfile(GAINS_FILE):
+        load_gains(GAINS_FILE)
+    if EMULATE:
+        emulators = {
+            address: ArduinoEmulator(address, sensor_model=engine_sensors)
+            for (address, _) in DEVICES
+        }
+        BUS_SCHEDULER = BusScheduler(EmulatedBus(*emulators.values()))
+    else:
+        BUS_SCHEDULER = BusScheduler(SMBus(BUS_NUM))
+    BUS_SCHEDULER.start()
+
+    for (address, reset_pin) in DEVICES:
+        device = i2c.Device(BUS_SCHEDULER, address)
+        gpio = _emulated_gpio(emulators[address], reset_pin) if EMULATE else None
+        controller = Controller(
+            device=device,
+            reset_pin=reset_pin,
+            gpio=gpio,
+            dtc_log=DTC_LOG_FILE,
+            cruise_mode=CRUISE_MODE,
+        )
+        frequency = controller.get_loop_stats()["frequency"]
+        # A call still queued a whole tick later is stale, the next tick replaces it
+        device.deadline = 1.00 / frequency
+        controller.add_snapshot_listener(BROADCASTERS[address].publish)
+        HISTORIES[address] = HistoryRecorder(int(HISTORY_SECONDS * frequency))
+        controller.add_snapshot_listener(HISTORIES[address].record)
+        CONTROLLERS[address] = controller
+
+    if BUS_RECORDING_FILE:
+        if len(CONTROLLERS) == 1:
+            [controller] = CONTROLLERS.values()
+            BUS_RECORDER = BusRecorder(BUS_RECORDING_FILE, controller.get_inputs)
+            i2c.set_recorder(BUS_RECORDER)
+        else:
+            print("Bus recording only supports a single device", file=sys.stderr)
 
+    for controller in CONTROLLERS.values():
+        thread = threading.Thread(target=controller.simulate)
+        thread.start()
+        CONTROLLER_THREADS.append(thread)
 
-def bus_func():
-    global CONTROLLER_OBJ
 
-    si2c.init_bus(1)
-    CONTROLLER_OBJ.simulate()
-    si2c.close_bus()
+def start_jobs():
+    """
+    Starts the controllers and telemetry broadcasters, once. App factories call this
+    directly, otherwise the first request does.
+    """
+    global BROADCASTERS
+    global JOBS_STARTED
 
+    if JOBS_STARTED:
+        return
+    with _JOBS_LOCK:
+        if JOBS_STARTED:
+            return
+        if CONTROLLER_PROCESS_MODE:
+            if EMULATE:
+                print(
+                    "ECM_EMULATE is ignored with ECM_CONTROLLER_PROCESS",
+                    file=sys.stderr,
+                )
+            _start_controller_process()
+        else:
+            _start_controller_threads()
+        for broadcaster in BROADCASTERS.values():
+            socketio.start_background_task(broadcaster.run)
+        JOBS_STARTED = True
 
-@app.before_first_request
-def activate_job():
-    global CONTROLLER_OBJ
-    global CONTROLLER_THREAD
 
-    CONTROLLER_OBJ = Controller()
-    CONTROLLER_THREAD = threading.Thread(target=bus_func)
-    CONTROLLER_THREAD.start()
+# Flask 2.3 removed before_first_request, start_jobs() only runs once anyway
+app.before_request(start_jobs)
 
 
 @app.route("/")
 def index():
-    return render_template("index.html")
+    global DEVICES
+
+    return render_template(
+        "index.html", devices=[f"{address:#04x}" for (address, _) in DEVICES]
+    )
+
+
+@app.route("/history")
+def history():
+    """
+    Trend data for the last `window` seconds (ending `end` seconds ago), reduced to at
+    most `points` min/max/mean buckets. `fields` is a comma separated subset of
+    history.FIELDS. `device` is the throttle body address, the first one by default.
+    """
+    global DEVICES
+    global HISTORIES
+
+    device = int(request.args.get("device", str(DEVICES[0][0])), 0)
+    if device not in HISTORIES:
+        return jsonify({"error": f"Unknown device {device:#04x}"}), 404
+    window = request.args.get("window", 60.00, type=float)
+    points = request.args.get("points", 500, type=int)
+    end = request.args.get("end", 0.00, type=float)
+    fields = request.args.get("fields", None, type=str)
+    if fields is not None:
+        fields = fields.split(",")
+    return jsonify(HISTORIES[device].query(window, points, end, fields))
+
+
+def _frame_view(frame: Optional[FreezeFrame]) -> Optional[Dict[str, List]]:
+    # Ticks from before the controller started are NaN, which JSON cannot hold
+    if frame is None:
+        return None
+    return {
+        name: [None if math.isnan(value) else value for value in values]
+        for (name, values) in frame.samples.items()
+    }
+
+
+@app.route("/dtc")
+def dtc():
+    """
+    Active DTCs and, with ECM_DTC_LOG set, the logged set and clear events for `code`
+    (all by default) between the wall clock times `start` and `end`. Set events carry
+    their freeze frame. `device` is the throttle body address, the first one by default.
+    """
+    global DEVICES
+    global CONTROLLERS
+    global DTC_LOG_FILE
+
+    device = int(request.args.get("device", str(DEVICES[0][0])), 0)
+    if device not in CONTROLLERS:
+        return jsonify({"error": f"Unknown device {device:#04x}"}), 404
+    snapshot = CONTROLLERS[device].get_snapshot()
+    events = []
+    if DTC_LOG_FILE:
+        events = read_log(
+            DTC_LOG_FILE,
+            request.args.get("code", None, type=int),
+            request.args.get("start", None, type=float),
+            request.args.get("end", None, type=float),
+            device,
+        )
+    return jsonify(
+        {
+            "active": to_view(snapshot)["dtc"] if snapshot is not None else [],
+            "events": [
+                {
+                    "time": event.time,
+                    "tick": event.tick,
+                    "code": event.code,
+                    "active": event.active,
+                    "frame": _frame_view(event.frame),
+                }
+                for event in events
+            ],
+        }
+    )
+
+
+@app.route("/metrics")
+def metrics_text():
+    """Controller and bus latency histograms and counters for Prometheus to scrape"""
+    global CONTROLLER_PROCESS
+
+    if CONTROLLER_PROCESS != None:
+        text = CONTROLLER_PROCESS.metrics_text()
+    else:
+        text = metrics.render()
+    return Response(text, content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/controller/restart", methods=["POST"])
+def restart_controller():
+    """Restarts the controller process, only available with ECM_CONTROLLER_PROCESS=1"""
+    global CONTROLLER_PROCESS
+
+    if CONTROLLER_PROCESS == None:
+        return jsonify({"error": "Controllers run in the web server process"}), 409
+    CONTROLLER_PROCESS.restart()
+    return jsonify(CONTROLLER_PROCESS.stats())
 
 
 @socketio.on("my event")
 def reply():
-    global CONTROLLER_OBJ
-
-    data = {}
-    data["cruise_on"] = CONTROLLER_OBJ.get_cruise_control_status()
-    data["cruise_speed"] = 0
-    if data["cruise_on"]:
-        data["cruise_speed"] = CONTROLLER_OBJ.get_cruise_target_speed()
-    data["vehicle_speed"] = CONTROLLER_OBJ.update_speed()
-    data["accelerator"] = CONTROLLER_OBJ.get_accelerator_position() * 100.00
-    data["throttle"] = CONTROLLER_OBJ.get_throttle_body() / 90.00 * 100.00
-    data["maf"] = CONTROLLER_OBJ.get_maf_value()
-    data["dtc"] = []
-    dtc_list = CONTROLLER_OBJ.get_dtc_list()
-    for dtc in dtc_list.values():
-        data["dtc"].append({"num": dtc.number, "mesg": dtc.message})
-    emit("my response", data)
+    global CONTROLLERS
+
+    # Full frame on request, kept for clients that poll instead of subscribing
+    snapshot = CONTROLLERS[_client_device()].get_snapshot()
+    if snapshot is not None:
+        emit("my response", to_view(snapshot))
+
+
+@socketio.on("subscribe")
+def subscribe(mesg):
+    global DEVICES
+    global BROADCASTERS
+    global CLIENT_SUBSCRIPTIONS
+
+    max_rate = None
+    device = DEVICES[0][0]
+    if isinstance(mesg, dict):
+        if mesg.get("max_rate") is not None:
+            max_rate = float(mesg["max_rate"])
+        if mesg.get("device") is not None:
+            device = int(str(mesg["device"]), 0)
+    if device not in BROADCASTERS:
+        return
+    rate = pick_tier(max_rate)
+
+    prev = CLIENT_SUBSCRIPTIONS.get(request.sid)
+    if prev is not None:
+        leave_room(room_name(prev[1], prev[0]))
+    CLIENT_SUBSCRIPTIONS[request.sid] = (device, rate)
+    join_room(room_name(rate, device))
+    emit("telemetry", BROADCASTERS[device].join_state(rate))
+
+
+@socketio.on("disconnect")
+def disconnect():
+    global CLIENT_SUBSCRIPTIONS
+
+    CLIENT_SUBSCRIPTIONS.pop(request.sid, None)
 
 
 @socketio.on("update accel")
 def update_accel(mesg):
-    global CONTROLLER_OBJ
+    global CONTROLLERS
 
+    controller = CONTROLLERS[_client_device()]
     accel_val = float(mesg["accel-val"]) / 100.00
-    CONTROLLER_OBJ.set_accelerator_position(accel_val)
-    CONTROLLER_OBJ.set_cruise_control_status(False)
+    controller.set_accelerator_position(accel_val)
+    controller.set_cruise_control_status(False)
 
 
 @socketio.on("update cruise")
 def update_cruise(mesg):
-    global CONTROLLER_OBJ
+    global CONTROLLERS
 
+    controller = CONTROLLERS[_client_device()]
     cruise_enable = mesg[0]["value"] == "true"
     cruise_speed = int(mesg[1]["value"])
 
     if cruise_enable:
-        CONTROLLER_OBJ.set_cruise_target_speed(cruise_speed)
-        CONTROLLER_OBJ.set_cruise_control_status(True)
+        controller.set_cruise_target_speed(cruise_speed)
+        controller.set_cruise_control_status(True)
     else:
-        CONTROLLER_OBJ.set_cruise_control_status(False)
+        controller.set_cruise_control_status(False)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,383 @@
+"""Script for load testing the dashboard with simulated Socket.IO clients"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import argparse, json, os, random, socket, subprocess, sys, threading, time
+import urllib.request
+import socketio
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+# Globals
+DEFAULT_STEPS = "1,2,5,10,20,50"  # clients per step
+DEFAULT_DURATION = 10.00  # seconds per step
+POLL_RATE = 5.00  # Hz, "my event" requests per client, main.js MAX_UPDATE_RATE
+INPUT_RATE = 0.50  # Hz, accelerator or cruise changes per client
+_RESPONSE_TIMEOUT = 2.00  # seconds before an unanswered "my event" counts as an error
+_STARTUP_TIMEOUT = 30.00  # seconds for the server to come up with its loops running
+
+
+def create_app():
+    """
+    Flask app factory for the server under test: the dashboard driving emulated throttle
+    bodies, plus GET /loadtest/loop to read (and with ?reset=1, restart) the loop stats
+    """
+    os.environ["ECM_EMULATE"] = "1"
+    os.environ.pop("ECM_CONTROLLER_PROCESS", None)
+    import dashboard
+
+    @dashboard.app.route("/loadtest/loop")
+    def loop_stats():
+        stats = {
+            f"{address:#04x}": controller.get_loop_stats()
+            for (address, controller) in dashboard.CONTROLLERS.items()
+        }
+        if dashboard.request.args.get("reset") == "1":
+            for controller in dashboard.CONTROLLERS.values():
+                controller.reset_loop_stats()
+        return dashboard.jsonify(stats)
+
+    # Start the controllers now rather than on whichever request comes first
+    dashboard.start_jobs()
+    return dashboard.app
+
+
+class _Client:
+    """
+    One simulated browser. It subscribes like main.js does on connect, polls with
+    "my event" at `poll_rate` and now and then moves the accelerator slider or submits the
+    cruise form.
+    """
+
+    latencies: List[float]
+    sent: int
+    received: int
+    errors: int
+
+    __sio: socketio.Client
+    __response: threading.Event
+    __device: str
+    __rng: random.Random
+
+    def __init__(self, device: str, seed: int):
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.__sio = socketio.Client(reconnection=False)
+        self.__response = threading.Event()
+        self.__device = device
+        self.__rng = random.Random(seed)
+        self.__sio.on("my response", self.__on_response)
+        self.__sio.on("telemetry", self.__on_telemetry)
+
+    # Internal functions
+    def __on_response(self, mesg):
+        self.received += 1
+        self.__response.set()
+
+    def __on_telemetry(self, mesg):
+        self.received += 1
+
+    def __emit(self, event: str, data=None):
+        self.__sio.emit(event, data)
+        self.sent += 1
+
+    def __send_input(self):
+        if self.__rng.random() < 0.80:
+            # The range input's value, sent as a string
+            self.__emit("update accel", {"accel-val": str(self.__rng.randint(0, 100))})
+        elif self.__rng.random() < 0.50:
+            # $("#cruise-form").serializeArray() with the checkbox ticked
+            self.__emit(
+                "update cruise",
+                [
+                    {"name": "cruise-enable", "value": "true"},
+                    {"name": "cruise-input", "value": str(self.__rng.randint(20, 80))},
+                ],
+            )
+        else:
+            # Unticked, main.js puts the missing checkbox back in front
+            self.__emit(
+                "update cruise",
+                [
+                    {"name": "cruise-enable", "value": "false"},
+                    {"name": "cruise-input", "value": "0"},
+                ],
+            )
+
+    # Public Functions
+    def connect(self, url: str):
+        self.__sio.connect(url)
+        self.__emit("subscribe", {"max_rate": POLL_RATE, "device": self.__device})
+
+    def run(self, until: float, poll_rate: float, input_rate: float):
+        period = 1.00 / poll_rate
+        # Count only the timed run, not the subscription and its full frame
+        self.sent = 0
+        self.received = 0
+        # Spread the clients out instead of having them all poll at once
+        next_poll = time.monotonic() + self.__rng.random() * period
+        while next_poll < until:
+            delay = next_poll - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_poll += period
+            if self.__rng.random() < input_rate * period:
+                self.__send_input()
+
+            self.__response.clear()
+            start = time.perf_counter()
+            self.__emit("my event")
+            if self.__response.wait(_RESPONSE_TIMEOUT):
+                self.latencies.append(time.perf_counter() - start)
+            else:
+                self.errors += 1
+
+    def disconnect(self):
+        self.__sio.disconnect()
+
+
+def _run_clients(
+    url: str,
+    count: int,
+    device: str,
+    start: float,
+    duration: float,
+    poll_rate: float,
+    input_rate: float,
+    seed: int,
+) -> Dict:
+    # Runs in a worker process, `start` is on the shared monotonic clock
+    clients = [_Client(device, seed + idx) for idx in range(count)]
+    connect_errors = 0
+    connected = []
+    for client in clients:
+        try:
+            client.connect(url)
+        except socketio.exceptions.ConnectionError:
+            connect_errors += 1
+        else:
+            connected.append(client)
+
+    delay = start - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    threads = [
+        threading.Thread(
+            target=client.run, args=(start + duration, poll_rate, input_rate)
+        )
+        for client in connected
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for client in connected:
+        client.disconnect()
+
+    return {
+        "latencies": [t for client in connected for t in client.latencies],
+        "sent": sum(client.sent for client in connected),
+        "received": sum(client.received for client in connected),
+        "errors": connect_errors + sum(client.errors for client in connected),
+    }
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def _get_json(url: str) -> Dict:
+    with urllib.request.urlopen(url, timeout=_RESPONSE_TIMEOUT) as response:
+        return json.load(response)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(url: str, device: str, server: subprocess.Popen = None):
+    """
+    Waits until the dashboard at `url` answers and the control loop for `device` is
+    ticking, so that clients never connect to a half started server. Raises RuntimeError
+    if `server` exits or the loop is not running within _STARTUP_TIMEOUT.
+    """
+    deadline = time.monotonic() + _STARTUP_TIMEOUT
+    reason = "no answer"
+    while True:
+        try:
+            loops = _get_json(f"{url}/loadtest/loop")
+        except (OSError, ValueError) as err:
+            reason = str(err)
+        else:
+            if device not in loops:
+                reason = f"no controller for {device}, only {sorted(loops)}"
+            elif loops[device]["ticks"] > 0:
+                return
+            else:
+                reason = f"controller for {device} has not ticked"
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"Dashboard exited with status {server.returncode}")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Dashboard did not start: {reason}")
+        time.sleep(0.20)
+
+
+def start_server(port: int, device: str, log=subprocess.DEVNULL) -> subprocess.Popen:
+    """
+    Starts the dashboard under test with `flask run`, the way run.sh does, sending its
+    output to the file `log`. Returns once wait_for_server() sees `device` ticking.
+    """
+    server = subprocess.Popen(
+        [sys.executable, "-m", "flask", "run"]
+        + ["--host", "127.0.0.1", "--port", str(port)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, FLASK_APP="load_test:create_app"),
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    try:
+        wait_for_server(f"http://127.0.0.1:{port}", device, server)
+    except RuntimeError:
+        server.kill()
+        server.wait()
+        raise
+    return server
+
+
+def run_step(
+    url: str,
+    clients: int,
+    duration: float,
+    workers: int,
+    device: str = "0x08",
+    poll_rate: float = POLL_RATE,
+    input_rate: float = INPUT_RATE,
+) -> Dict[str, float]:
+    """
+    Runs `clients` simulated browsers against the dashboard at `url` for `duration`
+    seconds, spread over up to `workers` processes so the clients do not compete with each
+    other for one GIL. Returns response latency, message rates and tick jitter.
+    """
+    workers = max(min(workers, clients), 1)
+    shares = [clients // workers + (idx < clients % workers) for idx in range(workers)]
+    # Connecting takes a while with many clients, start polling together afterwards
+    start = time.monotonic() + 1.00 + 0.05 * clients / workers
+
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [
+            pool.submit(
+                _run_clients,
+                url,
+                share,
+                device,
+                start,
+                duration,
+                poll_rate,
+                input_rate,
+                idx * 1000,
+            )
+            for (idx, share) in enumerate(shares)
+        ]
+        delay = start - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        _get_json(f"{url}/loadtest/loop?reset=1")
+        results = [future.result() for future in futures]
+        loop = _get_json(f"{url}/loadtest/loop")[device]
+
+    latencies = [t for result in results for t in result["latencies"]]
+    return {
+        "clients": clients,
+        "p50_ms": _percentile(latencies, 0.50) * 1e3,
+        "p99_ms": _percentile(latencies, 0.99) * 1e3,
+        "sent_per_s": sum(result["sent"] for result in results) / duration,
+        "received_per_s": sum(result["received"] for result in results) / duration,
+        "errors": sum(result["errors"] for result in results),
+        "ticks": loop["ticks"],
+        "overruns": loop["overruns"],
+        "jitter_mean_ms": loop["jitter_mean"] * 1e3,
+        "jitter_stddev_ms": loop["jitter_stddev"] * 1e3,
+        "jitter_max_ms": loop["jitter_max"] * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--steps", default=DEFAULT_STEPS, help="comma separated client counts"
+    )
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION)
+    parser.add_argument("--poll-rate", type=float, default=POLL_RATE, help="Hz")
+    parser.add_argument("--input-rate", type=float, default=INPUT_RATE, help="Hz")
+    parser.add_argument(
+        "--workers", type=int, default=min(os.cpu_count() or 1, 4), help="processes"
+    )
+    parser.add_argument(
+        "--url",
+        help="test a dashboard already started with FLASK_APP=load_test:create_app",
+    )
+    parser.add_argument("--device", default="0x08", help="throttle body to load")
+    parser.add_argument("--server-log", help="file for the dashboard's own output")
+    parser.add_argument("--output", help="JSON file for the results")
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        port = _free_port()
+        if args.server_log is not None:
+            # The server keeps its own handle to the file
+            with open(args.server_log, "w") as log:
+                server = start_server(port, args.device, log)
+        else:
+            server = start_server(port, args.device)
+        url = f"http://127.0.0.1:{port}"
+    else:
+        wait_for_server(url, args.device)
+
+    results = []
+    try:
+        print(
+            f"{'clients':>7} {'p50 ms':>8} {'p99 ms':>8} {'sent/s':>8} {'recv/s':>8} "
+            f"{'errors':>6} {'overruns':>8} {'jitter ms':>9} {'sd ms':>7} {'max ms':>7}"
+        )
+        for clients in (int(step) for step in args.steps.split(",")):
+            result = run_step(
+                url,
+                clients,
+                args.duration,
+                args.workers,
+                device=args.device,
+                poll_rate=args.poll_rate,
+                input_rate=args.input_rate,
+            )
+            results.append(result)
+            print(
+                f"{clients:>7} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+                f"{result['sent_per_s']:>8.1f} {result['received_per_s']:>8.1f} "
+                f"{result['errors']:>6} {result['overruns']:>8} "
+                f"{result['jitter_mean_ms']:>9.2f} {result['jitter_stddev_ms']:>7.2f} "
+                f"{result['jitter_max_ms']:>7.2f}"
+            )
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 var socket = io();
+var MAX_UPDATE_RATE = 5; // Hz, the server rounds down to its nearest rate tier
+var telemetry = {};
 $(document).ready(function () {
     var opts = {
         angle: -0.1,
@@ -71,10 +73,7 @@ $(document).ready(function () {
     gauge2.setMinValue(13400);  // Prefer setter over gauge.minValue = 0
     gauge2.animationSpeed = 32; // set animation speed (32 is default value)
     gauge2.set(13400); // set actual value
-    socket.on("connect", function () {
-        socket.emit("my event");
-    });
-    socket.on("my response", function (msg) {
+    function render(msg) {
         gauge.set(msg.vehicle_speed);
         $("#vehicle-speed-val").text(msg.vehicle_speed + " mph");
         gauge2.set(msg.maf * 1000);
@@ -83,8 +82,35 @@ $(document).ready(function () {
         $("#accel-val").text(msg.accelerator.toFixed(2) + "%");
         $("#throttle-bar").val(msg.throttle);
         $("#throttle-val").text(msg.throttle.toFixed(2) + "%");
+    }
+    function subscribe() {
+        socket.emit("subscribe", {
+            "max_rate": MAX_UPDATE_RATE,
+            "device": $("#device-select").val()
+        });
+    }
+    socket.on("connect", subscribe);
+    // Controls and telemetry follow the selected throttle body
+    $("#device-select").change(subscribe);
+    socket.on("my response", function (msg) {
+        render(msg);
         parseDTC(msg.dtc);
     });
+    // Telemetry frames only carry the fields that changed since the previous one
+    socket.on("telemetry", function (msg) {
+        if (msg.full) {
+            telemetry = {};
+            delete msg.full;
+        }
+        Object.assign(telemetry, msg);
+        if (telemetry.vehicle_speed === undefined) {
+            return;
+        }
+        render(telemetry);
+        if (msg.dtc !== undefined) {
+            parseDTC(telemetry.dtc);
+        }
+    });
     $("#cruise-form").submit(function () {
         var arr = $("#cruise-form").serializeArray();
         if (arr.length === 2) {
@@ -103,9 +129,6 @@ $(document).ready(function () {
         socket.emit("update cruise", arr);
         return false;
     });
-    setInterval(function () {
-        socket.emit("my event");
-    }, 600);
 });
 
 function updateAccel(val) {
@@ -0,0 +1,158 @@
+"""Module for fanning controller telemetry out to dashboards as delta-encoded frames"""
+
+__author__ = "Jackson Harmer"
+__copyright__ = "Copyright (c) 2020 Jackson Harmer. All rights reserved."
+__license__ = "MIT"
+__version__ = "0.1"
+
+import threading
+from controller import TelemetrySnapshot
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Globals
+RATE_TIERS: Tuple[float, ...] = (1.00, 2.00, 5.00, 10.00, 20.00)  # Hz
+DEFAULT_RATE: float = 5.00
+_DTC_VIEW: Tuple[Tuple[Tuple[int, str], ...], List[Dict[str, Any]]] = ((), [])
+
+
+def _dtc_view(dtc: Tuple[Tuple[int, str], ...]) -> List[Dict[str, Any]]:
+    # Codes change rarely, so the list is only rebuilt when they do
+    global _DTC_VIEW
+
+    (codes, view) = _DTC_VIEW
+    if dtc != codes:
+        view = [{"num": num, "mesg": mesg} for (num, mesg) in dtc]
+        _DTC_VIEW = (dtc, view)
+    return view
+
+
+def to_view(snapshot: TelemetrySnapshot) -> Dict[str, Any]:
+    """Converts a controller snapshot into the units shown on the dashboard"""
+    return {
+        "cruise_on": snapshot.cruise_on,
+        "cruise_speed": snapshot.cruise_speed,
+        # Tenths are enough to show, and keep small changes out of the delta frames
+        "vehicle_speed": round(snapshot.vehicle_speed, 1),
+        "accelerator": snapshot.accelerator * 100.00,
+        "throttle": snapshot.throttle / 90.00 * 100.00,
+        "maf": snapshot.maf,
+        "dtc": _dtc_view(snapshot.dtc),
+    }
+
+
+def pick_tier(max_rate: Optional[float]) -> float:
+    """Returns the fastest rate tier that does not exceed `max_rate`"""
+    if max_rate is None:
+        return DEFAULT_RATE
+    tier = RATE_TIERS[0]
+    for rate in RATE_TIERS:
+        if rate <= max_rate:
+            tier = rate
+    return tier
+
+
+def room_name(rate: float, device: Optional[int] = None) -> str:
+    if device is None:
+        return f"telemetry-{rate:g}hz"
+    return f"telemetry-{device:#04x}-{rate:g}hz"
+
+
+class _Room:
+    name: str
+    rate: float
+    period: float
+    next_due: float
+    last_seq: int
+    state: Dict[str, Any]
+
+    def __init__(self, rate: float, device: Optional[int]):
+        self.name = room_name(rate, device)
+        self.rate = rate
+        self.period = 1.00 / rate
+        self.next_due = 0.00
+        self.last_seq = -1
+        self.state = {}
+
+
+class TelemetryBroadcaster:
+    """
+    Class that broadcasts the latest controller snapshot to one Socket.IO room per rate tier.
+
+    The controller only hands over its latest snapshot via publish(). A single broadcast loop
+    then visits each tier when it is due and emits just the fields that changed since that
+    room's last emission, so the cost per tick depends on the number of tiers and not on the
+    number of connected dashboards.
+    """
+
+    __emit: Callable[..., None]
+    __sleep: Callable[[float], None]
+    __clock: Callable[[], float]
+    __snapshot: Optional[TelemetrySnapshot]
+    __rooms: Dict[float, _Room]
+    __lock: threading.Lock
+    __running: bool
+
+    def __init__(
+        self,
+        emit: Callable[..., None],
+        sleep: Callable[[float], None],
+        clock: Callable[[], float],
+        device: Optional[int] = None,
+    ):
+        """
+        emit: called as emit(event, data, to=room), e.g. SocketIO.emit
+        sleep: sleep function that cooperates with the server, e.g. SocketIO.sleep
+        clock: monotonic clock in seconds
+        device: address of the throttle body, gives each device its own rooms
+        """
+        self.__emit = emit
+        self.__sleep = sleep
+        self.__clock = clock
+        self.__snapshot = None
+        self.__rooms = {rate: _Room(rate, device) for rate in RATE_TIERS}
+        self.__lock = threading.Lock()
+        self.__running = False
+
+    def publish(self, snapshot: TelemetrySnapshot):
+        """Stores the newest snapshot, safe to call from the control loop"""
+        self.__snapshot = snapshot
+
+    def join_state(self, rate: float) -> Dict[str, Any]:
+        """Returns the full state a client joining the `rate` tier must start from"""
+        with self.__lock:
+            state = dict(self.__rooms[rate].state)
+        state["full"] = True
+        return state
+
+    def broadcast_once(self):
+        snapshot = self.__snapshot
+        if snapshot is None:
+            return
+        now = self.__clock()
+        view = None
+        with self.__lock:
+            for room in self.__rooms.values():
+                if now < room.next_due or room.last_seq == snapshot.seq:
+                    continue
+                room.next_due = now + room.period
+                room.last_seq = snapshot.seq
+                if view is None:
+                    view = to_view(snapshot)
+                delta = {
+                    key: value
+                    for (key, value) in view.items()
+                    if key not in room.state or room.state[key] != value
+                }
+                if delta:
+                    room.state.update(delta)
+                    self.__emit("telemetry", delta, to=room.name)
+
+    def run(self):
+        self.__running = True
+        min_period = 1.00 / RATE_TIERS[-1]
+        while self.__running:
+            self.broadcast_once()
+            self.__sleep(min_period)
+
+    def stop(self):
+        self.__running = False
@@ -11,6 +11,7 @@ namespace calibration
     constexpr int SERVO_MAX_POSITION = 118;
     constexpr unsigned long LOOP_DELAY = 100UL;
     constexpr unsigned long SERVO_READ_DELAY = 15UL;
+    constexpr unsigned long SENSOR_SAMPLE_DELAY = 20UL; // sensors are sampled through LOOP_DELAY
     constexpr float SATURATION_CUTOFF = 20.00f;
     constexpr float SATURATION_STEEPNESS = 10.00f;
 } // namespace calibration
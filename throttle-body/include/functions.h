@@ -6,8 +6,12 @@
 #pragma once
 
 //float Saturate(float val);
+void SaveBootResetFlags();
 void UpdateServo();
 int GetServoPosition();
 void SetServoPosition(int pos);
+void ReadSensors();
+void GetTelemetry();
+void GetSensorBurst();
 void receiveEvent(int howMany);
 void requestEvent();
@@ -29,9 +29,40 @@ enum class command : int8_t
 
     // Value between 1 and 128 are reserved for function calls
     GetServoPosition = 1,
-    SetServoPosition = 2
+    SetServoPosition = 2,
+    GetTelemetry = 3,             // Returns a telemetry frame
+    SetServoPositionReadback = 4, // Sets the servo, then returns a telemetry frame
+    GetSensorBurst = 5            // Returns the newest sensor samples
 };
 
+// Layout of params.p in a telemetry frame
+namespace telemetry
+{
+    constexpr int POSITION = 0;    // i: position in degrees, as GetServoPosition returns it
+    constexpr int SERVO_ANGLE = 1; // i: raw angle written to the servo
+    constexpr int SENSOR_0 = 2;    // i: analogRead() of the first sensor pin
+    constexpr int SENSOR_1 = 3;    // i: analogRead() of the second sensor pin
+    constexpr int LOOP_COUNT = 4;  // u: loop() iterations since boot
+    constexpr int ERROR_FLAGS = 5; // u: error_flag bits, cleared once sent
+    constexpr int UPTIME_MS = 6;   // u: millis()
+} // namespace telemetry
+
+// Layout of params.p in a sensor burst
+namespace sensor_burst
+{
+    constexpr int COUNT = 0;        // u: samples taken since boot
+    constexpr int FIRST_SAMPLE = 1; // u: A0 reading in the low half, A1 in the high half
+    constexpr int SAMPLES = 6;      // samples per burst, oldest first, the last is the newest
+} // namespace sensor_burst
+
+namespace error_flag
+{
+    constexpr uint32_t BAD_FRAME_SIZE = 0x01UL;        // A frame of the wrong size was dropped
+    constexpr uint32_t UNKNOWN_COMMAND = 0x02UL;       // A frame with an unknown command arrived
+    constexpr uint32_t POSITION_OUT_OF_RANGE = 0x04UL; // A position outside 0 - 90 was set
+    constexpr uint32_t RESET_CAUSE_SHIFT = 8UL;        // Bits 8 - 15 hold the reset cause (MCUSR)
+} // namespace error_flag
+
 struct i2c_buffer
 {
     command cmd;
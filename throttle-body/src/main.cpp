@@ -27,11 +27,27 @@ constexpr int SERVO_PWM_PIN = 3;
 constexpr unsigned long SERIAL_BAUD_RATE = 9'600UL;
 constexpr uint32_t I2C_BAUD_RATE = 100'000U;
 constexpr int I2C_ADDRESS = 8;
+constexpr uint8_t SENSOR_PINS[2] = { A0, A1 };
+constexpr uint8_t SENSOR_RING_SIZE = 8; // power of two, at least sensor_burst::SAMPLES
 
 i2c_buffer g_buf;
 volatile int g_servo_position;
+volatile int g_sensor_raw[2];
+volatile uint32_t g_sensor_samples[SENSOR_RING_SIZE]; // A0 | A1 << 16
+volatile uint32_t g_sensor_count;
+volatile uint32_t g_loop_count;
+volatile uint32_t g_error_flags;
+uint8_t g_boot_reset_flags __attribute__((section(".noinit")));
 Servo g_servo;
 
+// Optiboot clears MCUSR before starting the sketch and passes the old value in r2. This
+// runs before the C runtime setup, while r2 still holds it.
+void SaveBootResetFlags() __attribute__((naked, used, section(".init0")));
+void SaveBootResetFlags()
+{
+    __asm__ __volatile__("sts %0, r2\n" : "=m"(g_boot_reset_flags));
+}
+
 void setup()
 {
     Wire.begin(I2C_ADDRESS);
@@ -40,14 +56,31 @@ void setup()
     Wire.onRequest(requestEvent);
     g_servo.attach(SERVO_PWM_PIN);
     g_servo_position = g_servo.read();
+    // MCUSR is only still set when no bootloader ran, otherwise take the bootloader's copy
+    const uint8_t reset_cause = MCUSR != 0 ? MCUSR : g_boot_reset_flags;
+    g_error_flags = static_cast<uint32_t>(reset_cause) << error_flag::RESET_CAUSE_SHIFT;
+    MCUSR = 0;
     Serial.begin(SERIAL_BAUD_RATE);
     PRINTLN("DEBUG Enabled!\n");
 }
 
 void loop()
 {
-    delay(calibration::LOOP_DELAY);
+    // Oversample the sensors instead of idling, the Pi reads them back in bursts
+    const unsigned long start = millis();
+    while (millis() - start < calibration::LOOP_DELAY)
+    {
+        ReadSensors();
+        delay(calibration::SENSOR_SAMPLE_DELAY);
+    }
+
     UpdateServo();
+    ReadSensors();
+
+    // The I2C handlers read these from interrupt context, don't let them see half a write
+    noInterrupts();
+    ++g_loop_count;
+    interrupts();
 }
 
 // float Saturate(float val)
@@ -79,16 +112,62 @@ int GetServoPosition()
 
 void SetServoPosition(int pos)
 {
+    if (pos < 0 || pos > 90)
+    {
+        g_error_flags |= error_flag::POSITION_OUT_OF_RANGE;
+    }
+
     g_servo_position = map(pos, 0, 90, calibration::SERVO_MIN_POSITION, calibration::SERVO_MAX_POSITION);
     PRINT("Setting servo to ");
     PRINTLN(g_servo_position);
     g_buf.clear_error();
 }
 
+void ReadSensors()
+{
+    const int sensor_0 = analogRead(SENSOR_PINS[0]);
+    const int sensor_1 = analogRead(SENSOR_PINS[1]);
+
+    noInterrupts();
+    g_sensor_raw[0] = sensor_0;
+    g_sensor_raw[1] = sensor_1;
+    g_sensor_samples[g_sensor_count % SENSOR_RING_SIZE] =
+        static_cast<uint32_t>(sensor_0) | (static_cast<uint32_t>(sensor_1) << 16);
+    ++g_sensor_count;
+    interrupts();
+}
+
+void GetTelemetry()
+{
+    g_buf.params.p[telemetry::POSITION].i = GetServoPosition();
+    g_buf.params.p[telemetry::SERVO_ANGLE].i = g_servo_position;
+    g_buf.params.p[telemetry::SENSOR_0].i = g_sensor_raw[0];
+    g_buf.params.p[telemetry::SENSOR_1].i = g_sensor_raw[1];
+    g_buf.params.p[telemetry::LOOP_COUNT].u = g_loop_count;
+    g_buf.params.p[telemetry::ERROR_FLAGS].u = g_error_flags;
+    g_buf.params.p[telemetry::UPTIME_MS].u = millis();
+    g_error_flags = 0;
+}
+
+void GetSensorBurst()
+{
+    g_buf.clear_error();
+    g_buf.params.p[sensor_burst::COUNT].u = g_sensor_count;
+
+    // Slots before the first sample stay zero
+    for (int i = 0; i < sensor_burst::SAMPLES && static_cast<uint32_t>(i) < g_sensor_count; ++i)
+    {
+        const uint32_t idx = g_sensor_count - 1 - i;
+        g_buf.params.p[sensor_burst::FIRST_SAMPLE + sensor_burst::SAMPLES - 1 - i].u =
+            g_sensor_samples[idx % SENSOR_RING_SIZE];
+    }
+}
+
 void receiveEvent(int howMany)
 {
     if (howMany != sizeof(g_buf))
     {
+        g_error_flags |= error_flag::BAD_FRAME_SIZE;
         return;
     }
 
@@ -108,7 +187,21 @@ void receiveEvent(int howMany)
                 SetServoPosition(g_buf.params.p[0].i);
                 break;
 
+            case command::GetTelemetry:
+                GetTelemetry();
+                break;
+
+            case command::SetServoPositionReadback:
+                SetServoPosition(g_buf.params.p[0].i);
+                GetTelemetry();
+                break;
+
+            case command::GetSensorBurst:
+                GetSensorBurst();
+                break;
+
             default:
+                g_error_flags |= error_flag::UNKNOWN_COMMAND;
                 break;
         }
     }